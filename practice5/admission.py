@@ -0,0 +1,211 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+class Rejected(Exception):
+    """A request turned away before any work was done; answered with status_code and Retry-After"""
+
+    def __init__(self, status_code: int, reason: str, message: str, retry_after: float):
+        super().__init__(message)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+class RateLimiter:
+    """
+    Token bucket per key (API token, user_id, ...): rate tokens per second up
+    to burst, one per request; rate 0 disables the limit. At most max_keys
+    buckets are tracked, and the least recently used key starts over with a
+    full bucket when it is dropped.
+    """
+
+    def __init__(self, rate: float = 0, burst: float = 10, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (tokens, updated)
+        self.buckets = OrderedDict()
+        self.counters = {"admitted": 0, "limited": 0}
+
+    def acquire(self, key: str):
+        """0 when the request may go ahead, otherwise the seconds until the key has a token again"""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        bucket = self.buckets.pop(key, None)
+        tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        admitted = tokens >= 1
+        self.buckets[key] = (tokens - 1 if admitted else tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        if admitted:
+            self.counters["admitted"] += 1
+            return 0
+        self.counters["limited"] += 1
+        return (1 - tokens) / self.rate
+
+    def stats(self):
+        return {"rate": self.rate, "burst": self.burst, "tracked_keys": len(self.buckets), **self.counters}
+
+class ConcurrencyLimiter:
+    """
+    Lets at most limit requests run at once (0 disables it); the others wait
+    in FIFO order, at most max_queue of them. A request is shed at once when
+    the queue is full or its expected wait, from the recent time requests
+    take, is above queue_target, and gives up after waiting queue_target
+    anyway. A spike is then answered quickly instead of slowing every
+    request down until clients time out.
+    """
+
+    def __init__(self, limit: int = 100, max_queue: int = 500, queue_target: float = 5):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_target = queue_target
+        self.active = 0
+        self.waiters = deque()
+        # Moving average of the time a request holds its slot
+        self.service_time = None
+        self.wait_times = deque(maxlen=1000)
+        self.counters = {"admitted": 0, "waited": 0, "shed_queue_full": 0, "shed_expected_wait": 0,
+                         "shed_wait_timeout": 0}
+
+    def expected_wait(self):
+        if self.service_time is None or self.limit <= 0:
+            return 0
+        return (len(self.waiters) + 1) * self.service_time / self.limit
+
+    def wake(self):
+        """Hand free slots to the oldest waiters"""
+        while self.waiters and (self.limit <= 0 or self.active < self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    async def acquire(self):
+        if self.limit <= 0 or (self.active < self.limit and not self.waiters):
+            self.active += 1
+            self.counters["admitted"] += 1
+            self.wait_times.append(0)
+            return
+        if len(self.waiters) >= self.max_queue:
+            self.counters["shed_queue_full"] += 1
+            raise Rejected(503, "queue_full", f"Server busy: {self.max_queue} requests already waiting",
+                           self.expected_wait())
+        expected = self.expected_wait()
+        if expected > self.queue_target:
+            self.counters["shed_expected_wait"] += 1
+            raise Rejected(503, "expected_wait", f"Server busy: expected wait {expected:.1f}s is above "
+                           f"{self.queue_target}s", expected)
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.counters["waited"] += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_target)
+        except asyncio.TimeoutError:
+            if waiter.cancel():
+                self.waiters.remove(waiter)
+                self.counters["shed_wait_timeout"] += 1
+                raise Rejected(503, "wait_timeout", f"Server busy: no capacity within {self.queue_target}s",
+                               self.expected_wait())
+        except asyncio.CancelledError:
+            # A slot handed over just as the caller went away is passed on
+            if waiter.cancel():
+                self.waiters.remove(waiter)
+            else:
+                self.release()
+            raise
+        self.counters["admitted"] += 1
+        self.wait_times.append(time.monotonic() - start)
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.service_time = elapsed if self.service_time is None else 0.9 * self.service_time + 0.1 * elapsed
+            self.release()
+
+    def configure(self, limit: int = None, max_queue: int = None, queue_target: float = None):
+        if limit is not None:
+            self.limit = limit
+        if max_queue is not None:
+            self.max_queue = max_queue
+        if queue_target is not None:
+            self.queue_target = queue_target
+        self.wake()
+
+    def stats(self):
+        waits = sorted(self.wait_times)
+        pick = lambda fraction: round(waits[min(len(waits) - 1, int(fraction * len(waits)))], 4) if waits else None
+        return {
+            "limit": self.limit,
+            "max_queue": self.max_queue,
+            "queue_target": self.queue_target,
+            "active": self.active,
+            "queued": len(self.waiters),
+            "service_seconds": round(self.service_time, 4) if self.service_time is not None else None,
+            "wait_seconds": {"p50": pick(0.5), "p95": pick(0.95), "max": round(waits[-1], 4) if waits else None},
+            **self.counters
+        }
+
+class AdmissionControl:
+    """Rate limits per API token and per user_id, and the concurrency limit, of the gateway"""
+
+    def __init__(self, per_token: RateLimiter, per_user: RateLimiter, concurrency: ConcurrencyLimiter):
+        self.per_token = per_token
+        self.per_user = per_user
+        self.concurrency = concurrency
+
+    def check(self, token: str, user_id: str = None):
+        """Take a token from each bucket the request falls under; raises Rejected with 429 when one is empty"""
+        wait = self.per_token.acquire(token)
+        if wait:
+            raise Rejected(429, "token_rate", f"Rate limit of {self.per_token.rate}/s for this token exceeded", wait)
+        if user_id is not None:
+            wait = self.per_user.acquire(user_id)
+            if wait:
+                raise Rejected(429, "user_rate", f"Rate limit of {self.per_user.rate}/s for user {user_id} exceeded",
+                               wait)
+
+    def configure(self, settings: dict):
+        """Change the limits while running; keys are those of stats(), e.g. token_rate or max_concurrency"""
+        for prefix, limiter in (("token", self.per_token), ("user", self.per_user)):
+            for name in ("rate", "burst"):
+                if settings.get(f"{prefix}_{name}") is not None:
+                    setattr(limiter, name, settings[f"{prefix}_{name}"])
+        self.concurrency.configure(settings.get("max_concurrency"), settings.get("max_queue"),
+                                   settings.get("queue_target"))
+
+    def stats(self):
+        return {"per_token": self.per_token.stats(), "per_user": self.per_user.stats(),
+                "concurrency": self.concurrency.stats()}
+
+    def summary(self):
+        """Limits, load and rejection totals, without anything per token or user"""
+        concurrency = self.concurrency
+        return {
+            "token_rate": self.per_token.rate,
+            "user_rate": self.per_user.rate,
+            "max_concurrency": concurrency.limit,
+            "max_queue": concurrency.max_queue,
+            "active": concurrency.active,
+            "queued": len(concurrency.waiters),
+            "rejected": {
+                "token_rate": self.per_token.counters["limited"],
+                "user_rate": self.per_user.counters["limited"],
+                "queue_full": concurrency.counters["shed_queue_full"],
+                "expected_wait": concurrency.counters["shed_expected_wait"],
+                "wait_timeout": concurrency.counters["shed_wait_timeout"]
+            }
+        }
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "true").lower() == "true"
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "10000"))
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+# Seconds a cached result stays valid; 0 keeps results until they are evicted
+ANALYSIS_CACHE_TTL = float(os.getenv("ANALYSIS_CACHE_TTL", "3600"))
+# Optional directory shared by several business service instances
+ANALYSIS_CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", "")
+
+def cache_key(content: str, version: str):
+    """Content-addressed key: the same text analyzed by the same analyzer version maps to one entry"""
+    return hashlib.sha256(version.encode() + b"\0" + content.encode()).hexdigest()
+
+class AnalysisCache:
+    """
+    Bounded in-memory LRU of analysis results with TTL and size-based eviction,
+    optionally backed by a shared on-disk tier of one JSON file per key.
+    The memory tier is only used from the event loop; the disk tier methods
+    are safe to run in executor threads.
+    """
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 16 * 1024 * 1024,
+                 ttl: float = 3600, directory: str = ""):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.counters = {"hits": 0, "misses": 0, "disk_hits": 0, "evictions": 0, "expirations": 0}
+
+    def expired(self, stored_at: float):
+        return self.ttl > 0 and time.time() - stored_at > self.ttl
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        value, size, stored_at = entry
+        if self.expired(stored_at):
+            self.remove(key)
+            self.counters["expirations"] += 1
+            self.counters["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return value
+
+    def put(self, key: str, value: dict, stored_at: float = None):
+        size = len(key) + len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (value, size, stored_at or time.time())
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.counters["evictions"] += 1
+
+    def remove(self, key: str):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def disk_path(self, key: str):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def disk_get(self, key: str):
+        """Return (value, stored_at) from the disk tier, or None"""
+        if not self.directory:
+            return None
+        path = self.disk_path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if self.expired(stored_at):
+                os.remove(path)
+                return None
+            with open(path, encoding="utf-8") as cached:
+                return json.load(cached), stored_at
+        except (OSError, ValueError):
+            return None
+
+    def disk_put(self, key: str, value: dict):
+        if not self.directory:
+            return
+        path = self.disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as cached:
+            json.dump(value, cached)
+        os.replace(tmp_path, path)
+
+    def promote(self, key: str, value: dict, stored_at: float):
+        """Keep a disk-tier hit in memory and count it as a hit instead of a miss"""
+        self.counters["misses"] -= 1
+        self.counters["hits"] += 1
+        self.counters["disk_hits"] += 1
+        self.put(key, value, stored_at)
+
+    def stats(self):
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_ratio": round(self.counters["hits"] / lookups, 4) if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "disk_tier": self.directory or None
+        }
+
+def create_cache():
+    if not ANALYSIS_CACHE_ENABLED:
+        return None
+    return AnalysisCache(
+        max_entries=ANALYSIS_CACHE_MAX_ENTRIES,
+        max_bytes=ANALYSIS_CACHE_MAX_BYTES,
+        ttl=ANALYSIS_CACHE_TTL,
+        directory=ANALYSIS_CACHE_DIR
+    )
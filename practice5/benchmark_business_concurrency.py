@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import itertools
+import time
+
+import httpx
+
+import business_service
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Concurrency benchmark for the Business Logic Service /process endpoint")
+    parser.add_argument("--url", default=None,
+                        help="Live business service URL; the app is run in-process when omitted")
+    parser.add_argument("--clients", default="1,2,4,8,16,32,64",
+                        help="Comma separated list of concurrent client counts")
+    parser.add_argument("--requests-per-client", type=int, default=3)
+    parser.add_argument("--delay", type=float, default=None,
+                        help="Override PROCESSING_DELAY for the in-process app")
+    return parser.parse_args()
+
+# Every request sends new content, so none is answered from the analysis cache
+request_numbers = itertools.count()
+
+async def client_loop(client, url, headers, count, latencies):
+    for _ in range(count):
+        payload = {"content": f"This is a great sample text. I like this architecture! #{next(request_numbers)}",
+                   "existing_data": {}}
+        start = time.perf_counter()
+        response = await client.post(url, json=payload, headers=headers)
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+
+async def run_level(client, url, headers, clients, requests_per_client):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client_loop(client, url, headers, requests_per_client, latencies)
+        for _ in range(clients)
+    ])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "clients": clients,
+        "requests": len(latencies),
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed,
+        "p50": latencies[len(latencies) // 2],
+        "max": latencies[-1]
+    }
+
+async def main():
+    args = parse_args()
+    levels = [int(level) for level in args.clients.split(",")]
+    headers = {"Authorization": f"Bearer {business_service.INTERNAL_SERVICE_TOKEN}"}
+    if args.delay is not None:
+        business_service.PROCESSING_DELAY = args.delay
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=None,
+                                   limits=httpx.Limits(max_connections=max(levels)))
+        lifespan = None
+    else:
+        transport = httpx.ASGITransport(app=business_service.app)
+        client = httpx.AsyncClient(transport=transport, base_url="http://business", timeout=None)
+        lifespan = business_service.app.router.lifespan_context(business_service.app)
+        await lifespan.__aenter__()
+
+    print(f"executor={business_service.ANALYSIS_EXECUTOR} workers={business_service.ANALYSIS_WORKERS} "
+          f"delay={business_service.PROCESSING_DELAY}s")
+    print(f"{'clients':>8} {'requests':>9} {'elapsed_s':>10} {'req/s':>9} {'p50_ms':>9} {'max_ms':>9}")
+    try:
+        async with client:
+            for clients in levels:
+                result = await run_level(client, "/process", headers, clients, args.requests_per_client)
+                print(f"{result['clients']:>8} {result['requests']:>9} {result['elapsed']:>10.2f} "
+                      f"{result['throughput']:>9.2f} {result['p50'] * 1000:>9.1f} {result['max'] * 1000:>9.1f}")
+    finally:
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import httpx
+
+from load_test import percentile
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="End-to-end /process latency with the services networked and co-located in one process")
+    parser.add_argument("--modes", default="http,asgi,direct",
+                        help="http runs three uvicorn processes; asgi and direct run colocated:app")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per concurrency level")
+    parser.add_argument("--concurrency", default="1,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8100, help="First of the three ports used")
+    parser.add_argument("--token", default=os.getenv("APP_TOKEN", "YourSuperSecretToken"))
+    return parser.parse_args()
+
+def commands(mode, port):
+    """(module, port, extra environment) of the processes one mode runs; the gateway comes last"""
+    if mode == "http":
+        return [("database_service", port + 2, {}), ("business_service", port + 1, {}),
+                ("client_service", port, {"BUSINESS_SERVICE_URL": f"http://127.0.0.1:{port + 1}",
+                                          "DATABASE_SERVICE_URL": f"http://127.0.0.1:{port + 2}"})]
+    return [("colocated", port, {"DOWNSTREAM_TRANSPORT": mode})]
+
+async def start(module, port, environment, token):
+    env = {**os.environ, "PROCESSING_DELAY": "0", "STORAGE_BACKEND": "memory", "APP_TOKEN": token,
+           **environment}
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", f"{module}:app", "--host", "127.0.0.1", "--port", str(port),
+        "--log-level", "warning", env=env
+    )
+    async with httpx.AsyncClient() as client:
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(f"http://127.0.0.1:{port}/health", timeout=1)).status_code == 200:
+                    return process
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{module} did not start on port {port}")
+
+async def run(client, requests, concurrency, users, rng):
+    latencies = []
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            body = {"content": "This is a great sample text that we want to process. I like this architecture!",
+                    "user_id": rng.choice(users)}
+            start = time.perf_counter()
+            response = await client.post("/process", json=body)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200 or "error" in response.json():
+                raise RuntimeError(f"/process failed: {response.text}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return requests / elapsed, latencies
+
+async def measure(mode, args):
+    processes = []
+    try:
+        for module, port, environment in commands(mode, args.port):
+            processes.append(await start(module, port, environment, args.token))
+        rng = random.Random(1)
+        users = [f"bench_user_{i}" for i in range(args.users)]
+        levels = [int(level) for level in args.concurrency.split(",")]
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=30,
+                                     headers={"Authorization": f"Bearer {args.token}"},
+                                     limits=httpx.Limits(max_connections=max(levels))) as client:
+            await run(client, min(200, args.requests), max(levels), users, rng)  # warm-up
+            return [(level, *await run(client, args.requests, level, users, rng)) for level in levels]
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            await process.wait()
+
+def main():
+    args = parse_args()
+    print(f"{'mode':<8} {'concurrency':>11} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for mode in args.modes.split(","):
+        for concurrency, throughput, latencies in asyncio.run(measure(mode.strip(), args)):
+            print(f"{mode:<8} {concurrency:>11} {throughput:>8,.0f} {percentile(latencies, 0.5) * 1000:>8.2f} "
+                  f"{percentile(latencies, 0.99) * 1000:>8.2f} {latencies[-1] * 1000:>8.2f}")
+
+if __name__ == "__main__":
+    main()
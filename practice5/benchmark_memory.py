@@ -0,0 +1,81 @@
+import argparse
+import gc
+import time
+import tracemalloc
+from collections import deque
+
+from storage import MemoryStorage
+
+SENTIMENTS = ("positive", "negative", "neutral")
+BASE_TIME = 1745400000
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Memory used per user by the Database Service storage")
+    parser.add_argument("--users", default="100000,1000000", help="Comma-separated user counts to measure")
+    parser.add_argument("--history", type=int, default=50, help="History entries per user")
+    parser.add_argument("--legacy-max-users", type=int, default=100000,
+                        help="Largest user count measured with the old dict-of-dicts layout as well")
+    return parser.parse_args()
+
+# An hour's worth of distinct seconds, like a busy service writing in real time
+TIMESTAMPS = [time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(BASE_TIME + i)) for i in range(3600)]
+
+def timestamp(i):
+    # A new string object each time, as parsing a request body would produce
+    return (TIMESTAMPS[i % 3600] + " ")[:-1]
+
+def record(i, history_length):
+    # Fresh objects for every user, as parsing each request body would produce
+    return {
+        "analysis": {"word_count": i % 50, "character_count": i % 300, "sentiment": SENTIMENTS[i % 3],
+                     "processing_id": f"proc_{i % 9000 + 1000}"},
+        "metadata": {"last_updated": timestamp(i), "version": history_length, "history_length": history_length}
+    }
+
+def entry(i, j):
+    return {"timestamp": timestamp(i + j), "word_count": (i + j) % 50, "sentiment": SENTIMENTS[(i + j) % 3]}
+
+class LegacyStorage:
+    """The previous layout: record dicts and a deque of entry dicts per user"""
+
+    def __init__(self):
+        self.records = {}
+        self.histories = {}
+
+    def put(self, user_id, value):
+        self.records[user_id] = value
+
+    def append_history(self, user_id, value):
+        self.histories.setdefault(user_id, deque()).append(value)
+
+def measure(storage, users, history):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(users):
+        user_id = f"user_{i}"
+        for j in range(history):
+            storage.append_history(user_id, entry(i, j))
+        storage.put(user_id, record(i, history))
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used, elapsed
+
+def main():
+    args = parse_args()
+    print(f"{'layout':<8} {'users':>10} {'history':>8} {'total MB':>10} {'bytes/user':>11} {'load s':>8}")
+    for users in (int(count) for count in args.users.split(",")):
+        layouts = [("compact", MemoryStorage)]
+        if users <= args.legacy_max_users:
+            layouts.insert(0, ("legacy", LegacyStorage))
+        for name, factory in layouts:
+            storage = factory()
+            used, elapsed = measure(storage, users, args.history)
+            print(f"{name:<8} {users:>10,} {args.history:>8} {used / 2**20:>10.1f} {used / users:>11,.0f} "
+                  f"{elapsed:>8.1f}")
+            del storage
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import asyncio
+import time
+
+from fastapi import FastAPI
+
+from metrics import instrument
+
+def make_app(with_metrics: bool):
+    app = FastAPI()
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    if with_metrics:
+        instrument(app, "benchmark")
+    return app
+
+async def call(app, path="/health"):
+    """Drive the ASGI app directly so only the app and middleware cost is measured"""
+    scope = {"type": "http", "method": "GET", "path": path, "raw_path": path.encode(), "query_string": b"",
+             "headers": [], "http_version": "1.1", "scheme": "http", "server": ("bench", 80),
+             "client": ("bench", 1), "root_path": ""}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+async def measure(app, requests):
+    for _ in range(1000):
+        await call(app)
+    start = time.perf_counter()
+    for _ in range(requests):
+        await call(app)
+    return (time.perf_counter() - start) / requests
+
+async def main():
+    parser = argparse.ArgumentParser(description="Per-request cost of the metrics middleware")
+    parser.add_argument("--requests", type=int, default=50000)
+    args = parser.parse_args()
+
+    bare = await measure(make_app(False), args.requests)
+    instrumented = await measure(make_app(True), args.requests)
+    print(f"requests={args.requests}")
+    print(f"without metrics: {bare * 1e6:.1f} us/request")
+    print(f"with metrics:    {instrumented * 1e6:.1f} us/request")
+    print(f"overhead:        {(instrumented - bare) * 1e6:.1f} us/request")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import argparse
+import random
+import time
+
+from indexes import index_fields
+from storage import MemoryStorage
+
+SENTIMENTS = ("positive", "negative", "neutral")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Latency of indexed /query lookups as the record count grows")
+    parser.add_argument("--records", default="10000,100000,1000000", help="Comma-separated record counts")
+    parser.add_argument("--repeat", type=int, default=200, help="Queries per measurement")
+    parser.add_argument("--limit", type=int, default=50, help="Page size")
+    return parser.parse_args()
+
+def build(count, now, rng):
+    storage = MemoryStorage()
+    for i in range(count):
+        # Updates spread over the last 30 days
+        updated = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now - rng.randrange(30 * 86400)))
+        storage.put(f"user_{i}", {
+            "analysis": {"word_count": rng.randrange(100), "character_count": rng.randrange(600),
+                         "sentiment": rng.choice(SENTIMENTS), "processing_id": f"proc_{rng.randrange(1000, 10000)}"},
+            "metadata": {"last_updated": updated, "version": rng.randrange(1, 20), "history_length": 0}
+        })
+    return storage
+
+def timed(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2] * 1000
+
+def full_scan(storage, low, limit):
+    """What a client had to do before: walk every record and filter"""
+    matches = []
+    for user_id, value in storage.records.items():
+        sentiment, updated, _, _, _ = index_fields(value)
+        if sentiment == "negative" and updated is not None and updated >= low:
+            matches.append(user_id)
+            if len(matches) == limit:
+                break
+    return matches
+
+def main():
+    args = parse_args()
+    rng = random.Random(1)
+    now = int(time.time())
+    hour_ago = now - 3600
+    negative_recently = lambda fields: fields[0] == "negative"
+    print(f"{'records':>10} {'build s':>8}   median ms: {'sentiment':>9} {'last hour':>9} {'versions':>9} "
+          f"{'aggregates':>10} {'full scan':>9}")
+    for count in (int(value) for value in args.records.split(",")):
+        start = time.perf_counter()
+        storage = build(count, now, rng)
+        build_seconds = time.perf_counter() - start
+        results = [
+            timed(lambda: storage.query("sentiment", "negative", "negative", limit=args.limit), args.repeat),
+            timed(lambda: storage.query("updated", hour_ago, None, limit=args.limit, where=negative_recently),
+                  args.repeat),
+            timed(lambda: storage.query("version", 5, 7, limit=args.limit), args.repeat),
+            timed(storage.indexes.aggregates, args.repeat),
+            timed(lambda: full_scan(storage, hour_ago, args.limit), max(1, args.repeat // 20))
+        ]
+        print(f"{count:>10,} {build_seconds:>8.1f}   {'':>10}" + " ".join(f"{value:>9.3f}" for value in results[:3])
+              + f" {results[3]:>10.3f} {results[4]:>9.3f}")
+        del storage
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import random
+import time
+
+import sentiment
+
+def legacy_analyze(content):
+    """The original business_service implementation, kept for comparison"""
+    word_count = len(content.split())
+    char_count = len(content)
+    positive_words = ["good", "great", "excellent", "happy", "positive", "nice", "love", "like"]
+    negative_words = ["bad", "terrible", "awful", "sad", "negative", "hate", "dislike"]
+    words = content.lower().split()
+    positive_count = sum(1 for word in words if word in positive_words)
+    negative_count = sum(1 for word in words if word in negative_words)
+    if positive_count > negative_count:
+        sentiment_label = "positive"
+    elif negative_count > positive_count:
+        sentiment_label = "negative"
+    else:
+        sentiment_label = "neutral"
+    return {"word_count": word_count, "character_count": char_count, "sentiment": sentiment_label}
+
+VOCABULARY = sentiment.POSITIVE_WORDS + sentiment.NEGATIVE_WORDS + [
+    "the", "a", "service", "weather", "today", "request", "data", "Process", "user", "text", "sample", "is"
+] * 4
+
+def make_document(size, rng):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(VOCABULARY)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+def timed(function, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the original and the lexicon-based sentiment analysis")
+    parser.add_argument("--sizes", default="1024,16384,131072,1048576", help="Document sizes in bytes")
+    parser.add_argument("--batch", type=int, default=1000, help="Documents per batch for the batch comparison")
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    print(f"{'doc_bytes':>10} {'legacy_ms':>10} {'new_ms':>10} {'speedup':>8}")
+    for size in map(int, args.sizes.split(",")):
+        document = make_document(size, rng)
+        legacy_time, legacy_result = timed(legacy_analyze, document)
+        new_time, new_result = timed(sentiment.analyze, document)
+        assert legacy_result == new_result, (legacy_result, new_result)
+        print(f"{size:>10} {legacy_time * 1000:>10.3f} {new_time * 1000:>10.3f} {legacy_time / new_time:>7.1f}x")
+
+    documents = [make_document(1024, rng) for _ in range(args.batch)]
+    legacy_time, legacy_results = timed(lambda docs: [legacy_analyze(doc) for doc in docs], documents)
+    single_time, _ = timed(lambda docs: [sentiment.analyze(doc) for doc in docs], documents)
+    batch_time, batch_results = timed(sentiment.analyze_many, documents)
+    assert legacy_results == batch_results
+    print(f"\nbatch of {args.batch} x 1KB documents:")
+    print(f"  legacy per document: {legacy_time * 1000:.1f} ms")
+    print(f"  analyze per document: {single_time * 1000:.1f} ms")
+    print(f"  analyze_many: {batch_time * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
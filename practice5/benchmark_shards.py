@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import httpx
+
+from sharding import ShardingTransport
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Database read and write throughput with 1..N shards")
+    parser.add_argument("--shards", required=True,
+                        help="Comma-separated Database Service URLs; measured with the first 1, 2, ... of them")
+    parser.add_argument("--token", default=os.getenv("INTERNAL_SERVICE_TOKEN", "YourInternalToken"))
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=64, help="Requests in flight per shard")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per measurement")
+    return parser.parse_args()
+
+async def run(client, concurrency, duration, request):
+    done = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal done
+        while time.perf_counter() < deadline:
+            response = await request(client)
+            response.raise_for_status()
+            done += 1
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return done / duration
+
+async def measure(urls, args):
+    sharding = ShardingTransport(urls, lambda url: httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)))
+    users = [f"bench_user_{i}" for i in range(args.users)]
+
+    def write(client):
+        user_id = random.choice(users)
+        return client.post("/write", json={
+            "user_id": user_id,
+            "data": {"analysis": {"word_count": 12, "character_count": 70, "sentiment": "positive",
+                                  "processing_id": "proc_1234"}},
+            "history_entry": {"timestamp": time.strftime("%Y-%m-%d %H:%M:%S"), "word_count": 12,
+                              "sentiment": "positive"}
+        }, extensions={"shard_keys": [user_id]})
+
+    def read(client):
+        user_id = random.choice(users)
+        return client.get("/read", params={"user_id": user_id}, extensions={"shard_keys": [user_id]})
+
+    async with httpx.AsyncClient(transport=sharding, base_url=urls[0], timeout=30,
+                                 headers={"Authorization": f"Bearer {args.token}"}) as client:
+        concurrency = args.concurrency * len(urls)
+        return (await run(client, concurrency, args.duration, write),
+                await run(client, concurrency, args.duration, read))
+
+def main():
+    args = parse_args()
+    urls = [url.strip() for url in args.shards.split(",") if url.strip()]
+    print(f"{'shards':>6} {'writes/s':>10} {'reads/s':>10} {'write scaling':>14} {'read scaling':>13}")
+    baseline = None
+    for count in range(1, len(urls) + 1):
+        writes, reads = asyncio.run(measure(urls[:count], args))
+        baseline = baseline or (writes, reads)
+        print(f"{count:>6} {writes:>10,.0f} {reads:>10,.0f} {writes / baseline[0]:>13.2f}x {reads / baseline[1]:>12.2f}x")
+
+if __name__ == "__main__":
+    main()
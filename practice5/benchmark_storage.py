@@ -0,0 +1,72 @@
+import argparse
+import asyncio
+import shutil
+import tempfile
+import time
+
+from storage import DurableStorage
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write throughput and recovery time of the durable storage engine")
+    parser.add_argument("--records", type=int, default=1_000_000)
+    parser.add_argument("--writers", type=int, default=256,
+                        help="Concurrent writers sharing each group commit")
+    parser.add_argument("--group-commit-ms", type=float, default=2)
+    parser.add_argument("--no-fsync", action="store_true")
+    parser.add_argument("--dir", default=None, help="Data directory, a temporary one is used when omitted")
+    return parser.parse_args()
+
+def make_record(i):
+    return {
+        "analysis": {"word_count": i % 50, "character_count": i % 300, "sentiment": "positive",
+                     "processing_id": f"proc_{i % 9000 + 1000}"},
+        "metadata": {"last_updated": "2025-04-23 12:00:00", "version": 1}
+    }
+
+async def writer(storage, start, stop, step):
+    for i in range(start, stop, step):
+        user_id = f"user_{i}"
+        storage.put(user_id, make_record(i))
+        storage.append_history(user_id, {"timestamp": "2025-04-23 12:00:00", "word_count": i % 50,
+                                         "sentiment": "positive"})
+        await storage.sync()
+
+def open_storage(directory, args):
+    return DurableStorage(directory, fsync=not args.no_fsync, group_commit_ms=args.group_commit_ms,
+                          snapshot_interval=float("inf"), snapshot_wal_records=10**12)
+
+async def main():
+    args = parse_args()
+    directory = args.dir or tempfile.mkdtemp(prefix="storage_bench_")
+    try:
+        storage = open_storage(directory, args)
+        await storage.open()
+        start = time.perf_counter()
+        await asyncio.gather(*[writer(storage, w, args.records, args.writers) for w in range(args.writers)])
+        elapsed = time.perf_counter() - start
+        await storage.close(snapshot=False)
+        print(f"records={args.records} writers={args.writers} fsync={not args.no_fsync} "
+              f"group_commit_ms={args.group_commit_ms}")
+        print(f"write: {elapsed:.2f}s, {args.records / elapsed:,.0f} records/s (record + history append each)")
+
+        storage = open_storage(directory, args)
+        await storage.open()
+        print(f"recovery from WAL: {storage.recovery_stats['seconds']:.2f}s, "
+              f"{storage.recovery_stats['wal_records_replayed']:,} WAL records replayed")
+        start = time.perf_counter()
+        await storage.snapshot()
+        print(f"snapshot: {time.perf_counter() - start:.2f}s")
+        await storage.close(snapshot=False)
+
+        storage = open_storage(directory, args)
+        await storage.open()
+        print(f"recovery from snapshot: {storage.recovery_stats['seconds']:.2f}s, "
+              f"{storage.recovery_stats['snapshot_records']:,} records loaded")
+        assert storage.count() == args.records
+        await storage.close(snapshot=False)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    asyncio.run(main())
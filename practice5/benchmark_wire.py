@@ -0,0 +1,82 @@
+import argparse
+import json
+import random
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+import wire
+from business_service import ProcessPayload
+from database_service import WritePayload
+
+SENTIMENTS = ("positive", "negative", "neutral")
+BASE_TIME = 1745400000
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Encode, decode and validation cost of the internal wire formats")
+    parser.add_argument("--history", type=int, default=10000, help="History entries in the large payload")
+    parser.add_argument("--repeat", type=int, default=50, help="Runs per measurement (median is reported)")
+    return parser.parse_args()
+
+def history(count, rng):
+    return [{"timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(BASE_TIME + i * rng.randrange(1, 600))),
+             "word_count": rng.randrange(200), "sentiment": rng.choice(SENTIMENTS)} for i in range(count)]
+
+def payloads(args, rng):
+    """(name, model, value): a typical /write body, and a legacy /process body carrying a long history"""
+    entry = history(1, rng)[0]
+    write = {
+        "user_id": "user_42",
+        "data": {"analysis": {"word_count": 17, "character_count": 96, "sentiment": "positive",
+                              "processing_id": "proc_4821"}},
+        "history_entry": entry,
+        "expected_version": 7
+    }
+    process = {
+        "content": "This is a great sample text that we want to process. I like this architecture!",
+        "existing_data": {"analysis": write["data"]["analysis"], "process_history": history(args.history, rng)}
+    }
+    return [("small /write", WritePayload, write), (f"{args.history:,}-entry history", ProcessPayload, process)]
+
+def fastapi_json(value):
+    """What returning a dict from an endpoint costs: jsonable_encoder, then JSONResponse's json.dumps"""
+    return json.dumps(jsonable_encoder(value), ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode()
+
+def codecs():
+    """(name, encode, decode) for each format, with and without gzip"""
+    formats = [("json, stdlib + jsonable_encoder", fastapi_json, json.loads)]
+    if wire.orjson is not None:
+        formats.append(("json, orjson", wire.json_dumps, wire.json_loads))
+    if wire.msgpack is not None:
+        formats.append(("msgpack", wire.msgpack.packb, wire.msgpack.unpackb))
+    for name, encode, decode in list(formats):
+        formats.append((name + " + gzip", lambda value, encode=encode: wire.compress(encode(value)),
+                        lambda body, decode=decode: decode(wire.decompress(body))))
+    return formats
+
+def timed(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2] * 1000, result
+
+def main():
+    args = parse_args()
+    rng = random.Random(1)
+    print(f"{'payload':<22} {'format':<36} {'bytes':>10} {'encode ms':>10} {'decode ms':>10} {'validate ms':>12} "
+          f"{'total ms':>9}")
+    for payload_name, model, value in payloads(args, rng):
+        for name, encode, decode in codecs():
+            encode_ms, body = timed(lambda: encode(value), args.repeat)
+            decode_ms, decoded = timed(lambda: decode(body), args.repeat)
+            validate_ms, _ = timed(lambda: model.model_validate(decoded), args.repeat)
+            total = encode_ms + decode_ms + validate_ms
+            print(f"{payload_name:<22} {name:<36} {len(body):>10,} {encode_ms:>10.3f} {decode_ms:>10.3f} "
+                  f"{validate_ms:>12.3f} {total:>9.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,67 @@
 from fastapi import Depends, FastAPI, HTTPException, Header
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import List
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
 import time
 import random
 import os
 
-app = FastAPI(title="Business Logic Service",
-              description="Handles data processing and transformation")
+from sentiment import ANALYZER_VERSION, analyze, analyze_many, lexicon
+from analysis_cache import cache_key, create_cache
+from metrics import instrument
+from profiling import enable_profiling
+from tracing import enable_tracing, span
+from wire import WireResponse, WireRoute
 
 INTERNAL_SERVICE_TOKEN = os.getenv("INTERNAL_SERVICE_TOKEN", "YourInternalToken")
+# Simulated processing time in seconds; 0 disables the delay entirely
+PROCESSING_DELAY = float(os.getenv("PROCESSING_DELAY", "2"))
+# "thread" or "process" - where the word count/sentiment analysis runs
+ANALYSIS_EXECUTOR = os.getenv("ANALYSIS_EXECUTOR", "thread")
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "4"))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "5000"))
+
+executor = None
+# Results are keyed by content and analyzer version, so a lexicon change never serves stale results
+analysis_cache = create_cache()
+ANALYSIS_CACHE_VERSION = f"{ANALYZER_VERSION}:{lexicon.fingerprint}"
+
+def get_executor():
+    global executor
+    if executor is None:
+        if ANALYSIS_EXECUTOR == "process":
+            executor = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS)
+        else:
+            executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS)
+    return executor
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_executor()
+    yield
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=True)
+        executor = None
+
+app = FastAPI(title="Business Logic Service",
+              description="Handles data processing and transformation",
+              lifespan=lifespan)
+# Internal callers may send and accept msgpack or gzip bodies
+app.router.route_class = WireRoute
+instrument(app, "business")
+enable_tracing(app, "business")
+enable_profiling(app, "business")
+
 class ProcessPayload(BaseModel):
     content: str
     existing_data: dict = {}
 
+class BatchProcessPayload(BaseModel):
+    items: List[ProcessPayload] = Field(..., max_length=MAX_BATCH_SIZE)
+
 def validate_internal_token(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid authorization header")
@@ -22,57 +72,134 @@ def validate_internal_token(authorization: str = Header(None)):
     
     return token
 
+def analyze_batch(contents: List[str]):
+    """Analyze a chunk of documents in one executor task, reporting errors per item"""
+    try:
+        return analyze_many(contents)
+    except Exception:
+        pass
+    results = []
+    for content in contents:
+        try:
+            results.append(analyze(content))
+        except Exception as e:
+            results.append({"error": str(e)})
+    return results
+
+async def cached_analysis(key: str):
+    """Look a result up in the memory tier, then in the optional disk tier"""
+    if analysis_cache is None:
+        return None
+    analysis = analysis_cache.get(key)
+    if analysis is None and analysis_cache.directory:
+        loop = asyncio.get_running_loop()
+        found = await loop.run_in_executor(None, analysis_cache.disk_get, key)
+        if found is not None:
+            analysis, stored_at = found
+            analysis_cache.promote(key, analysis, stored_at)
+    return analysis
+
+async def store_analysis(key: str, analysis: dict):
+    if analysis_cache is None:
+        return
+    analysis_cache.put(key, analysis)
+    if analysis_cache.directory:
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, analysis_cache.disk_put, key, analysis)
+        except OSError as e:
+            print(f"Failed to write analysis cache entry: {e}")
+
+def build_result(analysis: dict, existing_data: dict):
+    # History is owned by the Database Service; only legacy callers still send it in existing_data
+    previous_processes = existing_data.get("process_history", [])
+    
+    return {
+        "analysis": {
+            "word_count": analysis["word_count"],
+            "character_count": analysis["character_count"],
+            "sentiment": analysis["sentiment"],
+            "processing_id": f"proc_{random.randint(1000, 9999)}"
+        },
+        "process_history": previous_processes + [{
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "word_count": analysis["word_count"],
+            "sentiment": analysis["sentiment"]
+        }]
+    }
+
 @app.get("/")
 async def root():
     return {
         "service": "Business Logic Service",
         "description": "Performs data processing and transformations",
-        "endpoints": ["/process", "/health"]
+        "endpoints": ["/process", "/process_batch", "/health", "/cache_stats", "/metrics"]
     }
 
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
+@app.get("/cache_stats")
+async def cache_stats():
+    if analysis_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, "analyzer_version": ANALYSIS_CACHE_VERSION, **analysis_cache.stats()}
+
 @app.post("/process")
 async def process_data(payload: ProcessPayload, token: str = Depends(validate_internal_token)):
-    time.sleep(2)
-    
-    # Generate a simple transformation of the input data
-    word_count = len(payload.content.split())
-    char_count = len(payload.content)
-    
-    # Access history from existing data if available
-    previous_processes = payload.existing_data.get("process_history", [])
+    key = cache_key(payload.content, ANALYSIS_CACHE_VERSION)
+    with span("cache_lookup"):
+        analysis = await cached_analysis(key)
+    if analysis is None:
+        # Simulated work must not block the event loop, so other requests keep being served
+        if PROCESSING_DELAY > 0:
+            with span("simulated_delay"):
+                await asyncio.sleep(PROCESSING_DELAY)
+        
+        loop = asyncio.get_running_loop()
+        with span("analysis"):
+            analysis = await loop.run_in_executor(get_executor(), analyze, payload.content)
+        await store_analysis(key, analysis)
     
-    # Analyze sentiment
-    positive_words = ["good", "great", "excellent", "happy", "positive", "nice", "love", "like"]
-    negative_words = ["bad", "terrible", "awful", "sad", "negative", "hate", "dislike"]
+    # A cache hit still gets a fresh processing_id and history entry
+    return WireResponse(build_result(analysis, payload.existing_data))
+
+@app.post("/process_batch")
+async def process_batch(payload: BatchProcessPayload, token: str = Depends(validate_internal_token)):
+    """
+    Process many documents in one call. Cached results are reused; for the rest
+    the simulated delay is paid once per batch and the analysis is split into
+    one chunk per worker, so at most ANALYSIS_WORKERS chunks run at a time.
+    Failures are reported per item.
+    """
+    keys = [cache_key(item.content, ANALYSIS_CACHE_VERSION) for item in payload.items]
+    analyses = [await cached_analysis(key) for key in keys]
+    missing = [index for index, analysis in enumerate(analyses) if analysis is None]
     
-    words = payload.content.lower().split()
-    positive_count = sum(1 for word in words if word in positive_words)
-    negative_count = sum(1 for word in words if word in negative_words)
+    if missing:
+        if PROCESSING_DELAY > 0:
+            await asyncio.sleep(PROCESSING_DELAY)
+        
+        contents = [payload.items[index].content for index in missing]
+        chunk_size = max(1, -(-len(contents) // ANALYSIS_WORKERS))
+        loop = asyncio.get_running_loop()
+        chunks = await asyncio.gather(*[
+            loop.run_in_executor(get_executor(), analyze_batch, contents[start:start + chunk_size])
+            for start in range(0, len(contents), chunk_size)
+        ])
+        for index, analysis in zip(missing, [analysis for chunk in chunks for analysis in chunk]):
+            analyses[index] = analysis
+            if "error" not in analysis:
+                await store_analysis(keys[index], analysis)
     
-    if positive_count > negative_count:
-        sentiment = "positive"
-    elif negative_count > positive_count:
-        sentiment = "negative"
-    else:
-        sentiment = "neutral"
-    result = {
-        "analysis": {
-            "word_count": word_count,
-            "character_count": char_count,
-            "sentiment": sentiment,
-            "processing_id": f"proc_{random.randint(1000, 9999)}"
-        },
-        "process_history": previous_processes + [{
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "word_count": word_count,
-            "sentiment": sentiment
-        }]
-    }
-    return result
+    results = []
+    for item, analysis in zip(payload.items, analyses):
+        if "error" in analysis:
+            results.append({"status": "error", "error": analysis["error"]})
+        else:
+            results.append({"status": "success", **build_result(analysis, item.existing_data)})
+    return WireResponse({"results": results})
 
 if __name__ == "__main__":
     import uvicorn
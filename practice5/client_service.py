@@ -1,20 +1,315 @@
-from fastapi import FastAPI, Header, HTTPException, Depends
+from fastapi import FastAPI, Header, HTTPException, Depends, Query
+from fastapi.responses import JSONResponse
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import List
+import asyncio
 import httpx
 import os
-from pydantic import BaseModel
+import random
+import secrets
+from pydantic import BaseModel, Field
+
+from metrics import MeasuredTransport, instrument, registry
+from tracing import TracingTransport, enable_tracing
+from admission import AdmissionControl, ConcurrencyLimiter, RateLimiter, Rejected
+from idempotency import IdempotencyStore, KeyReused, fingerprint
+from job_queue import JobQueue, QueueFull
+from local_transport import MODES, connect
+from load_balancer import BalancingTransport
+from profiling import enable_profiling
+from resilience import (CircuitBreaker, CircuitOpen, DownstreamError, ResilientTransport, RetryBudget,
+                        downstream_error)
+from sharding import ShardingTransport
+from wire import ACCEPT, Codec
 
 BUSINESS_SERVICE_URL = os.getenv("BUSINESS_SERVICE_URL", "http://localhost:8001")
-DATABASE_SERVICE_URL = os.getenv("DATABASE_SERVICE_URL", "http://localhost:8002")
+# Comma-separated Business Logic Service replicas; defaults to the single BUSINESS_SERVICE_URL
+BUSINESS_SERVICE_URLS = [url.strip() for url in os.getenv("BUSINESS_SERVICE_URLS", BUSINESS_SERVICE_URL).split(",")
+                         if url.strip()]
+# Comma-separated Database Service shards; users are spread over them by consistent hashing of user_id
+DATABASE_SERVICE_URLS = [url.strip() for url in os.getenv("DATABASE_SERVICE_URL", "http://localhost:8002").split(",")
+                         if url.strip()]
+DATABASE_VNODES = int(os.getenv("DATABASE_VNODES", "128"))
+# While a shard is added, writes to moving users are held only once this few are left to copy again
+REBALANCE_PAUSE_KEYS = int(os.getenv("REBALANCE_PAUSE_KEYS", "1000"))
 APP_TOKEN = os.getenv("APP_TOKEN", "YourSuperSecretToken")
 INTERNAL_SERVICE_TOKEN = os.getenv("INTERNAL_SERVICE_TOKEN", "YourInternalToken")
+# Bearer token for the operator endpoints (/admission and POST /shards), separate from APP_TOKEN so API
+# clients cannot change their own limits or point the gateway at a URL of their choice; they answer 403
+# while it is not set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+if ADMIN_TOKEN and ADMIN_TOKEN == APP_TOKEN:
+    print("WARNING: ADMIN_TOKEN is the same as APP_TOKEN, /admission and POST /shards stay off")
+    ADMIN_TOKEN = ""
+
+# Connection pool settings shared by the long-lived downstream clients
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+# Per-hop timeouts in seconds
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "2"))
+DATABASE_TIMEOUT = float(os.getenv("DATABASE_TIMEOUT", "5"))
+BUSINESS_TIMEOUT = float(os.getenv("BUSINESS_TIMEOUT", "30"))
+
+# Load balancing across the business replicas: p2c (power of two choices) or least_outstanding
+BUSINESS_LB_STRATEGY = os.getenv("BUSINESS_LB_STRATEGY", "p2c")
+BUSINESS_HEALTH_INTERVAL = float(os.getenv("BUSINESS_HEALTH_INTERVAL", "5"))
+BUSINESS_EJECT_FAILURES = int(os.getenv("BUSINESS_EJECT_FAILURES", "5"))
+BUSINESS_EJECT_SECONDS = float(os.getenv("BUSINESS_EJECT_SECONDS", "30"))
+# Re-resolve the replica host names on every health probe (compose replicas share one name)
+BUSINESS_DNS_DISCOVERY = os.getenv("BUSINESS_DNS_DISCOVERY", "false").lower() == "true"
+
+# How the Business Logic and Database services are called: "http" over the network, or "asgi" / "direct"
+# to run them inside this process (see colocated.py); asgi goes through their whole ASGI app including
+# middleware, direct dispatches straight to their routes
+DOWNSTREAM_TRANSPORT = os.getenv("DOWNSTREAM_TRANSPORT", "http").lower()
+if DOWNSTREAM_TRANSPORT != "http":
+    if DOWNSTREAM_TRANSPORT not in MODES:
+        raise ValueError(f"Unknown DOWNSTREAM_TRANSPORT {DOWNSTREAM_TRANSPORT}, expected http or one of {MODES}")
+    # One instance of each runs in this process; these URLs only name them
+    BUSINESS_SERVICE_URLS = ["http://business-service"]
+    DATABASE_SERVICE_URLS = ["http://database-service"]
+    BUSINESS_DNS_DISCOVERY = False
+
+# Per-downstream circuit breakers: open after this many consecutive failures, half-open after the timeout
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "10"))
+# Idempotent reads (GET) are retried, but retries may add at most RETRY_BUDGET_RATIO extra load
+READ_RETRIES = int(os.getenv("READ_RETRIES", "2"))
+READ_RETRY_BACKOFF = float(os.getenv("READ_RETRY_BACKOFF", "0.05"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "5"))
+# Hedge business /process calls that are slower than this percentile of recent calls
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+
+# Compare-and-set writes that hit a version conflict are retried with jittered exponential backoff
+WRITE_CONFLICT_RETRIES = int(os.getenv("WRITE_CONFLICT_RETRIES", "10"))
+WRITE_CONFLICT_BACKOFF = float(os.getenv("WRITE_CONFLICT_BACKOFF", "0.01"))
+WRITE_CONFLICT_MAX_BACKOFF = float(os.getenv("WRITE_CONFLICT_MAX_BACKOFF", "0.5"))
+
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "5000"))
+# Number of /process_batch calls allowed to run against the downstream services at once
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+batch_semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+# Async /process jobs: bounded queue, worker pool and how long results are kept
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "1000"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "16"))
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "300"))
+JOB_MAX_RESULTS = int(os.getenv("JOB_MAX_RESULTS", "10000"))
+JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", "30"))
+job_queue = JobQueue(maxsize=JOB_QUEUE_SIZE, workers=JOB_WORKERS, result_ttl=JOB_RESULT_TTL,
+                     max_results=JOB_MAX_RESULTS)
+
+# Admission control for /process: token buckets per API token and per user_id (rate 0 disables them),
+# and at most ADMISSION_MAX_CONCURRENCY synchronous requests in progress (0 disables it). Up to
+# ADMISSION_MAX_QUEUE more wait, and requests that would wait longer than ADMISSION_QUEUE_TARGET
+# seconds are answered 503 with Retry-After right away. Changeable at runtime with PUT /admission.
+# All clients share APP_TOKEN, so the per-token bucket limits the gateway as a whole.
+ADMISSION_TOKEN_RATE = float(os.getenv("ADMISSION_TOKEN_RATE", "0"))
+ADMISSION_TOKEN_BURST = float(os.getenv("ADMISSION_TOKEN_BURST", "100"))
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "0"))
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "10"))
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "100"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "500"))
+ADMISSION_QUEUE_TARGET = float(os.getenv("ADMISSION_QUEUE_TARGET", "5"))
+admission = AdmissionControl(
+    RateLimiter(ADMISSION_TOKEN_RATE, ADMISSION_TOKEN_BURST),
+    RateLimiter(ADMISSION_USER_RATE, ADMISSION_USER_BURST),
+    ConcurrencyLimiter(ADMISSION_MAX_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TARGET)
+)
+ADMISSION_REJECTED = registry.counter("client_admission_rejected_total", "Requests rejected by admission control",
+                                      ("reason",))
+
+# /process results kept for retries that send the same Idempotency-Key
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+idempotency = IdempotencyStore(max_entries=IDEMPOTENCY_MAX_ENTRIES, ttl=IDEMPOTENCY_TTL)
+
+# One shared client per downstream service, created in the lifespan
+http_clients = {}
+business_balancer = None
+database_sharding = None
+rebalance_task = None
+# Resilience state (circuit breaker, retry budget, hedging) per downstream service
+guards = {}
+# Negotiated request and response body formats per downstream service
+codecs = {}
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def create_transport():
+    http2 = HTTP2_ENABLED and http2_available()
+    if HTTP2_ENABLED and not http2:
+        print("WARNING: HTTP2_ENABLED is set but the 'h2' package is not installed, using HTTP/1.1")
+    return httpx.AsyncHTTPTransport(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+    )
+
+def guard(name: str, transport: httpx.AsyncBaseTransport, hedge_paths=()):
+    """Wrap a transport with metrics and a ResilientTransport registered as guards[name]"""
+    guards[name] = ResilientTransport(
+        MeasuredTransport(transport, "client", name),
+        CircuitBreaker(name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT),
+        RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND),
+        retries=READ_RETRIES, retry_backoff=READ_RETRY_BACKOFF,
+        hedge_paths=hedge_paths, hedge_percentile=HEDGE_PERCENTILE
+    )
+    return guards[name]
+
+def create_http_client(name: str, base_url: str, timeout: float, transport: httpx.AsyncBaseTransport = None,
+                       hedge_paths=(), guarded: bool = True):
+    """
+    Build the long-lived client for one downstream service. Every hop goes
+    through MeasuredTransport so its latency shows up in /metrics, and through
+    TracingTransport so the request ID is propagated and the hop is timed.
+    ResilientTransport sits between them, so each retry or hedge is measured
+    as its own attempt while the trace shows the call as a whole. A transport
+    that guards its own endpoints (the database shards) is passed with guarded=False.
+    Bodies are exchanged through codecs[name], which negotiates msgpack and
+    gzip with the service.
+    """
+    if transport is None:
+        transport = create_transport()
+    if guarded:
+        transport = guard(name, transport, hedge_paths)
+    in_process = DOWNSTREAM_TRANSPORT != "http"
+    codecs[name] = Codec(compression=not in_process)
+    headers = {"Authorization": f"Bearer {INTERNAL_SERVICE_TOKEN}", "Accept": ACCEPT}
+    if in_process:
+        # Nothing crosses a network, so gzip would only cost CPU on both sides
+        headers["Accept-Encoding"] = "identity"
+    return httpx.AsyncClient(
+        base_url=base_url,
+        timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT),
+        headers=headers,
+        transport=TracingTransport(transport, name)
+    )
+
+def shard_name(url: str):
+    """Circuit breaker and metrics name of a database shard; plain "database" without sharding"""
+    if [url] == DATABASE_SERVICE_URLS:
+        return "database"
+    return f"database@{httpx.URL(url).netloc.decode('ascii')}"
+
+def shard_keys(*user_ids: str):
+    """Request extensions that route a database call to the shard owning these users"""
+    return {"shard_keys": list(user_ids)}
+
+def pool_stats(name: str, client: httpx.AsyncClient):
+    """
+    Report the state of the client's connection pool.
+    httpx does not expose pool counters publicly, so this reads httpcore's pool.
+    """
+    transport = client._transport
+    while hasattr(transport, "transport") or isinstance(transport, ShardingTransport):
+        # The shards share one connection pool
+        transport = (next(iter(transport.shards.values())) if isinstance(transport, ShardingTransport)
+                     else transport.transport)
+    connections = getattr(getattr(transport, "_pool", None), "connections", [])
+    idle = sum(1 for connection in connections if connection.is_idle())
+    http2 = sum(1 for connection in connections if "HTTP/2" in connection.info())
+    return {
+        "base_url": str(client.base_url),
+        "connections": len(connections),
+        "active": len(connections) - idle,
+        "idle": idle,
+        "http2_connections": http2,
+        "max_connections": HTTP_MAX_CONNECTIONS,
+        "max_keepalive_connections": HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        "keepalive_expiry": HTTP_KEEPALIVE_EXPIRY,
+        "timeout": client.timeout.read,
+        "wire": codecs[name].stats()
+    }
+
+async def start_colocated(stack: AsyncExitStack):
+    """
+    Start the Database and Business Logic services inside this process and
+    return the transports that reach them. They are imported here so the
+    networked gateway never loads them.
+    """
+    import business_service
+    import database_service
+
+    transports = []
+    for service in (database_service, business_service):
+        await stack.enter_async_context(service.app.router.lifespan_context(service.app))
+        transports.append(connect(service.app, DOWNSTREAM_TRANSPORT))
+    print(f"Database and Business Logic services run in this process ({DOWNSTREAM_TRANSPORT} transport)")
+    return transports
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global business_balancer, database_sharding
+    colocated = AsyncExitStack()
+    if DOWNSTREAM_TRANSPORT == "http":
+        database_transport, business_transport = create_transport(), create_transport()
+    else:
+        database_transport, business_transport = await start_colocated(colocated)
+    business_balancer = BalancingTransport(
+        business_transport, BUSINESS_SERVICE_URLS, strategy=BUSINESS_LB_STRATEGY,
+        health_interval=BUSINESS_HEALTH_INTERVAL, eject_failures=BUSINESS_EJECT_FAILURES,
+        eject_seconds=BUSINESS_EJECT_SECONDS, discover=BUSINESS_DNS_DISCOVERY
+    )
+    business_balancer.start()
+    # Hedging only pays off when the second attempt can land on another replica
+    replicated = len(BUSINESS_SERVICE_URLS) > 1 or BUSINESS_DNS_DISCOVERY
+    http_clients["business"] = create_http_client("business", BUSINESS_SERVICE_URLS[0], BUSINESS_TIMEOUT,
+                                                  transport=business_balancer,
+                                                  hedge_paths=("/process",) if HEDGE_ENABLED and replicated else ())
+    database_sharding = ShardingTransport(DATABASE_SERVICE_URLS, lambda url: guard(shard_name(url), database_transport),
+                                          vnodes=DATABASE_VNODES, pause_keys=REBALANCE_PAUSE_KEYS)
+    http_clients["database"] = create_http_client("database", DATABASE_SERVICE_URLS[0], DATABASE_TIMEOUT,
+                                                  transport=database_sharding, guarded=False)
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    if rebalance_task is not None:
+        rebalance_task.cancel()
+        await asyncio.gather(rebalance_task, return_exceptions=True)
+    for client in http_clients.values():
+        await client.aclose()
+    http_clients.clear()
+    await colocated.aclose()
 
 app = FastAPI(title="Client Service", 
-              description="The API gateway for our microservice application")
+              description="The API gateway for our microservice application",
+              lifespan=lifespan)
+instrument(app, "client")
+enable_tracing(app, "client", server_timing=True)
+enable_profiling(app, "client")
+
+@app.exception_handler(Rejected)
+async def rejected(request, exc: Rejected):
+    ADMISSION_REJECTED.inc(exc.reason)
+    return JSONResponse(status_code=exc.status_code, content={"error": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+@app.exception_handler(DownstreamError)
+async def downstream_failed(request, exc: DownstreamError):
+    headers = {"Retry-After": str(exc.retry_after)} if exc.retry_after is not None else {}
+    return JSONResponse(status_code=exc.status_code, content={"error": str(exc)}, headers=headers)
 
 class DataPayload(BaseModel):
     content: str
     user_id: str
 
+class BatchDataPayload(BaseModel):
+    items: List[DataPayload] = Field(..., max_length=MAX_BATCH_SIZE)
+
 def validate_token(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid authorization header")
@@ -25,12 +320,18 @@ def validate_token(authorization: str = Header(None)):
     
     return token
 
+def validate_admin_token(authorization: str = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are off, set ADMIN_TOKEN to use them")
+    if not authorization or not secrets.compare_digest(authorization, f"Bearer {ADMIN_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
 @app.get("/")
 async def root():
     return {
         "service": "Client Service",
         "description": "Entry point for the microservice application. This service orchestrates calls to the Business Logic and Database services.",
-        "endpoints": ["/process", "/health"]
+        "endpoints": ["/process", "/process_batch", "/jobs/{job_id}", "/history", "/health", "/pool_stats", "/balancer_stats", "/job_stats", "/idempotency_stats", "/admission", "/shards", "/metrics"]
     }
 
 @app.get("/health")
@@ -39,93 +340,332 @@ async def health():
     business_status = "unknown"
     db_status = "unknown"
     
-    async with httpx.AsyncClient() as client:
+    try:
+        business_response = await http_clients["business"].get("/health")
+        if business_response.status_code == 200:
+            business_status = business_response.json().get("status", "error")
+    except CircuitOpen:
+        business_status = "circuit_open"
+    except Exception:
+        business_status = "error"
+        
+    shard_status = {}
+    for url in database_sharding.shards:
         try:
-            business_response = await client.get(f"{BUSINESS_SERVICE_URL}/health")
-            if business_response.status_code == 200:
-                business_status = business_response.json().get("status", "error")
+            db_response = await http_clients["database"].get("/health", extensions={"shard": url})
+            shard_status[url] = db_response.json().get("status", "error") if db_response.status_code == 200 else "error"
+        except CircuitOpen:
+            shard_status[url] = "circuit_open"
         except Exception:
-            business_status = "error"
-            
-        try:
-            db_response = await client.get(f"{DATABASE_SERVICE_URL}/health")
-            if db_response.status_code == 200:
-                db_status = db_response.json().get("status", "error")
-        except Exception:
-            db_status = "error"
+            shard_status[url] = "error"
+    # The database is only ok when every shard is
+    db_status = next((status for status in shard_status.values() if status != "ok"), "ok")
     
-    return {
+    health = {
         "status": client_status,
         "dependencies": {
             "business_service": business_status,
             "database_service": db_status
-        }
+        },
+        "circuit_breakers": {name: guard.stats() for name, guard in guards.items()},
+        # Per-token and per-user detail is only shown at the admin-only GET /admission
+        "admission": admission.summary()
     }
+    if len(shard_status) > 1:
+        health["database_shards"] = shard_status
+    return health
 
-@app.post("/process")
-async def process_data(data: DataPayload, token: str = Depends(validate_token)):
+@app.get("/pool_stats")
+async def get_pool_stats(token: str = Depends(validate_token)):
+    return {name: pool_stats(name, client) for name, client in http_clients.items()}
+
+@app.get("/balancer_stats")
+async def get_balancer_stats(token: str = Depends(validate_token)):
+    """Per-replica load, health and latency of the Business Logic Service endpoints"""
+    return business_balancer.stats()
+
+class ShardPayload(BaseModel):
+    url: str
+
+@app.get("/shards")
+async def get_shards(token: str = Depends(validate_token)):
+    """Database shards, the share of users each owns, and the state of the last rebalance"""
+    return database_sharding.stats()
+
+async def rebalance(url: str):
+    try:
+        await database_sharding.add_shard(http_clients["database"], url)
+    except Exception as e:
+        if url not in database_sharding.shards:
+            # The shard's circuit breaker would otherwise stay in /health
+            guards.pop(shard_name(url), None)
+        print(f"Adding database shard {url} failed: {str(e)}")
+
+@app.post("/shards", dependencies=[Depends(validate_admin_token)])
+async def add_shard(payload: ShardPayload):
+    """
+    Add a Database Service shard and move the users it takes over to it in the
+    background; follow the progress at GET /shards
+    """
+    global rebalance_task
+    if DOWNSTREAM_TRANSPORT != "http":
+        raise HTTPException(status_code=409, detail="Shards cannot be added while the database runs in this process")
+    if rebalance_task is not None and not rebalance_task.done():
+        raise HTTPException(status_code=409, detail="A rebalance is already running")
+    if payload.url in database_sharding.shards:
+        raise HTTPException(status_code=409, detail=f"{payload.url} is already a shard")
+    rebalance_task = asyncio.create_task(rebalance(payload.url))
+    await asyncio.sleep(0)
+    return JSONResponse(status_code=202, content=database_sharding.stats(), headers={"Location": "/shards"})
+
+@app.get("/history")
+async def read_history(user_id: str, offset: int = 0, limit: int = 50, token: str = Depends(validate_token)):
+    """
+    Page through a user's process history stored in the Database Service
+    """
+    try:
+        db_response = await http_clients["database"].get(
+            "/history",
+            params={"user_id": user_id, "offset": offset, "limit": limit},
+            extensions=shard_keys(user_id)
+        )
+    except Exception as e:
+        raise downstream_error("Failed to connect to database service", e)
+    if db_response.status_code != 200:
+        raise downstream_error("Database history read failed", response=db_response)
+    return codecs["database"].decode(db_response)
+
+async def run_process(data: DataPayload):
     """
     Process data through the orchestrated flow:
-    1. Read data from the Database Service
-    2. Process it with the Business Logic Service
-    3. Store the result in the Database Service
-    4. Return the final response
+    1. Process the new content with the Business Logic Service while reading
+       the user's current record version from the Database Service
+    2. Store the analysis and append the new history entry in the Database Service,
+       as a compare-and-set against that version, retrying on conflicts
+    3. Return the final response
+    The user's history stays in the Database Service, so the cost does not grow with it.
+    A failed step raises DownstreamError, answered with 503, 504, 502 or, when the
+    write kept conflicting, 409.
     """
-    async with httpx.AsyncClient() as client:
+    database_client = http_clients["database"]
+    business_client = http_clients["business"]
+    database_codec = codecs["database"]
+    business_codec = codecs["business"]
+    business_response, db_response = await asyncio.gather(
+        business_client.post("/process", **business_codec.encode({"content": data.content})),
+        database_client.get("/read", params={"user_id": data.user_id}, extensions=shard_keys(data.user_id)),
+        return_exceptions=True
+    )
+    if isinstance(db_response, Exception):
+        raise downstream_error("Failed to connect to database service", db_response)
+    if db_response.status_code != 200:
+        raise downstream_error("Database read failed", response=db_response)
+    expected_version = database_codec.decode(db_response)["data"].get("metadata", {}).get("version", 0)
+    
+    if isinstance(business_response, Exception):
+        raise downstream_error("Failed to connect to business logic service", business_response)
+    if business_response.status_code != 200:
+        raise downstream_error("Business logic processing failed", response=business_response)
+    processed_result = business_codec.decode(business_response)
+    
+    save_payload = {
+        "user_id": data.user_id,
+        "data": {"analysis": processed_result["analysis"]},
+        "history_entry": processed_result["process_history"][-1]
+    }
+    for attempt in range(WRITE_CONFLICT_RETRIES + 1):
+        save_payload["expected_version"] = expected_version
         try:
-            db_response = await client.get(
-                f"{DATABASE_SERVICE_URL}/read",
-                params={"user_id": data.user_id},
-                headers={"Authorization": f"Bearer {INTERNAL_SERVICE_TOKEN}"}
-            )
-            if db_response.status_code != 200:
-                return {"error": f"Database read failed: {db_response.text}"}
-            
-            existing_data = db_response.json()
+            save_response = await database_client.post("/write", **database_codec.encode(save_payload),
+                                                       extensions=shard_keys(data.user_id))
         except Exception as e:
-            return {"error": f"Failed to connect to database service: {str(e)}"}
+            raise downstream_error("Failed to store result in database", e)
+        if save_response.status_code != 409 or attempt == WRITE_CONFLICT_RETRIES:
+            break
+        # Another request for this user won the race; retry against the version it wrote
+        expected_version = database_codec.decode(save_response)["detail"]["current_version"]
+        backoff = min(WRITE_CONFLICT_MAX_BACKOFF, WRITE_CONFLICT_BACKOFF * 2 ** attempt)
+        await asyncio.sleep(random.uniform(0, backoff))
+    if save_response.status_code == 409:
+        raise DownstreamError(409, f"Database write conflict after {WRITE_CONFLICT_RETRIES} retries: "
+                                   f"{save_response.text}")
+    if save_response.status_code != 200:
+        raise downstream_error("Database write failed", response=save_response)
+    
+    final_result = database_codec.decode(save_response)
+    return {
+        "message": "Data processed successfully",
+        "user_id": data.user_id,
+        "original_content": data.content,
+        "processed_result": processed_result,
+        "storage_status": final_result
+    }
+
+async def start_process(data: DataPayload, asynchronous: bool):
+    """(status code, body) of a /process call: the result, or the queued job"""
+    if not asynchronous:
+        async with admission.concurrency.slot():
+            return 200, await run_process(data)
+    try:
+        job = job_queue.submit(run_process, data)
+    except QueueFull as e:
+        return 503, {"error": str(e)}
+    return 202, {"job_id": job.id, "status": job.status, "status_url": f"/jobs/{job.id}"}
+
+def reusable(result):
+    """Only results worth replaying are kept; a retry after an error or a full queue runs again"""
+    status_code, body = result
+    return status_code != 503 and "error" not in body
+
+@app.post("/process")
+async def process_data(data: DataPayload, mode: str = "sync", prefer: str = Header(None),
+                       idempotency_key: str = Header(None), token: str = Depends(validate_token)):
+    """
+    Process data synchronously, or with mode=async (or "Prefer: respond-async")
+    queue it and answer 202 with a job ID to poll at /jobs/{job_id}.
+    With an Idempotency-Key header, a retry of the same request gets the first
+    result back (marked Idempotent-Replayed) instead of processing it again.
+    Requests over a rate limit get 429, and synchronous ones that would wait
+    too long for capacity get 503, both with Retry-After.
+    """
+    asynchronous = mode == "async" or bool(prefer and "respond-async" in prefer)
+    # Replays cost nothing, so only new work is held to the rate limits
+    admit = lambda: admission.check(token, data.user_id)
+    replayed = False
+    if idempotency_key is None:
+        admit()
+        status_code, body = await start_process(data, asynchronous)
+    else:
+        if not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise HTTPException(status_code=400,
+                                detail=f"Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters")
         try:
-            payload = {
-                "content": data.content,
-                "existing_data": existing_data.get("data", {})
-            }
-            headers = {
-                "Authorization": f"Bearer {INTERNAL_SERVICE_TOKEN}"
-            }
-            business_response = await client.post(
-                f"{BUSINESS_SERVICE_URL}/process",
-                json=payload,
-                headers=headers
+            (status_code, body), replayed = await idempotency.run(
+                (token, "/process", idempotency_key), fingerprint(data.content, data.user_id, asynchronous),
+                lambda: start_process(data, asynchronous), keep=reusable, admit=admit
             )
-            if business_response.status_code != 200:
-                return {"error": f"Business logic processing failed: {business_response.text}"}
-            
-            processed_result = business_response.json()
-        except Exception as e:
-            return {"error": f"Failed to connect to business logic service: {str(e)}"}
+        except KeyReused as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    headers = {}
+    if status_code == 202:
+        headers["Location"] = body["status_url"]
+    elif status_code == 503:
+        headers["Retry-After"] = "1"
+    if replayed:
+        headers["Idempotent-Replayed"] = "true"
+    return JSONResponse(status_code=status_code, content=body, headers=headers)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = Query(0, ge=0, le=JOB_MAX_WAIT), token: str = Depends(validate_token)):
+    """
+    Return an async job's status and result; wait > 0 long-polls until it finishes
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    await job_queue.wait(job, wait)
+    return job.to_dict()
+
+@app.get("/job_stats")
+async def job_stats(token: str = Depends(validate_token)):
+    return job_queue.stats()
+
+class AdmissionPayload(BaseModel):
+    token_rate: float = Field(None, ge=0)
+    token_burst: float = Field(None, ge=1)
+    user_rate: float = Field(None, ge=0)
+    user_burst: float = Field(None, ge=1)
+    max_concurrency: int = Field(None, ge=0)
+    max_queue: int = Field(None, ge=0)
+    queue_target: float = Field(None, gt=0)
+
+@app.get("/admission", dependencies=[Depends(validate_admin_token)])
+async def get_admission():
+    """Rate limits, concurrency limit and queue of /process, with how many requests each turned away"""
+    return admission.stats()
+
+@app.put("/admission", dependencies=[Depends(validate_admin_token)])
+async def update_admission(payload: AdmissionPayload):
+    """Change the admission limits while running; omitted fields keep their value"""
+    admission.configure(payload.model_dump())
+    return admission.stats()
+
+@app.get("/idempotency_stats")
+async def idempotency_stats(token: str = Depends(validate_token)):
+    """Stored /process results, and how many requests were replayed or coalesced onto a running one"""
+    return idempotency.stats()
+
+@app.post("/process_batch")
+async def process_batch(batch: BatchDataPayload, token: str = Depends(validate_token)):
+    """
+    Process many items with a constant number of round trips:
+    one /process_batch call to the Business Logic Service and one /write_many
+    call to the Database Service, whatever the batch size.
+    Results are reported per item in the order the items were sent.
+    A batch counts as one request against the per-token rate limit.
+    """
+    admission.check(token)
+    async with batch_semaphore:
         try:
-            save_payload = {
-                "user_id": data.user_id,
-                "data": processed_result
-            }
-            save_response = await client.post(
-                f"{DATABASE_SERVICE_URL}/write",
-                json=save_payload,
-                headers={"Authorization": f"Bearer {INTERNAL_SERVICE_TOKEN}"}
+            business_response = await http_clients["business"].post(
+                "/process_batch",
+                **codecs["business"].encode({"items": [{"content": item.content} for item in batch.items]})
             )
-            if save_response.status_code != 200:
-                return {"error": f"Database write failed: {save_response.text}"}
-            
-            final_result = save_response.json()
         except Exception as e:
-            return {"error": f"Failed to store result in database: {str(e)}"}
-        return {
-            "message": "Data processed successfully",
-            "user_id": data.user_id,
-            "original_content": data.content,
-            "processed_result": processed_result,
-            "storage_status": final_result
-        }
+            raise downstream_error("Failed to connect to business logic service", e)
+        if business_response.status_code != 200:
+            raise downstream_error("Business logic processing failed", response=business_response)
+        processed_results = codecs["business"].decode(business_response)["results"]
+        
+        results = []
+        writes = []
+        for item, processed in zip(batch.items, processed_results):
+            if processed["status"] != "success":
+                results.append({"user_id": item.user_id, "status": "error",
+                                "error": f"Business logic processing failed: {processed.get('error')}"})
+                continue
+            processed_result = {"analysis": processed["analysis"], "process_history": processed["process_history"]}
+            results.append({"user_id": item.user_id, "status": "success",
+                            "original_content": item.content, "processed_result": processed_result})
+            writes.append((len(results) - 1, {
+                "user_id": item.user_id,
+                "data": {"analysis": processed["analysis"]},
+                "history_entry": processed["process_history"][-1]
+            }))
+        
+        async def write_shard(shard_writes):
+            """One /write_many call per shard, all shards at once"""
+            user_ids = [write["user_id"] for _, write in shard_writes]
+            try:
+                save_response = await http_clients["database"].post(
+                    "/write_many",
+                    **codecs["database"].encode({"items": [write for _, write in shard_writes]}),
+                    extensions=shard_keys(*user_ids)
+                )
+                if save_response.status_code != 200:
+                    raise RuntimeError(f"Database write failed: {save_response.text}")
+                for (index, _), storage_status in zip(shard_writes, codecs["database"].decode(save_response)["results"]):
+                    if storage_status["status"] != "success":
+                        results[index] = {"user_id": results[index]["user_id"], "status": "error",
+                                          "error": f"Database write failed: {storage_status.get('error')}"}
+                    else:
+                        results[index]["storage_status"] = storage_status
+            except Exception as e:
+                for index, _ in shard_writes:
+                    results[index] = {"user_id": results[index]["user_id"], "status": "error",
+                                      "error": f"Failed to store result in database: {str(e)}"}
+        
+        if writes:
+            groups = database_sharding.group([write["user_id"] for _, write in writes])
+            await asyncio.gather(*[write_shard([writes[position] for position in group]) for group in groups])
+    
+    succeeded = sum(1 for result in results if result["status"] == "success")
+    return {
+        "message": "Batch processed",
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results
+    }
 
 if __name__ == "__main__":
     import uvicorn
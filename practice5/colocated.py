@@ -0,0 +1,32 @@
+"""
+The Client, Business Logic and Database services in one process, for small
+nodes: uvicorn colocated:app --port 8000
+
+The Client Service reaches the other two through in-process transports
+(DOWNSTREAM_TRANSPORT, asgi by default) instead of loopback HTTP. The
+Business Logic and Database APIs stay available under /business and
+/database, with the same token checks.
+"""
+import os
+
+from starlette.applications import Starlette
+from starlette.routing import Mount
+
+os.environ.setdefault("DOWNSTREAM_TRANSPORT", "asgi")
+
+import business_service  # noqa: E402
+import client_service  # noqa: E402
+import database_service  # noqa: E402
+
+if client_service.DOWNSTREAM_TRANSPORT == "http":
+    raise RuntimeError("colocated:app needs DOWNSTREAM_TRANSPORT=asgi or direct")
+
+# The Client Service lifespan starts the other two services (see client_service.start_colocated)
+app = Starlette(
+    routes=[
+        Mount("/business", app=business_service.app),
+        Mount("/database", app=database_service.app),
+        Mount("/", app=client_service.app)
+    ],
+    lifespan=lambda app: client_service.app.router.lifespan_context(client_service.app)
+)
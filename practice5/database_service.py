@@ -1,18 +1,79 @@
+import asyncio
+import base64
+import json
 import os
-from fastapi import Depends, FastAPI, HTTPException, Header
-from pydantic import BaseModel
-from typing import Dict, Any, Optional
+import zlib
+from contextlib import AsyncExitStack, asynccontextmanager
+from fastapi import Depends, FastAPI, HTTPException, Header, Query, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Dict, Any, List, Optional
 import time
 
-app = FastAPI(title="Database Service",
-              description="Handles data storage and retrieval")
+from records import parse_timestamp
+from sharding import HashRanges
+from storage import create_storage, dumps
+from metrics import instrument, registry
+from profiling import enable_profiling
+from tracing import enable_tracing, span
+from wire import WireResponse, WireRoute
 
 INTERNAL_SERVICE_TOKEN = os.getenv("INTERNAL_SERVICE_TOKEN", "YourInternalToken")
-database: Dict[str, Dict[str, Any]] = {}
+# Maximum number of history entries kept per user; 0 keeps the full history
+HISTORY_MAX_ENTRIES = int(os.getenv("HISTORY_MAX_ENTRIES", "0"))
+HISTORY_PAGE_LIMIT = 1000
+QUERY_PAGE_LIMIT = 1000
+# Index entries one /query page may examine before it returns a cursor to continue from
+QUERY_MAX_SCAN = int(os.getenv("QUERY_MAX_SCAN", "100000"))
+# Users serialized per /scan chunk and NDJSON lines applied per /import chunk
+SCAN_CHUNK_SIZE = int(os.getenv("SCAN_CHUNK_SIZE", "1000"))
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+IMPORT_MAX_LINE_BYTES = int(os.getenv("IMPORT_MAX_LINE_BYTES", str(16 * 1024 * 1024)))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "5000"))
+# Writers to the same user_id are serialized by one of these striped locks
+LOCK_STRIPES = int(os.getenv("LOCK_STRIPES", "64"))
+
+# Records and the append-only process history per user; see storage.py for the backends
+storage = create_storage(history_max_entries=HISTORY_MAX_ENTRIES)
+key_locks = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    key_locks[:] = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+    await storage.open()
+    yield
+    await storage.close()
+
+app = FastAPI(title="Database Service",
+              description="Handles data storage and retrieval",
+              lifespan=lifespan)
+# Internal callers may send and accept msgpack or gzip bodies
+app.router.route_class = WireRoute
+instrument(app, "database")
+enable_tracing(app, "database")
+enable_profiling(app, "database")
+registry.callback_gauge("database_records", "Records stored", lambda: storage.count())
+registry.callback_gauge("database_history_entries", "Process history entries stored",
+                        lambda: storage.history_entries())
+registry.callback_gauge("database_storage_bytes", "Bytes used by the storage directory (0 for memory)",
+                        lambda: storage.disk_bytes())
 
 class WritePayload(BaseModel):
     user_id: str
     data: Dict[str, Any]
+    history_entry: Optional[Dict[str, Any]] = None
+    # Compare-and-set: the write is rejected unless the stored version matches
+    expected_version: Optional[int] = None
+
+class WriteManyPayload(BaseModel):
+    items: List[WritePayload] = Field(..., max_length=MAX_BATCH_SIZE)
+
+class ReadManyPayload(BaseModel):
+    user_ids: List[str] = Field(..., max_length=MAX_BATCH_SIZE)
+
+class AppendPayload(BaseModel):
+    user_id: str
+    entry: Dict[str, Any]
 
 class ReadParams(BaseModel):
     user_id: str
@@ -32,54 +93,402 @@ async def root():
     return {
         "service": "Database Service",
         "description": "Handles data storage and retrieval operations",
-        "endpoints": ["/write", "/read", "/health"],
-        "records_count": len(database)
+        "endpoints": ["/write", "/read", "/write_many", "/read_many", "/history", "/history/append", "/query", "/aggregates", "/scan", "/import", "/purge", "/health", "/metrics"],
+        "records_count": storage.count()
     }
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {"status": "ok", "storage": storage.stats()}
 
-@app.post("/write")
-async def write_data(payload: WritePayload, token: str = Depends(validate_token)):
+class VersionConflict(Exception):
+    def __init__(self, user_id: str, expected_version: int, current_version: int):
+        super().__init__(f"Version conflict for {user_id}: expected {expected_version}, found {current_version}")
+        self.user_id = user_id
+        self.expected_version = expected_version
+        self.current_version = current_version
+
+def lock_indexes(user_ids):
+    return sorted({zlib.crc32(user_id.encode()) % len(key_locks) for user_id in user_ids})
+
+@asynccontextmanager
+async def locked(*user_ids: str):
     """
-    Write data to the database for a specific user
+    Hold the stripe locks of the given users, acquired in index order so
+    batch writers cannot deadlock with each other. Writers keep the lock until
+    their change is durable, so nobody builds on a version that may still be lost.
+    """
+    async with AsyncExitStack() as stack:
+        for index in lock_indexes(user_ids):
+            await stack.enter_async_context(key_locks[index])
+        yield
+
+def current_version(user_id: str):
+    return storage.version(user_id)
+
+def store_record(payload: WritePayload):
+    """
+    Store one user's record, bumping its version.
+    An optional history_entry is appended to the user's process history.
+    Raises VersionConflict, before changing anything, when expected_version does not match.
     """
     user_id = payload.user_id
+    version = current_version(user_id)
+    if payload.expected_version is not None and payload.expected_version != version:
+        raise VersionConflict(user_id, payload.expected_version, version)
     data_with_metadata = payload.data.copy()
+    if "process_history" in data_with_metadata:
+        storage.replace_history(user_id, data_with_metadata.pop("process_history"))
+    if payload.history_entry is not None:
+        storage.append_history(user_id, payload.history_entry)
     data_with_metadata["metadata"] = {
         "last_updated": time.strftime("%Y-%m-%d %H:%M:%S"),
-        "version": database.get(user_id, {}).get("metadata", {}).get("version", 0) + 1
+        "version": version + 1,
+        "history_length": len(storage.history(user_id))
     }
 
-    database[user_id] = data_with_metadata
+    storage.put(user_id, data_with_metadata)
+    return data_with_metadata["metadata"]
+
+@app.post("/write")
+async def write_data(payload: WritePayload, token: str = Depends(validate_token)):
+    """
+    Write data to the database for a specific user.
+    A stale expected_version is rejected with 409 and the current version.
+    """
+    async with locked(payload.user_id):
+        try:
+            metadata = store_record(payload)
+        except VersionConflict as e:
+            raise HTTPException(status_code=409, detail={
+                "message": str(e),
+                "expected_version": e.expected_version,
+                "current_version": e.current_version
+            })
+        with span("storage_sync"):
+            await storage.sync()
     
-    return {
+    return WireResponse({
         "status": "success",
-        "user_id": user_id,
+        "user_id": payload.user_id,
         "message": "Data stored successfully",
-        "metadata": data_with_metadata["metadata"]
-    }
+        "metadata": metadata
+    })
+
+@app.post("/write_many")
+async def write_many(payload: WriteManyPayload, token: str = Depends(validate_token)):
+    """
+    Write many records in one call, in order, with a single durability wait.
+    Results are reported per item in the order the items were sent.
+    """
+    results = []
+    async with locked(*[item.user_id for item in payload.items]):
+        for item in payload.items:
+            try:
+                results.append({"status": "success", "user_id": item.user_id, "metadata": store_record(item)})
+            except VersionConflict as e:
+                results.append({"status": "error", "user_id": item.user_id, "error": str(e),
+                                "current_version": e.current_version})
+            except Exception as e:
+                results.append({"status": "error", "user_id": item.user_id, "error": str(e)})
+        await storage.sync()
+    return WireResponse({"status": "success", "results": results})
 
 @app.get("/read")
-async def read_data(user_id: str, token: str = Depends(validate_token)):
+async def read_data(user_id: str, include_history: bool = False, token: str = Depends(validate_token)):
     """
-    Read data from the database for a specific user
+    Read data from the database for a specific user.
+    The process history is only embedded when include_history is set; use /history to page through it.
     """
-    if user_id not in database:
-        return {
+    data = storage.get(user_id)
+    if data is None:
+        return WireResponse({
             "status": "success",
             "user_id": user_id,
             "data": {},
             "message": "No data found for this user"
-        }
+        })
     
-    return {
+    if include_history:
+        data = {**data, "process_history": list(storage.history(user_id))}
+    return WireResponse({
         "status": "success",
         "user_id": user_id,
-        "data": database[user_id],
+        "data": data,
         "message": "Data retrieved successfully"
+    })
+
+@app.post("/read_many")
+async def read_many(payload: ReadManyPayload, token: str = Depends(validate_token)):
+    """
+    Read the records of many users in one call; users without data map to {}
+    """
+    return WireResponse({
+        "status": "success",
+        "data": {user_id: storage.get(user_id) or {} for user_id in payload.user_ids}
+    })
+
+@app.post("/history/append")
+async def append_history_entry(payload: AppendPayload, token: str = Depends(validate_token)):
+    """
+    Append a single entry to a user's process history
+    """
+    async with locked(payload.user_id):
+        history_length = storage.append_history(payload.user_id, payload.entry)
+        await storage.sync()
+    return WireResponse({
+        "status": "success",
+        "user_id": payload.user_id,
+        "history_length": history_length
+    })
+
+@app.get("/history")
+async def read_history(user_id: str,
+                       offset: int = Query(0, ge=0),
+                       limit: int = Query(50, ge=1, le=HISTORY_PAGE_LIMIT),
+                       token: str = Depends(validate_token)):
+    """
+    Read a page of a user's process history, oldest entry first.
+    Offsets are relative to the oldest retained entry.
+    """
+    history = storage.history(user_id)
+    entries = list(history[offset:offset + limit])
+    next_offset = offset + len(entries)
+    return WireResponse({
+        "status": "success",
+        "user_id": user_id,
+        "entries": entries,
+        "offset": offset,
+        "limit": limit,
+        "total": len(history),
+        "dropped": storage.dropped(user_id),
+        "next_offset": next_offset if next_offset < len(history) else None
+    })
+
+def encode_cursor(field: str, item):
+    return base64.urlsafe_b64encode(json.dumps([field, *item]).encode()).decode()
+
+def decode_cursor(field: str, cursor: str):
+    try:
+        cursor_field, key, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_field != field:
+        raise HTTPException(status_code=400, detail="Cursor belongs to a query with different filters")
+    return key, user_id
+
+def timestamp_param(name: str, value: Optional[str]):
+    if value is None:
+        return None
+    epoch = parse_timestamp(value)
+    if epoch is None:
+        raise HTTPException(status_code=422, detail=f"{name} must look like 2025-04-23 12:00:00")
+    return epoch
+
+@app.get("/query")
+async def query_records(sentiment: Optional[str] = None,
+                        updated_from: Optional[str] = None,
+                        updated_to: Optional[str] = None,
+                        updated_within: Optional[float] = Query(None, gt=0),
+                        version_min: Optional[int] = None,
+                        version_max: Optional[int] = None,
+                        limit: int = Query(50, ge=1, le=QUERY_PAGE_LIMIT),
+                        cursor: Optional[str] = None,
+                        token: str = Depends(validate_token)):
+    """
+    Find records by sentiment, last update time (updated_from/updated_to, or
+    updated_within the last N seconds) and version range, through the
+    secondary indexes. Pass next_cursor back as cursor for the next page;
+    a page may hold fewer than limit results when the scan budget ran out.
+    """
+    updated_low = timestamp_param("updated_from", updated_from)
+    updated_high = timestamp_param("updated_to", updated_to)
+    if updated_within is not None:
+        updated_low = max(updated_low or 0, int(time.time() - updated_within))
+    ranges = {
+        "updated": (updated_low, updated_high),
+        "version": (version_min, version_max),
+        "sentiment": (sentiment, sentiment)
     }
+    # Drive the scan with the first filtered index; the other filters are checked per record
+    field = next((name for name, bounds in ranges.items() if bounds != (None, None)), "updated")
+    checks = [(position, low, high) for position, name in enumerate(("sentiment", "updated", "version"))
+              for low, high in [ranges[name]] if name != field and (low, high) != (None, None)]
+
+    def where(fields):
+        for position, low, high in checks:
+            value = fields[position]
+            if value is None or (low is not None and value < low) or (high is not None and value > high):
+                return False
+        return True
+
+    low, high = ranges[field]
+    after = decode_cursor(field, cursor) if cursor else None
+    matches, last = storage.query(field, low, high, after, limit, where if checks else None, QUERY_MAX_SCAN)
+    return WireResponse({
+        "status": "success",
+        "results": [{"user_id": user_id, "data": data} for user_id, data in matches],
+        "count": len(matches),
+        "next_cursor": encode_cursor(field, last) if last is not None else None
+    })
+
+@app.get("/aggregates")
+async def aggregates(token: str = Depends(validate_token)):
+    """
+    Sentiment distribution and word totals over all stored records,
+    maintained incrementally on every write
+    """
+    return WireResponse({"status": "success", **storage.indexes.aggregates()})
+
+def hash_ranges_param(value: Optional[str]):
+    if value is None:
+        return None
+    try:
+        return HashRanges.parse(value)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="hash_ranges must look like low:high,low:high")
+
+def scan_lines(rows, include_history: bool):
+    chunk = []
+    for user_id, data, history, dropped in rows:
+        item = {"user_id": user_id, "data": data}
+        if include_history and history is not None:
+            item["history"] = history
+            item["history_dropped"] = dropped
+        chunk.append(dumps(item))
+    chunk.append("")
+    return "\n".join(chunk).encode()
+
+@app.get("/scan")
+async def scan(cursor: int = Query(0, ge=0), limit: Optional[int] = Query(None, ge=1),
+               include_history: bool = True, hash_ranges: Optional[str] = None, user_ids: Optional[str] = None,
+               token: str = Depends(validate_token)):
+    """
+    Stream users as NDJSON, one {"user_id", "data", "history", "history_dropped"}
+    object per line, as of the moment streaming starts; writes made meanwhile
+    are not visible. With limit, X-Next-Cursor holds the cursor for the next
+    call, which continues without skipping or repeating users.
+    hash_ranges ("low:high,...") keeps the users whose key hash falls in them,
+    and user_ids (comma-separated) streams just those users; both are used
+    to move users between shards.
+    """
+    ranges = hash_ranges_param(hash_ranges)
+    if user_ids is not None:
+        rows = []
+        for user_id in dict.fromkeys(user_ids.split(",")):
+            data, history = storage.get(user_id), storage.histories.get(user_id)
+            if data is not None or history is not None:
+                rows.append((user_id, data, list(history) if history is not None else None, storage.dropped(user_id)))
+        return StreamingResponse(iter([scan_lines(rows, include_history)]), media_type="application/x-ndjson")
+    end = len(storage.keys) if limit is None else min(len(storage.keys), cursor + limit)
+    headers = {"X-Next-Cursor": str(end)} if end < len(storage.keys) else {}
+
+    async def lines():
+        snapshot = storage.open_scan(cursor, end)
+        try:
+            while not snapshot.done():
+                rows = snapshot.next_rows(SCAN_CHUNK_SIZE, ranges.__contains__ if ranges is not None else None)
+                if rows:
+                    yield scan_lines(rows, include_history)
+                else:
+                    await asyncio.sleep(0)
+        finally:
+            snapshot.close()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers=headers)
+
+def import_item(line: bytes):
+    item = json.loads(line)
+    if not isinstance(item, dict) or not isinstance(item.get("user_id"), str):
+        raise ValueError("each line must be an object with a string user_id")
+    if not isinstance(item.get("data", {}), dict) or not isinstance(item.get("history", []), list):
+        raise ValueError("data must be an object and history a list")
+    return item
+
+@app.post("/purge")
+async def purge(hash_ranges: str, token: str = Depends(validate_token)):
+    """
+    Delete every user whose key hash falls in hash_ranges, SCAN_CHUNK_SIZE
+    users at a time; used to drop users from a shard after they were moved
+    """
+    ranges = hash_ranges_param(hash_ranges)
+    deleted = 0
+    keys = list(storage.keys)
+    for start in range(0, len(keys), SCAN_CHUNK_SIZE):
+        chunk = [user_id for user_id in keys[start:start + SCAN_CHUNK_SIZE] if user_id in ranges]
+        if chunk:
+            async with locked(*chunk):
+                deleted += sum(storage.delete(user_id) for user_id in chunk)
+                await storage.sync()
+        else:
+            await asyncio.sleep(0)
+    return {"status": "success", "deleted": deleted}
+
+@app.post("/import")
+async def import_records(request: Request, overwrite: bool = True, token: str = Depends(validate_token)):
+    """
+    Load NDJSON in the /scan format, applying it in chunks of IMPORT_CHUNK_SIZE
+    lines. Records are stored as they are, versions included. Each chunk is
+    applied under the users' locks and made durable before the next is read,
+    so concurrent writes and scans see whole chunks. overwrite=false keeps
+    users that already exist.
+    """
+    counters = {"imported": 0, "skipped": 0, "failed": 0}
+    errors = []
+    line_number = 0
+
+    async def apply(items):
+        async with locked(*[item["user_id"] for item in items]):
+            for item in items:
+                user_id = item["user_id"]
+                if not overwrite and (storage.get(user_id) is not None or len(storage.history(user_id))):
+                    counters["skipped"] += 1
+                    continue
+                if "data" in item:
+                    storage.put(user_id, item["data"])
+                if "history" in item:
+                    storage.replace_history(user_id, item["history"], item.get("history_dropped", 0))
+                counters["imported"] += 1
+            await storage.sync()
+
+    items = []
+
+    def parse(line: bytes):
+        nonlocal line_number
+        line_number += 1
+        if not line.strip():
+            return
+        try:
+            items.append(import_item(line))
+        except ValueError as e:
+            counters["failed"] += 1
+            if len(errors) < 10:
+                errors.append({"line": line_number, "error": str(e)})
+
+    # The unfinished last line; chunks are appended to it, so each byte is copied once
+    buffer = bytearray()
+    async for body_chunk in request.stream():
+        end = body_chunk.rfind(b"\n")
+        if end < 0:
+            buffer += body_chunk
+            if len(buffer) > IMPORT_MAX_LINE_BYTES:
+                raise HTTPException(status_code=413, detail=f"Line {line_number + 1} is too long")
+            continue
+        buffer += body_chunk[:end]
+        lines = buffer.split(b"\n")
+        buffer = bytearray(body_chunk[end + 1:])
+        if len(buffer) > IMPORT_MAX_LINE_BYTES:
+            raise HTTPException(status_code=413, detail=f"Line {line_number + len(lines) + 1} is too long")
+        for line in lines:
+            parse(line)
+            if len(items) >= IMPORT_CHUNK_SIZE:
+                await apply(items)
+                items = []
+    if buffer:
+        parse(buffer)
+    if items:
+        await apply(items)
+    return {"status": "success", "lines": line_number, **counters, "errors": errors}
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,98 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+class KeyReused(Exception):
+    """The Idempotency-Key was already used for a different request"""
+
+def fingerprint(*parts):
+    """Digest of the parts of a request that must match for a key to be replayed"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+class IdempotencyStore:
+    """
+    Results of requests sent with an Idempotency-Key, so a retry gets the
+    first result instead of running the request again.
+
+    The first request with a key runs the handler in a task of its own;
+    duplicates that arrive while it runs wait on that task (single flight),
+    and a client that gives up does not cancel it, so its retry still finds
+    the result. Results that keep(result) accepts are stored for ttl seconds,
+    at most max_entries of them; the others, and exceptions, are passed to
+    the requests already waiting and then forgotten, so the next retry runs
+    again. Keys are only compared with requests of the same fingerprint;
+    reusing one for a different request raises KeyReused.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (fingerprint, result, stored_at), oldest first
+        self.entries = OrderedDict()
+        # key -> (fingerprint, task)
+        self.in_flight = {}
+        self.counters = {"executed": 0, "replayed": 0, "coalesced": 0, "rejected": 0, "evictions": 0,
+                         "expirations": 0}
+
+    def evict(self):
+        now = time.time()
+        while self.entries:
+            key, (_, _, stored_at) = next(iter(self.entries.items()))
+            if now - stored_at > self.ttl:
+                self.counters["expirations"] += 1
+            elif len(self.entries) > self.max_entries:
+                self.counters["evictions"] += 1
+            else:
+                break
+            del self.entries[key]
+
+    def check(self, key, expected: str, actual: str):
+        if expected != actual:
+            self.counters["rejected"] += 1
+            raise KeyReused(f"Idempotency-Key {key[-1]} was already used for a different request")
+
+    async def run(self, key: tuple, request_fingerprint: str, handler, keep=lambda result: True, admit=lambda: None):
+        """
+        (result, replayed): handler()'s result, or the one of the earlier request
+        with this key. admit() is only called when the handler is about to run,
+        so it can turn new work away without refusing replays.
+        """
+        self.evict()
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.check(key, entry[0], request_fingerprint)
+            self.counters["replayed"] += 1
+            return entry[1], True
+        flight = self.in_flight.get(key)
+        if flight is not None:
+            self.check(key, flight[0], request_fingerprint)
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(flight[1]), True
+        admit()
+        task = asyncio.create_task(self.execute(key, request_fingerprint, handler, keep))
+        # Nobody may be left waiting when it fails; don't log the exception as unretrieved
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self.in_flight[key] = (request_fingerprint, task)
+        return await asyncio.shield(task), False
+
+    async def execute(self, key, request_fingerprint, handler, keep):
+        self.counters["executed"] += 1
+        try:
+            result = await handler()
+            if keep(result):
+                self.entries[key] = (request_fingerprint, result, time.time())
+                self.evict()
+            return result
+        finally:
+            del self.in_flight[key]
+
+    def stats(self):
+        return {
+            **self.counters,
+            "entries": len(self.entries),
+            "in_flight": len(self.in_flight),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl
+        }
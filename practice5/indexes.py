@@ -0,0 +1,136 @@
+from bisect import bisect_left, bisect_right, insort
+
+from records import Record, parse_timestamp
+
+# Entries per block of a SortedIndex; blocks are split when they grow to twice this size
+BLOCK_SIZE = 512
+
+class SortedIndex:
+    """
+    Sorted (key, user_id) pairs kept in blocks, so an update moves at most a
+    block's worth of entries and a range read starts with two binary searches,
+    whatever the number of users.
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self.maxes = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, item):
+        self.size += 1
+        if not self.blocks:
+            self.blocks.append([item])
+            self.maxes.append(item)
+            return
+        index = min(bisect_left(self.maxes, item), len(self.blocks) - 1)
+        block = self.blocks[index]
+        insort(block, item)
+        self.maxes[index] = block[-1]
+        if len(block) >= 2 * BLOCK_SIZE:
+            self.blocks[index:index + 1] = [block[:BLOCK_SIZE], block[BLOCK_SIZE:]]
+            self.maxes[index:index + 1] = [block[BLOCK_SIZE - 1], block[-1]]
+
+    def remove(self, item):
+        index = bisect_left(self.maxes, item)
+        if index == len(self.blocks):
+            return
+        block = self.blocks[index]
+        position = bisect_left(block, item)
+        if position == len(block) or block[position] != item:
+            return
+        del block[position]
+        self.size -= 1
+        if block:
+            self.maxes[index] = block[-1]
+        else:
+            del self.blocks[index], self.maxes[index]
+
+    def range(self, low=None, high=None, after=None):
+        """Yield pairs with low <= key <= high in order, starting after the pair `after` when given"""
+        if after is not None:
+            start, find = tuple(after), bisect_right
+        elif low is not None:
+            start, find = (low,), bisect_left
+        else:
+            start, find = None, None
+        index = 0 if start is None else bisect_left(self.maxes, start)
+        for block_index in range(index, len(self.blocks)):
+            block = self.blocks[block_index]
+            position = 0 if start is None or block_index > index else find(block, start)
+            for item in block[position:] if position else block:
+                if high is not None and item[0] > high:
+                    return
+                if low is not None and item[0] < low:
+                    continue
+                yield item
+
+def index_fields(value):
+    """(sentiment, updated epoch, version, word count, character count) of a stored record; None where unknown"""
+    if type(value) is Record:
+        return value.sentiment, value.updated, value.version, value.word_count, value.character_count
+    analysis = value.get("analysis") if isinstance(value.get("analysis"), dict) else {}
+    metadata = value.get("metadata") if isinstance(value.get("metadata"), dict) else {}
+    sentiment = analysis.get("sentiment")
+    updated = metadata.get("last_updated")
+    version = metadata.get("version")
+    word_count = analysis.get("word_count")
+    character_count = analysis.get("character_count")
+    return (
+        sentiment if isinstance(sentiment, str) else None,
+        parse_timestamp(updated) if isinstance(updated, str) else None,
+        version if type(version) is int else None,
+        word_count if type(word_count) is int else 0,
+        character_count if type(character_count) is int else 0
+    )
+
+class RecordIndexes:
+    """
+    Secondary indexes on sentiment, last update time and version, plus
+    aggregate counters, all updated as records are stored.
+    """
+
+    def __init__(self):
+        self.sentiment = SortedIndex()
+        self.updated = SortedIndex()
+        self.version = SortedIndex()
+        self.sentiment_counts = {}
+        self.word_count = 0
+        self.character_count = 0
+        self.records = 0
+
+    def indexes(self):
+        return self.sentiment, self.updated, self.version
+
+    def update(self, user_id: str, old, new):
+        if old is not None:
+            self.apply(user_id, index_fields(old), -1)
+        if new is not None:
+            self.apply(user_id, index_fields(new), 1)
+
+    def apply(self, user_id, fields, sign):
+        sentiment, updated, version, word_count, character_count = fields
+        for index, key in zip(self.indexes(), (sentiment, updated, version)):
+            if key is not None:
+                (index.add if sign > 0 else index.remove)((key, user_id))
+        if sentiment is not None:
+            count = self.sentiment_counts.get(sentiment, 0) + sign
+            if count:
+                self.sentiment_counts[sentiment] = count
+            else:
+                self.sentiment_counts.pop(sentiment, None)
+        self.word_count += sign * word_count
+        self.character_count += sign * character_count
+        self.records += sign
+
+    def aggregates(self):
+        return {
+            "records": self.records,
+            "sentiment_distribution": dict(sorted(self.sentiment_counts.items())),
+            "total_word_count": self.word_count,
+            "total_character_count": self.character_count,
+            "average_word_count": round(self.word_count / self.records, 2) if self.records else 0
+        }
@@ -0,0 +1,146 @@
+import asyncio
+import contextvars
+import time
+import uuid
+from collections import deque
+
+class QueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self, handler, args, context):
+        self.id = uuid.uuid4().hex
+        self.handler = handler
+        self.args = args
+        self.context = context
+        self.status = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.done = asyncio.Event()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "queue_wait_seconds": round(self.started - self.created, 4) if self.started else None,
+            "result": self.result
+        }
+
+class JobQueue:
+    """
+    Bounded in-process queue drained by a fixed pool of worker tasks.
+    Finished jobs are kept for result_ttl seconds (and at most max_results of them)
+    so callers can fetch or long-poll their results; the oldest finished jobs go
+    first, whatever is still queued or running.
+    """
+
+    def __init__(self, maxsize: int = 1000, workers: int = 8, result_ttl: float = 300, max_results: int = 10000):
+        self.maxsize = maxsize
+        self.worker_count = workers
+        self.result_ttl = result_ttl
+        self.max_results = max_results
+        self.queue = None
+        self.workers = []
+        self.jobs = {}
+        # Finished jobs in the order they finished, for eviction
+        self.finished = deque()
+        self.busy = 0
+        self.wait_times = deque(maxlen=1000)
+        self.run_times = deque(maxlen=1000)
+        self.counters = {"submitted": 0, "rejected": 0, "succeeded": 0, "failed": 0}
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, handler, *args):
+        """Queue handler(*args); raises QueueFull instead of waiting when the queue is at capacity"""
+        self.evict()
+        # Keep the caller's context (e.g. its request ID) for the downstream calls
+        job = Job(handler, args, contextvars.copy_context())
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.counters["rejected"] += 1
+            raise QueueFull(f"Job queue is full ({self.maxsize} jobs waiting)")
+        self.jobs[job.id] = job
+        self.counters["submitted"] += 1
+        return job
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    async def wait(self, job: Job, timeout: float):
+        """Long-poll: return once the job finished or timeout seconds passed"""
+        if timeout > 0 and not job.done.is_set():
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    def evict(self):
+        now = time.time()
+        while self.finished:
+            job = self.finished[0]
+            if job.finished + self.result_ttl > now and len(self.finished) <= self.max_results:
+                break
+            self.finished.popleft()
+            self.jobs.pop(job.id, None)
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            self.busy += 1
+            job.status = "running"
+            job.started = time.time()
+            self.wait_times.append(job.started - job.created)
+            try:
+                # The task copies the context it is created in, i.e. the job's
+                task = job.context.run(asyncio.create_task, job.handler(*job.args))
+                job.result = await task
+                failed = isinstance(job.result, dict) and "error" in job.result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.result = {"error": str(e)}
+                failed = True
+            finally:
+                self.busy -= 1
+                self.queue.task_done()
+            job.status = "failed" if failed else "succeeded"
+            job.finished = time.time()
+            self.run_times.append(job.finished - job.started)
+            self.counters[job.status] += 1
+            job.done.set()
+            self.finished.append(job)
+            self.evict()
+
+    def stats(self):
+        def percentiles(values):
+            ordered = sorted(values)
+            if not ordered:
+                return {"p50": None, "p95": None, "max": None}
+            pick = lambda fraction: round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 4)
+            return {"p50": pick(0.5), "p95": pick(0.95), "max": round(ordered[-1], 4)}
+        return {
+            **self.counters,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "queue_capacity": self.maxsize,
+            "workers": self.worker_count,
+            "busy_workers": self.busy,
+            "tracked_jobs": len(self.jobs),
+            "wait_seconds": percentiles(self.wait_times),
+            "run_seconds": percentiles(self.run_times)
+        }
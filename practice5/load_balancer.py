@@ -0,0 +1,175 @@
+import asyncio
+import random
+import socket
+import time
+from collections import deque
+from typing import List
+
+import httpx
+
+STRATEGIES = ("p2c", "least_outstanding")
+
+class Endpoint:
+    """One replica of a downstream service, with its load and health state"""
+
+    def __init__(self, url: str):
+        self.url = httpx.URL(url)
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.healthy = True
+        # Exponentially weighted moving average of the latency in seconds
+        self.ewma = 0.0
+        self.latencies = deque(maxlen=1000)
+
+    def available(self, now: float):
+        return self.healthy and now >= self.ejected_until
+
+    def load(self):
+        return self.outstanding, self.ewma
+
+    def record(self, elapsed: float, failed: bool, eject_failures: int, eject_seconds: float):
+        self.requests += 1
+        self.latencies.append(elapsed)
+        self.ewma = elapsed if self.requests == 1 else 0.8 * self.ewma + 0.2 * elapsed
+        if not failed:
+            self.consecutive_failures = 0
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= eject_failures:
+            # Outlier ejection: each repeated ejection keeps the replica out longer
+            self.ejections += 1
+            self.consecutive_failures = 0
+            self.ejected_until = time.monotonic() + eject_seconds * min(self.ejections, 10)
+            print(f"Ejecting {self.url} for {eject_seconds * min(self.ejections, 10):.0f}s after repeated failures")
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 1)
+        return {
+            "url": str(self.url),
+            "healthy": self.healthy,
+            "ejected": time.monotonic() < self.ejected_until,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "latency_ms": {"ewma": round(self.ewma * 1000, 1), "p50": percentile(0.5), "p95": percentile(0.95)}
+        }
+
+class BalancingTransport(httpx.AsyncBaseTransport):
+    """
+    Spreads requests over several replicas of one service by rewriting the
+    request URL before handing it to the shared inner transport.
+
+    Replicas are picked by power-of-two-choices or least outstanding requests,
+    probed in the background on health_path, and ejected for a while after
+    eject_failures consecutive errors. When every replica is out, all of them
+    are used again rather than failing every request. With discover=True the
+    configured host names are re-resolved on each probe and every address
+    becomes a replica, which is how compose replicas behind one name are found.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, urls: List[str], strategy: str = "p2c",
+                 health_path: str = "/health", health_interval: float = 5, eject_failures: int = 5,
+                 eject_seconds: float = 30, discover: bool = False):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown load balancing strategy {strategy}, expected one of {STRATEGIES}")
+        self.transport = transport
+        self.urls = urls
+        self.strategy = strategy
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.discover = discover
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.probe_task = None
+
+    def start(self):
+        if self.health_interval > 0 and (len(self.endpoints) > 1 or self.discover):
+            self.probe_task = asyncio.create_task(self.probe_loop())
+
+    def choose(self):
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.available(now)] or self.endpoints
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.strategy == "least_outstanding":
+            return min(candidates, key=Endpoint.load)
+        first, second = random.sample(candidates, 2)
+        return first if first.load() <= second.load() else second
+
+    async def handle_async_request(self, request):
+        endpoint = self.choose()
+        request.url = request.url.copy_with(scheme=endpoint.url.scheme, host=endpoint.url.host,
+                                            port=endpoint.url.port)
+        request.headers["Host"] = endpoint.url.netloc.decode("ascii")
+        endpoint.outstanding += 1
+        start = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except asyncio.CancelledError:
+            # A cancelled call (e.g. the losing side of a hedged request) says nothing about the replica
+            endpoint.outstanding -= 1
+            raise
+        except Exception:
+            endpoint.outstanding -= 1
+            endpoint.record(time.perf_counter() - start, True, self.eject_failures, self.eject_seconds)
+            raise
+        endpoint.outstanding -= 1
+        endpoint.record(time.perf_counter() - start, response.status_code >= 500, self.eject_failures,
+                        self.eject_seconds)
+        return response
+
+    async def resolve(self):
+        """Expand each configured URL into one endpoint per address its host resolves to"""
+        loop = asyncio.get_running_loop()
+        urls = []
+        for url in map(httpx.URL, self.urls):
+            try:
+                addresses = await loop.getaddrinfo(url.host, url.port, type=socket.SOCK_STREAM)
+            except OSError as e:
+                print(f"Could not resolve {url.host}: {str(e)}")
+                return
+            for address in sorted({info[4][0] for info in addresses}):
+                urls.append(str(url.copy_with(host=address)))
+        known = {str(endpoint.url): endpoint for endpoint in self.endpoints}
+        self.endpoints = [known.get(url) or Endpoint(url) for url in urls] or self.endpoints
+
+    async def probe(self, endpoint: Endpoint):
+        request = httpx.Request("GET", endpoint.url.join(self.health_path),
+                                extensions={"timeout": {"connect": 2, "read": 2, "write": 2, "pool": 2}})
+        try:
+            response = await self.transport.handle_async_request(request)
+            await response.aread()
+            await response.aclose()
+            healthy = response.status_code == 200
+        except Exception:
+            healthy = False
+        if healthy != endpoint.healthy:
+            print(f"{endpoint.url} is now {'healthy' if healthy else 'unhealthy'}")
+        endpoint.healthy = healthy
+
+    async def probe_loop(self):
+        while True:
+            if self.discover:
+                await self.resolve()
+            await asyncio.gather(*[self.probe(endpoint) for endpoint in self.endpoints])
+            await asyncio.sleep(self.health_interval)
+
+    def stats(self):
+        return {"strategy": self.strategy, "endpoints": [endpoint.stats() for endpoint in self.endpoints]}
+
+    async def aclose(self):
+        if self.probe_task is not None:
+            self.probe_task.cancel()
+            await asyncio.gather(self.probe_task, return_exceptions=True)
+        await self.transport.aclose()
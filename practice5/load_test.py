@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import json
+import random
+import string
+import subprocess
+import sys
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from itertools import accumulate
+
+import httpx
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the Client Service /process endpoint")
+    parser.add_argument("--url", default=None,
+                        help="Live Client Service URL; the three services run in-process when omitted")
+    parser.add_argument("--token", default=None, help="APP_TOKEN, defaults to the client service setting")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Target requests per second across all workers; 0 sends as fast as possible")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=0, help="Run for this many seconds instead of --requests")
+    parser.add_argument("--payload-size", type=int, default=100, help="Bytes of content per request")
+    parser.add_argument("--users", type=int, default=1000, help="Number of distinct user_ids")
+    parser.add_argument("--distribution", choices=["uniform", "zipf", "hotkey"], default="uniform")
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="Zipf exponent, or the share of requests for the hot user with --distribution hotkey")
+    parser.add_argument("--delay", type=float, default=0,
+                        help="PROCESSING_DELAY of the in-process Business Logic Service")
+    parser.add_argument("--transport", choices=["asgi", "direct"], default="asgi",
+                        help="How the in-process gateway calls the other services")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file as well")
+    parser.add_argument("--compare", default=None,
+                        help="Earlier JSON report; exit with status 1 if throughput or p99 regressed")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed regression for --compare")
+    return parser.parse_args(argv)
+
+@asynccontextmanager
+async def in_process_gateway(token: str = None, processing_delay: float = 0, transport: str = "asgi"):
+    """
+    Run the database, business and client services in this process and yield an
+    httpx client for the gateway. Internal hops go through in-process transports,
+    "asgi" or "direct" (see local_transport.py).
+    """
+    import business_service
+    import client_service
+    import database_service
+    from local_transport import connect
+
+    saved_delay = business_service.PROCESSING_DELAY
+    business_service.PROCESSING_DELAY = processing_delay
+    async with AsyncExitStack() as stack:
+        stack.callback(setattr, business_service, "PROCESSING_DELAY", saved_delay)
+        for service in (database_service, business_service, client_service):
+            await stack.enter_async_context(service.app.router.lifespan_context(service.app))
+        for name, service in (("database", database_service), ("business", business_service)):
+            await client_service.http_clients[name].aclose()
+            client_service.http_clients[name] = client_service.create_http_client(
+                name, f"http://{name}-service", 30, transport=connect(service.app, transport)
+            )
+        gateway = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=client_service.app),
+            base_url="http://client-service",
+            headers={"Authorization": f"Bearer {token or client_service.APP_TOKEN}"},
+            timeout=60
+        )
+        await stack.enter_async_context(gateway)
+        yield gateway
+
+def user_sampler(args, rng):
+    users = [f"load_user_{i}" for i in range(args.users)]
+    if args.distribution == "uniform":
+        return lambda: rng.choice(users)
+    if args.distribution == "hotkey":
+        return lambda: users[0] if rng.random() < args.skew else rng.choice(users)
+    cumulative = list(accumulate(1 / (rank + 1) ** args.skew for rank in range(args.users)))
+    return lambda: rng.choices(users, cum_weights=cumulative)[0]
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run_load(client, args):
+    rng = random.Random(args.seed)
+    next_user = user_sampler(args, rng)
+    words = ["good", "bad", "service", "data", "great", "weather", "today", "request"]
+    latencies = []
+    statuses = {}
+    errors = 0
+    issued = 0
+    start = time.perf_counter()
+    deadline = start + args.duration if args.duration else None
+    interval = 1 / args.rate if args.rate else 0
+
+    def content():
+        text = []
+        length = 0
+        while length < args.payload_size:
+            word = rng.choice(words) if rng.random() < 0.5 else "".join(rng.choices(string.ascii_lowercase, k=6))
+            text.append(word)
+            length += len(word) + 1
+        return " ".join(text)[:args.payload_size]
+
+    async def worker():
+        nonlocal issued, errors
+        while True:
+            if deadline is not None:
+                if time.perf_counter() >= deadline:
+                    return
+            elif issued >= args.requests:
+                return
+            sequence = issued
+            issued += 1
+            if interval:
+                # Open-loop pacing: latency counts from the intended send time,
+                # so a slow server cannot hide queueing delay (coordinated omission)
+                scheduled = start + sequence * interval
+                await asyncio.sleep(max(0, scheduled - time.perf_counter()))
+            else:
+                scheduled = time.perf_counter()
+            payload = {"content": content(), "user_id": next_user()}
+            try:
+                response = await client.post("/process", json=payload)
+                status = str(response.status_code)
+                failed = response.status_code != 200 or "error" in response.json()
+            except Exception as e:
+                status = type(e).__name__
+                failed = True
+            latencies.append(time.perf_counter() - scheduled)
+            statuses[status] = statuses.get(status, 0) + 1
+            errors += failed
+
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("token", "output", "compare")},
+        "requests": len(latencies),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0,
+        "errors": errors,
+        "error_rate": round(errors / len(latencies), 4) if latencies else 0,
+        "status_codes": statuses,
+        "latency_ms": {
+            name: round(percentile(latencies, fraction) * 1000, 3) if latencies else None
+            for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))
+        }
+    }
+
+def compare(report, baseline, tolerance):
+    """Return the list of regressions of report against baseline"""
+    regressions = []
+    if report["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(f"throughput {report['throughput_rps']} < baseline {baseline['throughput_rps']}")
+    if report["latency_ms"]["p99"] > baseline["latency_ms"]["p99"] * (1 + tolerance):
+        regressions.append(f"p99 {report['latency_ms']['p99']}ms > baseline {baseline['latency_ms']['p99']}ms")
+    if report["error_rate"] > baseline["error_rate"] + tolerance / 10:
+        regressions.append(f"error rate {report['error_rate']} > baseline {baseline['error_rate']}")
+    return regressions
+
+async def main(argv=None):
+    args = parse_args(argv)
+    if args.url:
+        token = args.token
+        if token is None:
+            import client_service
+            token = client_service.APP_TOKEN
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=args.url, headers={"Authorization": f"Bearer {token}"},
+                                     limits=limits, timeout=60) as client:
+            report = await run_load(client, args)
+    else:
+        async with in_process_gateway(args.token, args.delay, args.transport) as client:
+            report = await run_load(client, args)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(output + "\n")
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,110 @@
+import asyncio
+import traceback
+
+import httpx
+from fastapi import FastAPI
+from starlette.routing import Match
+
+# How the Client Service reaches services running in its own process
+MODES = ("asgi", "direct")
+
+class DirectTransport(httpx.AsyncBaseTransport):
+    """
+    Calls the endpoint of a FastAPI app that lives in this process, without
+    sockets or the app's middleware stack: the request is matched against the
+    app's routes and handed to the route itself. The route still parses the
+    body, checks the Bearer token through its dependencies and encodes the
+    reply, exactly as it does for a network request.
+
+    Skipping the middleware means the downstream app records no request
+    metrics and no trace of its own; its spans join the caller's trace
+    instead. An exception the app does not handle becomes a 500 response,
+    as it would over the network.
+    """
+
+    def __init__(self, app: FastAPI):
+        self.app = app
+        # What ExceptionMiddleware puts in the scope for the routes' error handling
+        handlers = app.exception_handlers
+        self.exception_handlers = ({key: value for key, value in handlers.items() if not isinstance(key, int)},
+                                   {key: value for key, value in handlers.items() if isinstance(key, int)})
+
+    def scope(self, request: httpx.Request):
+        return {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": request.method,
+            "headers": [(name.lower(), value) for name, value in request.headers.raw],
+            "scheme": request.url.scheme,
+            "path": request.url.path,
+            "raw_path": request.url.raw_path.split(b"?")[0],
+            "query_string": request.url.query,
+            "root_path": "",
+            "server": (request.url.host, request.url.port),
+            "client": ("127.0.0.1", 0),
+            "app": self.app,
+            "starlette.exception_handlers": self.exception_handlers
+        }
+
+    def route(self, scope):
+        """The route for scope with its path parameters, or a 404/405 status"""
+        partial = None
+        for route in self.app.router.routes:
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                return route, child_scope
+            if match == Match.PARTIAL and partial is None:
+                partial = route
+        return None, 405 if partial is not None else 404
+
+    async def handle_async_request(self, request: httpx.Request):
+        body = await request.aread()
+        scope = self.scope(request)
+        route, child_scope = self.route(scope)
+        if route is None:
+            return httpx.Response(child_scope, json={"detail": "Method Not Allowed" if child_scope == 405
+                                                     else "Not Found"})
+        scope.update(child_scope)
+        received = False
+        complete = asyncio.Event()
+        status_code = 500
+        headers = []
+        body_parts = []
+
+        async def receive():
+            nonlocal received
+            if received:
+                # Streaming responses listen for a disconnect while they send
+                await complete.wait()
+                return {"type": "http.disconnect"}
+            received = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            nonlocal status_code, headers
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                body_parts.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    complete.set()
+
+        try:
+            await route.handle(scope, receive, send)
+        except Exception:
+            traceback.print_exc()
+            return httpx.Response(500, text="Internal Server Error")
+        finally:
+            complete.set()
+        return httpx.Response(status_code, headers=headers, content=b"".join(body_parts))
+
+def connect(app: FastAPI, mode: str):
+    """Transport to an app in this process: through its full ASGI stack, or straight to its routes"""
+    if mode == "asgi":
+        # Unhandled errors come back as a 500 response instead of being raised, like over the network
+        return httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    if mode == "direct":
+        return DirectTransport(app)
+    raise ValueError(f"Unknown in-process transport {mode}, expected one of {MODES}")
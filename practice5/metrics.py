@@ -0,0 +1,213 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Tuple
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from starlette.routing import Match
+
+# Latency buckets in seconds, from sub-millisecond hops up to the slow business call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def escape(value: str):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = ""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], object] = {}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, *labels: str, value: float):
+        self.values[labels] = value
+
+class CallbackGauge(Metric):
+    """Gauge whose value is computed when /metrics is scraped, so it costs nothing on the hot path"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, callback: Callable[[], float]):
+        super().__init__(name, help_text)
+        self.callback = callback
+
+    def render(self):
+        return self.header() + [f"{self.name} {self.callback()}"]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str):
+        state = self.values.get(labels)
+        if state is None:
+            # Per-bucket counts (made cumulative on export), then sum and count
+            state = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self.values[labels] = state
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self):
+        lines = self.header()
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                bucket_labels = format_labels(self.labels, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        # Re-registering returns the existing metric, so modules can be re-imported safely
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        return self.register(Gauge(name, help_text, labels))
+
+    def callback_gauge(self, name: str, help_text: str, callback: Callable[[], float]):
+        metric = CallbackGauge(name, help_text, callback)
+        self.metrics[name] = metric
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+REQUESTS = registry.counter("http_requests_total", "HTTP requests handled",
+                            ("service", "method", "route", "status"))
+IN_PROGRESS = registry.gauge("http_requests_in_progress", "HTTP requests currently being handled",
+                             ("service", "method", "route"))
+LATENCY = registry.histogram("http_request_duration_seconds", "HTTP request latency",
+                             ("service", "method", "route", "status"))
+DOWNSTREAM_LATENCY = registry.histogram("downstream_request_duration_seconds",
+                                        "Latency of calls to other services",
+                                        ("service", "downstream", "method", "route", "status"))
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware (no BaseHTTPMiddleware) recording request counts,
+    in-flight requests and latency per route template and status.
+    """
+
+    def __init__(self, app, service: str, fastapi_app: FastAPI):
+        self.app = app
+        self.service = service
+        self.fastapi_app = fastapi_app
+        self.static_routes = None
+
+    def route_template(self, scope):
+        # Routes without path parameters are resolved with one dict lookup
+        if self.static_routes is None:
+            self.static_routes = {route.path: route.path for route in self.fastapi_app.routes
+                                  if "{" not in getattr(route, "path", "{")}
+        path = self.static_routes.get(scope["path"])
+        if path is not None:
+            return path
+        for route in self.fastapi_app.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        route = self.route_template(scope)
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        IN_PROGRESS.inc(self.service, method, route)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            IN_PROGRESS.dec(self.service, method, route)
+            REQUESTS.inc(self.service, method, route, status)
+            LATENCY.observe(time.perf_counter() - start, self.service, method, route, status)
+
+class MeasuredTransport(httpx.AsyncBaseTransport):
+    """Wraps an httpx transport to record per-hop latency to a downstream service"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, service: str, downstream: str):
+        self.transport = transport
+        self.service = service
+        self.downstream = downstream
+
+    async def handle_async_request(self, request):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await self.transport.handle_async_request(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            DOWNSTREAM_LATENCY.observe(time.perf_counter() - start, self.service, self.downstream,
+                                       request.method, request.url.path, status)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+def instrument(app: FastAPI, service: str):
+    """Add the metrics middleware and a /metrics endpoint in the Prometheus text format"""
+    app.add_middleware(MetricsMiddleware, service=service, fastapi_app=app)
+
+    async def metrics():
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+    app.add_api_route("/metrics", metrics, methods=["GET"], include_in_schema=False)
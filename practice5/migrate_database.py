@@ -0,0 +1,50 @@
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Copy every user from one Database Service to another")
+    parser.add_argument("source", help="Source Database Service URL, e.g. http://old-host:8002")
+    parser.add_argument("target", help="Target Database Service URL")
+    parser.add_argument("--token", default=os.getenv("INTERNAL_SERVICE_TOKEN", "YourInternalToken"))
+    parser.add_argument("--no-history", action="store_true", help="Copy records only")
+    parser.add_argument("--keep-existing", action="store_true", help="Do not overwrite users the target already has")
+    return parser.parse_args()
+
+async def migrate(args):
+    """Pipe the source's /scan stream straight into the target's /import, without buffering it"""
+    headers = {"Authorization": f"Bearer {args.token}"}
+    timeout = httpx.Timeout(60, read=None, write=None)
+    transferred = 0
+    async with httpx.AsyncClient(headers=headers, timeout=timeout) as client:
+        async with client.stream("GET", f"{args.source}/scan",
+                                 params={"include_history": str(not args.no_history).lower()}) as scan:
+            scan.raise_for_status()
+
+            async def body():
+                nonlocal transferred
+                async for chunk in scan.aiter_raw():
+                    transferred += len(chunk)
+                    yield chunk
+
+            response = await client.post(f"{args.target}/import", content=body(),
+                                         params={"overwrite": str(not args.keep_existing).lower()},
+                                         headers={"Content-Type": "application/x-ndjson"})
+            response.raise_for_status()
+    return response.json(), transferred
+
+def main():
+    args = parse_args()
+    start = time.perf_counter()
+    result, transferred = asyncio.run(migrate(args))
+    elapsed = time.perf_counter() - start
+    print(f"{result['imported']:,} users imported, {result['skipped']:,} skipped, {result['failed']:,} failed "
+          f"({transferred / 2**20:.1f} MB in {elapsed:.1f}s)")
+    for error in result["errors"]:
+        print(f"line {error['line']}: {error['error']}")
+
+if __name__ == "__main__":
+    main()
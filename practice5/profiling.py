@@ -0,0 +1,234 @@
+import asyncio
+import marshal
+import os
+import secrets
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse, Response
+
+# On-demand profiling under /debug; when off the endpoints are not even registered
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+# Bearer token for /debug, separate from the service tokens; profiling stays off without one
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILING_MAX_SECONDS = float(os.getenv("PROFILING_MAX_SECONDS", "60"))
+
+# Only one CPU profile and one loop watch at a time per process, whichever app they are asked from
+running = set()
+# Previous tracemalloc snapshot, for the diff of the next one
+last_snapshot = None
+
+def validate_debug_token(authorization: str = Header(None)):
+    if not authorization or not secrets.compare_digest(authorization, f"Bearer {PROFILING_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid debug token")
+
+def exclusive(name: str):
+    if name in running:
+        raise HTTPException(status_code=409, detail=f"A {name} is already running")
+    running.add(name)
+
+def function_key(code):
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+def stack_of(frame):
+    """Functions on a thread's stack, outermost first"""
+    stack = []
+    while frame is not None:
+        stack.append(function_key(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def label(function):
+    filename, line, name = function
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+def sample(seconds: float, interval: float, thread_ids):
+    """
+    Count the stacks of the given threads (all but this one when None) every
+    interval seconds. Runs in its own thread, so the sampled code pays only for
+    sys._current_frames() holding the GIL briefly.
+    """
+    own = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    samples = Counter()
+    rounds = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident != own and (thread_ids is None or ident in thread_ids):
+                samples[(names.get(ident, str(ident)), tuple(stack_of(frame)))] += 1
+        rounds += 1
+        time.sleep(interval)
+    return samples, rounds
+
+def collapsed(samples):
+    """One "thread;outer;...;inner count" line per stack, the input of flamegraph.pl and speedscope"""
+    lines = [";".join([thread] + [label(function) for function in stack]) + f" {count}"
+             for (thread, stack), count in samples.most_common()]
+    return "\n".join(lines) + "\n"
+
+def to_pstats(samples, interval: float):
+    """
+    The samples as a pstats file (what cProfile's dump_stats writes), with
+    times estimated as samples x interval; call counts are sample counts.
+    """
+    stats = {}
+    for (_, stack), count in samples.items():
+        seconds = count * interval
+        seen = set()
+        for depth, function in enumerate(stack):
+            entry = stats.setdefault(function, [0, 0, 0.0, 0.0, {}])
+            leaf = depth == len(stack) - 1
+            entry[1] += count
+            if function not in seen:
+                # Recursive calls count towards the inclusive time once
+                seen.add(function)
+                entry[0] += count
+                entry[3] += seconds
+            if leaf:
+                entry[2] += seconds
+            if depth > 0:
+                caller = entry[4].setdefault(stack[depth - 1], [0, 0, 0.0, 0.0])
+                caller[0] += count
+                caller[1] += count
+                caller[2] += seconds if leaf else 0.0
+                caller[3] += seconds
+    return marshal.dumps({function: (cc, nc, tt, ct, {caller: tuple(value) for caller, value in callers.items()})
+                          for function, (cc, nc, tt, ct, callers) in stats.items()})
+
+async def cpu_profile(seconds: float = Query(10, gt=0, le=PROFILING_MAX_SECONDS),
+                      interval: float = Query(0.005, ge=0.001, le=1),
+                      threads: str = Query("loop", pattern="^(loop|all)$"),
+                      format: str = Query("collapsed", pattern="^(collapsed|pstats)$")):
+    """
+    Sample the event loop thread (or every thread, e.g. executor workers) for
+    seconds and return collapsed stacks, or a pstats file for pstats/snakeviz
+    """
+    exclusive("CPU profile")
+    try:
+        thread_ids = None if threads == "all" else {threading.get_ident()}
+        samples, rounds = await asyncio.to_thread(sample, seconds, interval, thread_ids)
+    finally:
+        running.discard("CPU profile")
+    headers = {"X-Profile-Samples": str(rounds)}
+    if format == "pstats":
+        return Response(to_pstats(samples, interval), media_type="application/octet-stream",
+                        headers={**headers, "Content-Disposition": "attachment; filename=profile.pstats"})
+    return PlainTextResponse(collapsed(samples), headers=headers)
+
+async def watch_loop(seconds: float = Query(10, gt=0, le=PROFILING_MAX_SECONDS),
+                     threshold: float = Query(0.1, gt=0),
+                     interval: float = Query(0.01, ge=0.001, le=1)):
+    """
+    Measure event loop lag for seconds: a task that sleeps interval records how
+    late it wakes up, and a watchdog thread takes the loop thread's stack when
+    no wake-up happened for threshold seconds, i.e. while a callback blocks it.
+    """
+    exclusive("loop watch")
+    loop_thread = threading.get_ident()
+    beats = [time.monotonic()]
+    stalls = []
+    stop = threading.Event()
+
+    def watchdog():
+        reported = None
+        while not stop.wait(threshold / 4):
+            beat = beats[-1]
+            if time.monotonic() - beat > threshold and beat != reported:
+                reported = beat
+                frame = sys._current_frames().get(loop_thread)
+                stalls.append({"since": beat, "stack": [label(function) for function in stack_of(frame)]})
+
+    watcher = threading.Thread(target=watchdog, name="loop-watchdog", daemon=True)
+    lags = []
+    try:
+        watcher.start()
+        deadline = beats[0] + seconds
+        while beats[-1] < deadline:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            lags.append(now - expected)
+            beats.append(now)
+    finally:
+        stop.set()
+        await asyncio.to_thread(watcher.join)
+        running.discard("loop watch")
+    for stall in stalls:
+        # The stall ended at the first wake-up after it began
+        following = next((beat for beat in beats if beat > stall["since"]), None)
+        stall["seconds"] = round(following - stall.pop("since"), 4) if following else None
+    lags.sort()
+    pick = lambda fraction: round(lags[min(len(lags) - 1, int(fraction * len(lags)))] * 1000, 3)
+    return {
+        "seconds": seconds,
+        "wakeups": len(lags),
+        "lag_ms": {"p50": pick(0.5), "p99": pick(0.99), "max": round(lags[-1] * 1000, 3)} if lags else None,
+        "threshold": threshold,
+        "slow_callbacks": stalls
+    }
+
+async def tracemalloc_start(frames: int = Query(10, ge=1, le=100)):
+    """Start tracing allocations; every allocation costs more until it is stopped"""
+    global last_snapshot
+    if tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="tracemalloc is already tracing")
+    last_snapshot = None
+    tracemalloc.start(frames)
+    return {"tracing": True, "frames": frames}
+
+def allocation_stats(group_by: str, top: int):
+    global last_snapshot
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+    ])
+    statistics = [{"where": str(stat.traceback), "size_bytes": stat.size, "count": stat.count}
+                  for stat in snapshot.statistics(group_by)[:top]]
+    diff = None
+    if last_snapshot is not None:
+        diff = [{"where": str(stat.traceback), "size_diff_bytes": stat.size_diff, "count_diff": stat.count_diff,
+                 "size_bytes": stat.size} for stat in snapshot.compare_to(last_snapshot, group_by)[:top]]
+    last_snapshot = snapshot
+    return statistics, diff
+
+async def tracemalloc_snapshot(top: int = Query(20, ge=1, le=1000),
+                               group_by: str = Query("lineno", pattern="^(lineno|filename|traceback)$")):
+    """Top allocations now, and the biggest changes since the previous snapshot"""
+    if not tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="tracemalloc is not tracing, POST /debug/tracemalloc/start")
+    current, peak = tracemalloc.get_traced_memory()
+    statistics, diff = await asyncio.to_thread(allocation_stats, group_by, top)
+    return {"traced_bytes": current, "peak_bytes": peak, "top": statistics, "diff_since_last": diff}
+
+async def tracemalloc_stop():
+    global last_snapshot
+    tracemalloc.stop()
+    last_snapshot = None
+    return {"tracing": False}
+
+def enable_profiling(app: FastAPI, service: str):
+    """
+    Add the token-protected /debug endpoints when PROFILING_ENABLED is set;
+    otherwise nothing is added, so the service runs exactly as without them
+    """
+    if not PROFILING_ENABLED:
+        return
+    if not PROFILING_TOKEN:
+        print(f"WARNING: PROFILING_ENABLED is set but PROFILING_TOKEN is empty, /debug stays off for {service}")
+        return
+    protected = [Depends(validate_debug_token)]
+    for path, endpoint, methods in (
+        ("/debug/profile", cpu_profile, ["GET"]),
+        ("/debug/loop", watch_loop, ["GET"]),
+        ("/debug/tracemalloc/start", tracemalloc_start, ["POST"]),
+        ("/debug/tracemalloc", tracemalloc_snapshot, ["GET"]),
+        ("/debug/tracemalloc/stop", tracemalloc_stop, ["POST"])
+    ):
+        app.add_api_route(path, endpoint, methods=methods, dependencies=protected, include_in_schema=False)
+    print(f"Profiling endpoints enabled for {service} under /debug")
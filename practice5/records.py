@@ -0,0 +1,184 @@
+import sys
+import time
+from array import array
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+ANALYSIS_FIELDS = ("word_count", "character_count", "sentiment", "processing_id")
+METADATA_FIELDS = ("last_updated", "version", "history_length")
+HISTORY_FIELDS = ("timestamp", "word_count", "sentiment")
+# Label code marking a history entry that did not fit the columns and is kept as a dict
+RAW_ENTRY = 255
+MAX_COUNT = 2 ** 32 - 1
+
+# Sentiment labels are few, so history stores one byte per entry and the strings once
+labels = []
+label_codes = {}
+
+def label_code(label: str):
+    code = label_codes.get(label)
+    if code is None:
+        if len(labels) >= RAW_ENTRY:
+            return None
+        code = len(labels)
+        labels.append(sys.intern(label))
+        label_codes[labels[code]] = code
+    return code
+
+@lru_cache(maxsize=4096)
+def parse_timestamp(text: str):
+    """Epoch seconds for a local TIMESTAMP_FORMAT string, or None when it would not format back identically"""
+    try:
+        epoch = int(time.mktime(time.strptime(text, TIMESTAMP_FORMAT)))
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return epoch if format_timestamp(epoch) == text else None
+
+@lru_cache(maxsize=4096)
+def format_timestamp(epoch: int):
+    return time.strftime(TIMESTAMP_FORMAT, time.localtime(epoch))
+
+def is_count(value):
+    return type(value) is int and 0 <= value <= MAX_COUNT
+
+class Record:
+    """
+    A stored record of the usual {"analysis": ..., "metadata": ...} shape as
+    plain slots. compact_record keeps records of any other shape as dicts.
+    """
+    __slots__ = ("word_count", "character_count", "sentiment", "processing_id", "updated", "version",
+                 "history_length")
+
+    def to_dict(self):
+        return {
+            "analysis": {
+                "word_count": self.word_count,
+                "character_count": self.character_count,
+                "sentiment": self.sentiment,
+                "processing_id": self.processing_id
+            },
+            "metadata": {
+                "last_updated": format_timestamp(self.updated),
+                "version": self.version,
+                "history_length": self.history_length
+            }
+        }
+
+def compact_record(data):
+    """Record for data of the usual shape, otherwise data itself"""
+    analysis = data.get("analysis")
+    metadata = data.get("metadata")
+    if (len(data) != 2 or type(analysis) is not dict or type(metadata) is not dict
+            or tuple(analysis) != ANALYSIS_FIELDS or tuple(metadata) != METADATA_FIELDS):
+        return data
+    updated = parse_timestamp(metadata["last_updated"])
+    if (updated is None or type(analysis["sentiment"]) is not str or type(analysis["processing_id"]) is not str
+            or not all(type(value) is int for value in (analysis["word_count"], analysis["character_count"],
+                                                        metadata["version"], metadata["history_length"]))):
+        return data
+    record = Record()
+    record.word_count = analysis["word_count"]
+    record.character_count = analysis["character_count"]
+    record.sentiment = sys.intern(analysis["sentiment"])
+    record.processing_id = analysis["processing_id"]
+    record.updated = updated
+    record.version = metadata["version"]
+    record.history_length = metadata["history_length"]
+    return record
+
+def expand_record(value):
+    return value.to_dict() if type(value) is Record else value
+
+def record_version(value):
+    if value is None:
+        return 0
+    if type(value) is Record:
+        return value.version
+    return value.get("metadata", {}).get("version", 0)
+
+class History:
+    """
+    One user's process history stored column-wise: epoch timestamps, word
+    counts and sentiment label codes in typed arrays. Entries of any other
+    shape are kept as dicts, in order, and marked with RAW_ENTRY. Iterating
+    or slicing yields the original entry dicts.
+
+    A capped history drops its oldest entry by moving the start offset; the
+    dropped slots are cut off in one go once there are maxlen of them, so an
+    append stays O(1) amortized instead of shifting the whole arrays.
+    """
+    __slots__ = ("timestamps", "word_counts", "sentiments", "raw", "maxlen", "start")
+
+    def __init__(self, entries=(), maxlen: int = None):
+        self.timestamps = array("q")
+        self.word_counts = array("I")
+        self.sentiments = array("B")
+        self.raw = None
+        self.maxlen = maxlen
+        self.start = 0
+        for entry in entries:
+            self.append(entry)
+
+    def __len__(self):
+        return len(self.sentiments) - self.start
+
+    def append(self, entry):
+        """Append an entry, dropping the oldest one when the history is full; returns True if one was dropped"""
+        dropped = self.maxlen is not None and len(self) >= self.maxlen
+        if dropped:
+            if self.sentiments[self.start] == RAW_ENTRY:
+                self.raw.popleft()
+            self.start += 1
+            if self.start >= self.maxlen:
+                del self.timestamps[:self.start], self.word_counts[:self.start], self.sentiments[:self.start]
+                self.start = 0
+        code = None
+        if type(entry) is dict and tuple(entry) == HISTORY_FIELDS and is_count(entry["word_count"]):
+            timestamp = parse_timestamp(entry["timestamp"])
+            if timestamp is not None and type(entry["sentiment"]) is str:
+                code = label_code(entry["sentiment"])
+        if code is None:
+            if self.raw is None:
+                self.raw = deque()
+            self.raw.append(entry)
+            timestamp, word_count, code = 0, 0, RAW_ENTRY
+        else:
+            word_count = entry["word_count"]
+        self.timestamps.append(timestamp)
+        self.word_counts.append(word_count)
+        self.sentiments.append(code)
+        return dropped
+
+    def entries(self, start: int = 0, stop: int = None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        start, stop = start + self.start, stop + self.start
+        raw = None
+        if self.raw is not None:
+            # Raw entries before start are skipped by counting their markers
+            raw = islice(self.raw, self.sentiments[self.start:start].count(RAW_ENTRY), None)
+        for index in range(start, stop):
+            code = self.sentiments[index]
+            if code == RAW_ENTRY:
+                yield next(raw)
+            else:
+                yield {"timestamp": format_timestamp(self.timestamps[index]),
+                       "word_count": self.word_counts[index], "sentiment": labels[code]}
+
+    def __iter__(self):
+        return self.entries()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError("History only supports contiguous slices")
+        start, stop, _ = index.indices(len(self))
+        return list(self.entries(start, stop))
+
+    def copy(self):
+        history = History(maxlen=self.maxlen)
+        history.timestamps = self.timestamps[self.start:]
+        history.word_counts = self.word_counts[self.start:]
+        history.sentiments = self.sentiments[self.start:]
+        history.raw = deque(self.raw) if self.raw is not None else None
+        return history
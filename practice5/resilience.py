@@ -0,0 +1,263 @@
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from typing import Iterable
+
+import httpx
+
+class CircuitOpen(httpx.TransportError):
+    """Raised instead of calling a downstream service whose circuit breaker is open"""
+
+    def __init__(self, message: str, retry_after: float = 0, request: httpx.Request = None):
+        super().__init__(message, request=request)
+        self.retry_after = retry_after
+
+class DownstreamError(Exception):
+    """A downstream call that failed, to be answered with status_code (and Retry-After when it is set)"""
+
+    def __init__(self, status_code: int, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = None if retry_after is None else max(1, math.ceil(retry_after))
+
+def downstream_error(message: str, error: Exception = None, response: httpx.Response = None):
+    """
+    The DownstreamError for a call that raised error or answered with an
+    unexpected response: 503 with Retry-After while the service is unavailable
+    (open circuit, connection failure, or its own 503), 504 for a timeout,
+    400 or 422 when the service found the request itself invalid, and 502 for
+    anything else it answered.
+    """
+    if isinstance(error, CircuitOpen):
+        return DownstreamError(503, f"{message}: {error}", error.retry_after)
+    if isinstance(error, httpx.TimeoutException):
+        return DownstreamError(504, f"{message}: timed out ({type(error).__name__})")
+    if error is not None:
+        return DownstreamError(503, f"{message}: {error}", 1)
+    if response.status_code == 503:
+        retry_after = response.headers.get("retry-after", "1")
+        return DownstreamError(503, f"{message}: {response.text}", float(retry_after) if retry_after.isdigit() else 1)
+    if response.status_code in (400, 422, 504):
+        return DownstreamError(response.status_code, f"{message}: {response.text}")
+    return DownstreamError(502, f"{message}: {response.text}")
+
+class CircuitBreaker:
+    """
+    Closed: calls pass and consecutive failures are counted.
+    Open: calls fail immediately for reset_timeout seconds.
+    Half-open: up to half_open_requests trial calls pass; one success closes
+    the circuit again, one failure re-opens it.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 10,
+                 half_open_requests: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_requests = half_open_requests
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trials = 0
+        self.counters = {"opened": 0, "rejected": 0}
+
+    def allow(self):
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self.trials = 0
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and self.trials < self.half_open_requests:
+            self.trials += 1
+            return True
+        self.counters["rejected"] += 1
+        return False
+
+    def retry_after(self):
+        """Seconds until an open circuit lets a trial call through"""
+        return max(0, self.reset_timeout - (time.monotonic() - self.opened_at)) if self.state == "open" else 0
+
+    def abandon(self):
+        """A call let through by allow() was cancelled before it had an outcome"""
+        if self.state == "half_open":
+            self.trials -= 1
+
+    def record(self, failed: bool):
+        if not failed:
+            if self.state != "closed":
+                print(f"Circuit for {self.name} closed")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            return
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                print(f"Circuit for {self.name} opened after {self.consecutive_failures} failures")
+                self.counters["opened"] += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "open_for_seconds": round(time.monotonic() - self.opened_at, 1) if self.state != "closed" else None,
+            **self.counters
+        }
+
+class RetryBudget:
+    """
+    Token bucket that keeps retries (and hedges) to a fraction of the traffic:
+    every request deposits ratio tokens, every retry spends one, and
+    min_per_second tokens are added over time so idle services can still retry.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 5, capacity: float = 20):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.counters = {"retries": 0, "exhausted": 0}
+
+    def refill(self, amount: float = 0):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.min_per_second + amount)
+        self.updated = now
+
+    def deposit(self):
+        self.refill(self.ratio)
+
+    def withdraw(self):
+        self.refill()
+        if self.tokens < 1:
+            self.counters["exhausted"] += 1
+            return False
+        self.tokens -= 1
+        self.counters["retries"] += 1
+        return True
+
+    def stats(self):
+        self.refill()
+        return {"tokens": round(self.tokens, 2), **self.counters}
+
+def copy_request(request: httpx.Request):
+    """Independent copy for another attempt, since transports may rewrite the URL"""
+    return httpx.Request(request.method, request.url, headers=request.headers, content=request.content,
+                         extensions=request.extensions)
+
+def failed(response: httpx.Response):
+    return response.status_code >= 500
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    """
+    Guards one downstream service: a circuit breaker sheds calls while it is
+    failing, idempotent methods are retried within the retry budget, and
+    requests to hedge_paths get a second attempt (usually on another replica)
+    once the first is slower than the hedge_percentile of recent latencies.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, breaker: CircuitBreaker, budget: RetryBudget,
+                 retries: int = 2, retry_backoff: float = 0.05, retry_methods: Iterable[str] = ("GET", "HEAD"),
+                 hedge_paths: Iterable[str] = (), hedge_percentile: float = 0.95, hedge_min_delay: float = 0.01,
+                 hedge_min_samples: int = 20):
+        self.transport = transport
+        self.breaker = breaker
+        self.budget = budget
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_methods = set(retry_methods)
+        self.hedge_paths = set(hedge_paths)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = {path: deque(maxlen=1000) for path in self.hedge_paths}
+        self.counters = {"hedged": 0, "hedge_wins": 0}
+
+    async def attempt(self, request):
+        if not self.breaker.allow():
+            raise CircuitOpen(f"Circuit breaker for {self.breaker.name} service is open", self.breaker.retry_after(),
+                              request=request)
+        try:
+            response = await self.transport.handle_async_request(request)
+        except asyncio.CancelledError:
+            self.breaker.abandon()
+            raise
+        except Exception:
+            self.breaker.record(True)
+            raise
+        self.breaker.record(failed(response))
+        return response
+
+    def hedge_delay(self, path: str):
+        latencies = self.latencies.get(path)
+        if latencies is None or len(latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(latencies)
+        return max(self.hedge_min_delay, ordered[min(len(ordered) - 1, int(self.hedge_percentile * len(ordered)))])
+
+    async def hedged(self, request, delay: float):
+        first = asyncio.create_task(self.attempt(request))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not self.budget.withdraw():
+            return await first
+        self.counters["hedged"] += 1
+        second = asyncio.create_task(self.attempt(copy_request(request)))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if not task.exception() and not failed(task.result())]
+                if winners:
+                    if winners[0] is second:
+                        self.counters["hedge_wins"] += 1
+                    for task in done:
+                        if task is not winners[0] and not task.exception():
+                            await task.result().aclose()
+                    return winners[0].result()
+            # Both attempts failed; report the first one's outcome
+            if not second.exception():
+                await second.result().aclose()
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def handle_async_request(self, request):
+        self.budget.deposit()
+        path = request.url.path
+        delay = self.hedge_delay(path)
+        start = time.perf_counter()
+        if delay is not None:
+            response = await self.hedged(request, delay)
+        elif request.method in self.retry_methods:
+            response = await self.with_retries(request)
+        else:
+            response = await self.attempt(request)
+        if path in self.latencies and not failed(response):
+            self.latencies[path].append(time.perf_counter() - start)
+        return response
+
+    async def with_retries(self, request):
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                response = await self.attempt(request if attempt == 0 else copy_request(request))
+            except CircuitOpen:
+                raise
+            except httpx.TransportError:
+                if last or not self.budget.withdraw():
+                    raise
+            else:
+                if not failed(response) or last or not self.budget.withdraw():
+                    return response
+                await response.aclose()
+            await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+
+    def stats(self):
+        return {"circuit": self.breaker.stats(), "retry_budget": self.budget.stats(), **self.counters}
+
+    async def aclose(self):
+        await self.transport.aclose()
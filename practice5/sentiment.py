@@ -0,0 +1,98 @@
+import hashlib
+import os
+from itertools import repeat
+from typing import Dict, List
+
+# Bump whenever the analysis logic changes so cached results are not reused
+ANALYZER_VERSION = "2"
+
+# Optional lexicon file: one "<word> <label>" per line, where label is
+# positive, negative or a signed numeric weight. Lines starting with # are ignored.
+SENTIMENT_LEXICON_FILE = os.getenv("SENTIMENT_LEXICON_FILE", "")
+
+POSITIVE_WORDS = ["good", "great", "excellent", "happy", "positive", "nice", "love", "like"]
+NEGATIVE_WORDS = ["bad", "terrible", "awful", "sad", "negative", "hate", "dislike"]
+
+class Lexicon:
+    """
+    Precompiled word -> weight table (+1 positive, -1 negative by default).
+    Lookups are single hash probes, so scoring is linear in the document size
+    instead of scanning the word lists for every token.
+    """
+
+    def __init__(self, weights: Dict[str, float]):
+        self.weights = weights
+        digest = hashlib.sha256()
+        for word, weight in sorted(weights.items()):
+            digest.update(f"{word}={weight}\n".encode())
+        self.fingerprint = digest.hexdigest()[:16]
+
+    @classmethod
+    def default(cls):
+        weights = {word: 1.0 for word in POSITIVE_WORDS}
+        weights.update({word: -1.0 for word in NEGATIVE_WORDS})
+        return cls(weights)
+
+    @classmethod
+    def from_file(cls, path: str):
+        weights = {}
+        with open(path, encoding="utf-8") as lexicon_file:
+            for line_number, line in enumerate(lexicon_file, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                parts = line.replace(",", " ").replace("\t", " ").split()
+                if len(parts) != 2:
+                    raise ValueError(f"{path}:{line_number}: expected '<word> <label>'")
+                word, label = parts
+                if label == "positive":
+                    weight = 1.0
+                elif label == "negative":
+                    weight = -1.0
+                else:
+                    weight = float(label)
+                weights[word.lower()] = weight
+        return cls(weights)
+
+    def score(self, words: List[str]):
+        return sum(map(self.weights.get, words, repeat(0.0)))
+
+def load_lexicon():
+    if SENTIMENT_LEXICON_FILE:
+        return Lexicon.from_file(SENTIMENT_LEXICON_FILE)
+    return Lexicon.default()
+
+lexicon = load_lexicon()
+
+def label(score: float):
+    if score > 0:
+        return "positive"
+    if score < 0:
+        return "negative"
+    return "neutral"
+
+def analyze(content: str, lexicon: Lexicon = lexicon):
+    """
+    Count words/characters and classify sentiment with a single tokenization pass
+    """
+    words = content.lower().split()
+    return {
+        "word_count": len(words),
+        "character_count": len(content),
+        "sentiment": label(lexicon.score(words))
+    }
+
+def analyze_many(contents: List[str], lexicon: Lexicon = lexicon):
+    """
+    Score many documents in one call, with the lexicon lookup bound once for the batch
+    """
+    get_weight = lexicon.weights.get
+    results = []
+    for content in contents:
+        words = content.lower().split()
+        results.append({
+            "word_count": len(words),
+            "character_count": len(content),
+            "sentiment": label(sum(map(get_weight, words, repeat(0.0))))
+        })
+    return results
@@ -0,0 +1,253 @@
+import asyncio
+import hashlib
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List
+
+import httpx
+
+HASH_SPACE = 2 ** 64
+
+def key_hash(key: str):
+    """Stable 64-bit hash, the same in every process (unlike hash())"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    """
+    Consistent hash ring with vnodes points per node. A key belongs to the
+    node of the first point at or after its hash, so adding a node only moves
+    the keys of the arcs its points take over, about 1/(nodes + 1) of them.
+    """
+
+    def __init__(self, nodes: Iterable[str], vnodes: int = 128):
+        self.nodes = list(nodes)
+        self.vnodes = vnodes
+        points = sorted((key_hash(f"{node}#{index}"), node) for node in self.nodes for index in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, hashed: int):
+        index = bisect_left(self.hashes, hashed)
+        return self.owners[index if index < len(self.hashes) else 0]
+
+    def node_for(self, key: str):
+        return self.owner(key_hash(key))
+
+    def with_node(self, node: str):
+        return HashRing(self.nodes + [node], self.vnodes)
+
+    def shares(self):
+        """Fraction of the hash space each node owns"""
+        shares = dict.fromkeys(self.nodes, 0)
+        previous = self.hashes[-1] - HASH_SPACE
+        for point, node in zip(self.hashes, self.owners):
+            shares[node] += point - previous
+            previous = point
+        return {node: share / HASH_SPACE for node, share in shares.items()}
+
+    def moved_ranges(self, target: "HashRing"):
+        """{old node: hash ranges} of every part of the ring whose owner differs in target"""
+        points = sorted(set(self.hashes) | set(target.hashes))
+        moved = {}
+        previous = -1
+        for point in points + [HASH_SPACE - 1]:
+            source = self.owner(point)
+            if source != target.owner(point):
+                ranges = moved.setdefault(source, [])
+                if ranges and ranges[-1][1] == previous:
+                    ranges[-1] = (ranges[-1][0], point)
+                else:
+                    ranges.append((previous, point))
+            previous = point
+        return moved
+
+class HashRanges:
+    """Keys whose hash lies in one of the (low, high] ranges"""
+
+    def __init__(self, ranges):
+        self.ranges = sorted(ranges)
+        self.highs = [high for _, high in self.ranges]
+
+    @classmethod
+    def parse(cls, text: str):
+        """Ranges written as "low:high,low:high"; raises ValueError when malformed"""
+        ranges = []
+        for part in text.split(","):
+            low, high = map(int, part.split(":"))
+            if not -1 <= low < high < HASH_SPACE:
+                raise ValueError(f"Invalid hash range {part}")
+            ranges.append((low, high))
+        return cls(ranges)
+
+    def format(self):
+        return ",".join(f"{low}:{high}" for low, high in self.ranges)
+
+    def __contains__(self, key: str):
+        hashed = key_hash(key)
+        index = bisect_left(self.highs, hashed)
+        return index < len(self.ranges) and self.ranges[index][0] < hashed
+
+class ShardingTransport(httpx.AsyncBaseTransport):
+    """
+    Routes each request to the shard that owns its key on a consistent hash
+    ring, by rewriting the request URL like BalancingTransport. Callers pass
+    the user IDs a request touches in the "shard_keys" request extension (see
+    group() for batches); requests without keys go to the first shard, and the
+    "shard" extension addresses one shard directly. connect(url) builds the
+    transport used for a shard, so each shard has its own circuit breaker.
+
+    add_shard() rebalances online. While it runs, moving keys keep being served
+    by their old shard and every write to them is recorded; those keys are
+    copied again, and only for the final copy are writes to moving keys held
+    back, until the ring switches over.
+    """
+
+    def __init__(self, urls: List[str], connect: Callable[[str], httpx.AsyncBaseTransport], vnodes: int = 128,
+                 pause_keys: int = 1000, copy_timeout: float = 60):
+        self.connect = connect
+        self.shards: Dict[str, httpx.AsyncBaseTransport] = {url: connect(url) for url in urls}
+        self.ring = HashRing(urls, vnodes)
+        self.pause_keys = pause_keys
+        self.copy_timeout = copy_timeout
+        # Rebalancing state: the ring being moved to, keys to copy again and writes in flight
+        self.target = None
+        self.dirty = set()
+        self.writing = {}
+        self.writes_open = asyncio.Event()
+        self.writes_open.set()
+        self.status = {"state": "idle"}
+
+    def moving(self, keys):
+        target = self.target
+        return target is not None and any(target.node_for(key) != self.ring.node_for(key) for key in keys)
+
+    def group(self, keys: List[str]):
+        """Positions of keys grouped by shard, so each group can be sent as one request"""
+        target = self.target
+        groups = {}
+        for position, key in enumerate(keys):
+            # Moving keys are kept apart, so a group has one shard both before and after the switch
+            group_key = (self.ring.node_for(key), target.node_for(key) if target is not None else None)
+            groups.setdefault(group_key, []).append(position)
+        return list(groups.values())
+
+    async def handle_async_request(self, request):
+        keys = request.extensions.get("shard_keys") or ()
+        write = request.method != "GET" and keys
+        if write and self.moving(keys):
+            await self.writes_open.wait()
+        url = request.extensions.get("shard")
+        if url is None:
+            owners = {self.ring.node_for(key) for key in keys} or {self.ring.nodes[0]}
+            if len(owners) > 1:
+                raise httpx.TransportError("The keys of this request now belong to different shards, retry it")
+            url = owners.pop()
+        target = httpx.URL(url)
+        request.url = request.url.copy_with(scheme=target.scheme, host=target.host, port=target.port)
+        request.headers["Host"] = target.netloc.decode("ascii")
+        if not write:
+            return await self.shards[url].handle_async_request(request)
+        self.writing[id(request)] = keys
+        try:
+            return await self.shards[url].handle_async_request(request)
+        finally:
+            del self.writing[id(request)]
+            if self.moving(keys):
+                # Marked once the write is done, so a copy taken before it landed is repeated
+                self.dirty.update(keys)
+
+    async def copy(self, client: httpx.AsyncClient, source: str, destination: str, params: dict):
+        """Stream users from source's /scan into destination's /import"""
+        timeout = httpx.Timeout(self.copy_timeout, read=None, write=None)
+        async with client.stream("GET", "/scan", params=params, timeout=timeout,
+                                 extensions={"shard": source}) as scan:
+            if scan.status_code != 200:
+                raise RuntimeError(f"Scan of {source} failed: {(await scan.aread()).decode()}")
+            response = await client.post("/import", content=scan.aiter_raw(), timeout=timeout,
+                                         headers={"Content-Type": "application/x-ndjson"},
+                                         extensions={"shard": destination})
+        if response.status_code != 200:
+            raise RuntimeError(f"Import into {destination} failed: {response.text}")
+        result = response.json()
+        if result["failed"]:
+            raise RuntimeError(f"Import into {destination} rejected {result['failed']} users: {result['errors']}")
+        return result["imported"]
+
+    async def copy_dirty(self, client: httpx.AsyncClient, destination: str):
+        keys, self.dirty = self.dirty, set()
+        by_source = {}
+        for key in keys:
+            by_source.setdefault(self.ring.node_for(key), []).append(key)
+        copied = 0
+        for source, users in by_source.items():
+            for start in range(0, len(users), 100):
+                copied += await self.copy(client, source, destination,
+                                          {"user_ids": ",".join(users[start:start + 100])})
+        return copied
+
+    async def add_shard(self, client: httpx.AsyncClient, url: str):
+        """
+        Add a shard and move the keys it takes over, while requests keep flowing:
+        1. bulk-copy the moving hash ranges from each old shard
+        2. copy the keys written meanwhile, again, until few are left
+        3. hold writes to moving keys, wait for those in flight, copy the rest
+           and switch to the new ring
+        4. purge the moved ranges from the old shards
+        Only one rebalance runs at a time; the caller checks status first.
+        """
+        if url in self.shards:
+            raise ValueError(f"{url} is already a shard")
+        start = time.monotonic()
+        self.shards[url] = self.connect(url)
+        target = self.ring.with_node(url)
+        moved = self.ring.moved_ranges(target)
+        self.dirty = set()
+        self.target = target
+        self.status = {"state": "copying", "shard": url, "started": time.time(), "copied": 0, "recopied": 0}
+        try:
+            for source, ranges in moved.items():
+                self.status["copied"] += await self.copy(client, source, url,
+                                                         {"hash_ranges": HashRanges(ranges).format()})
+            for _ in range(5):
+                if len(self.dirty) <= self.pause_keys:
+                    break
+                self.status["recopied"] += await self.copy_dirty(client, url)
+            self.status["state"] = "switching"
+            self.writes_open.clear()
+            pause_start = time.monotonic()
+            while any(self.moving(keys) for keys in self.writing.values()):
+                await asyncio.sleep(0.005)
+            self.status["recopied"] += await self.copy_dirty(client, url)
+            self.ring = target
+            self.status["write_pause_seconds"] = round(time.monotonic() - pause_start, 3)
+        except Exception as e:
+            self.shards.pop(url)
+            self.status = {"state": "failed", "shard": url, "error": str(e)}
+            raise
+        finally:
+            self.target = None
+            self.dirty = set()
+            self.writes_open.set()
+        self.status["state"] = "purging"
+        purged = 0
+        for source, ranges in moved.items():
+            response = await client.post("/purge", params={"hash_ranges": HashRanges(ranges).format()},
+                                         timeout=httpx.Timeout(self.copy_timeout, read=None),
+                                         extensions={"shard": source})
+            if response.status_code == 200:
+                purged += response.json()["deleted"]
+            else:
+                print(f"Purging moved keys from {source} failed: {response.text}")
+        self.status.update(state="done", purged=purged, seconds=round(time.monotonic() - start, 3))
+        print(f"Added database shard {url}: {self.status}")
+
+    def stats(self):
+        return {
+            "shards": {url: round(share, 4) for url, share in self.ring.shares().items()},
+            "vnodes": self.ring.vnodes,
+            "rebalance": self.status
+        }
+
+    async def aclose(self):
+        for transport in self.shards.values():
+            await transport.aclose()
@@ -1,54 +1,171 @@
-import subprocess
+import asyncio
+import os
+import signal
 import sys
 import time
-import os
+
+import httpx
 from dotenv import load_dotenv
 
 load_dotenv()
 
-def start_service(file_name, port):
-    return subprocess.Popen(
-        [sys.executable, "-m", "uvicorn", f"{file_name}:app", "--host", "0.0.0.0", "--port", str(port)],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
+HOST = os.getenv("SERVICES_HOST", "0.0.0.0")
+# The Database Service keeps its records in process memory (and holds the storage
+# directory lock), so it always runs as a single worker
+BUSINESS_WORKERS = int(os.getenv("BUSINESS_WORKERS", str(os.cpu_count() or 1)))
+# Async jobs, idempotency keys, admission limits, circuit breakers and the shard ring live in the
+# Client Service process, so it must run as a single worker; more than 1 is refused
+CLIENT_WORKERS = int(os.getenv("CLIENT_WORKERS", "1"))
+# Run all three services in one process (colocated.py) instead of three networked ones
+COLOCATED = os.getenv("COLOCATED", "false").lower() == "true"
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", "30"))
+READY_POLL_INTERVAL = float(os.getenv("READY_POLL_INTERVAL", "0.05"))
+RESTART_BACKOFF = float(os.getenv("RESTART_BACKOFF", "0.5"))
+RESTART_MAX_BACKOFF = float(os.getenv("RESTART_MAX_BACKOFF", "30"))
+# A child that stayed up this long is considered stable and restarts with the shortest backoff again
+RESTART_RESET_AFTER = float(os.getenv("RESTART_RESET_AFTER", "60"))
+# Seconds each service gets to finish in-flight requests after SIGTERM before it is killed
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "10"))
+
+class Service:
+    def __init__(self, name: str, port: int, workers: int = 1, depends_on=()):
+        self.name = name
+        self.port = port
+        self.workers = max(1, workers)
+        self.depends_on = depends_on
+        self.process = None
+        self.ready = asyncio.Event()
+        self.restarts = 0
+
+    def command(self):
+        return [
+            sys.executable, "-m", "uvicorn", f"{self.name}:app", "--host", HOST, "--port", str(self.port),
+            "--workers", str(self.workers), "--timeout-graceful-shutdown", str(int(SHUTDOWN_TIMEOUT))
+        ]
+
+    async def stream_logs(self, process):
+        """Copy the child's output line by line so its pipe never fills up"""
+        async for line in process.stdout:
+            print(f"[{self.name}] {line.decode(errors='replace').rstrip()}", flush=True)
+
+    async def wait_ready(self, client: httpx.AsyncClient, process):
+        deadline = time.monotonic() + READY_TIMEOUT
+        while time.monotonic() < deadline and process.returncode is None:
+            try:
+                response = await client.get(f"http://127.0.0.1:{self.port}/health", timeout=1)
+                if response.status_code == 200:
+                    return True
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(READY_POLL_INTERVAL)
+        return False
+
+    async def supervise(self, services: dict, client: httpx.AsyncClient, stopping: asyncio.Event):
+        """Start once the dependencies are healthy, then restart the service with backoff whenever it exits"""
+        for dependency in self.depends_on:
+            await services[dependency].ready.wait()
+        failures = 0
+        while not stopping.is_set():
+            started = time.monotonic()
+            # A session of its own keeps Ctrl+C away from the child, so shutdown can run in dependency order
+            self.process = await asyncio.create_subprocess_exec(
+                *self.command(), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                start_new_session=True
+            )
+            logs = asyncio.create_task(self.stream_logs(self.process))
+            if await self.wait_ready(client, self.process):
+                print(f"{self.name} is healthy on port {self.port} ({self.workers} worker(s))")
+                self.ready.set()
+            elif self.process.returncode is None:
+                print(f"{self.name} did not become healthy within {READY_TIMEOUT}s")
+            code = await self.process.wait()
+            await logs
+            if stopping.is_set():
+                return
+            failures = 0 if time.monotonic() - started > RESTART_RESET_AFTER else failures + 1
+            backoff = min(RESTART_MAX_BACKOFF, RESTART_BACKOFF * 2 ** (failures - 1)) if failures else RESTART_BACKOFF
+            self.restarts += 1
+            print(f"{self.name} exited with code {code}, restarting in {backoff:.1f}s")
+            try:
+                await asyncio.wait_for(stopping.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        if self.process is None or self.process.returncode is not None:
+            return
+        print(f"Stopping {self.name}...")
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), SHUTDOWN_TIMEOUT + 5)
+        except asyncio.TimeoutError:
+            print(f"{self.name} did not stop in time, killing it")
+            self.process.kill()
+            await self.process.wait()
+
+def build_services():
+    if COLOCATED:
+        # One worker, since the Database Service lives in it
+        return {"colocated": Service("colocated", 8000)}
+    return {service.name: service for service in (
+        Service("database_service", 8002),
+        Service("business_service", 8001, BUSINESS_WORKERS),
+        Service("client_service", 8000, CLIENT_WORKERS, depends_on=("database_service", "business_service"))
+    )}
+
+async def supervise_all():
+    services = build_services()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stopping.set)
+        except NotImplementedError:
+            # Windows event loops have no signal handlers; a plain handler wakes the loop instead
+            signal.signal(signal_number, lambda *_: loop.call_soon_threadsafe(stopping.set))
+
+    print("Starting all microservices...")
+    start = time.monotonic()
+    async with httpx.AsyncClient() as client:
+        supervisors = [asyncio.create_task(service.supervise(services, client, stopping))
+                       for service in services.values()]
+
+        async def announce():
+            await asyncio.gather(*[service.ready.wait() for service in services.values()])
+            print(f"\nAll services healthy after {time.monotonic() - start:.2f}s")
+            print("\nAccess points:")
+            print("- Client Service: http://localhost:8000")
+            if COLOCATED:
+                print("- Business Logic Service: http://localhost:8000/business")
+                print("- Database Service: http://localhost:8000/database")
+            else:
+                print("- Business Logic Service: http://localhost:8001")
+                print("- Database Service: http://localhost:8002")
+            print("\nPress Ctrl+C to stop all services")
+
+        announcer = asyncio.create_task(announce())
+        await stopping.wait()
+        announcer.cancel()
+
+        print("\nStopping all services...")
+        # Reverse dependency order: the gateway stops taking requests before its downstreams go away
+        for service in reversed(list(services.values())):
+            await service.stop()
+        for supervisor in supervisors:
+            supervisor.cancel()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+    print("All services stopped")
 
 def main():
-    services = [
-        ("database_service", 8002),
-        ("business_service", 8001),
-        ("client_service", 8000)
-    ]
     app_token = os.getenv("APP_TOKEN")
     if not app_token or app_token == "REPLACE_WITH_A_LONG_RANDOM_SECRET":
         print("ERROR: Please set a secure APP_TOKEN in your .env file")
         sys.exit(1)
-    processes = []
-    try:
-        print("Starting all microservices...")
-
-        for service_file, port in services:
-            print(f"Starting {service_file} on port {port}...")
-            process = start_service(service_file, port)
-            processes.append((service_file, process))
-            time.sleep(1)
-        
-        print("\nAll services started successfully!")
-        print("\nAccess points:")
-        print("- Client Service: http://localhost:8000")
-        print("- Business Logic Service: http://localhost:8001")
-        print("- Database Service: http://localhost:8002")
-        print("\nPress Ctrl+C to stop all services")
-        
-        while True:
-            time.sleep(1)
-            
-    except KeyboardInterrupt:
-        print("\nStopping all services...")
-        for service_name, process in processes:
-            print(f"Stopping {service_name}...")
-            process.terminate()
-        print("All services stopped")
+    if CLIENT_WORKERS != 1:
+        print("ERROR: CLIENT_WORKERS must be 1. Async jobs, idempotency keys, admission limits and the "
+              "database shard ring are kept in the Client Service process and would differ between workers")
+        sys.exit(1)
+    asyncio.run(supervise_all())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,527 @@
+import asyncio
+import json
+import os
+import time
+from typing import Dict, Any
+
+from indexes import RecordIndexes, index_fields
+from records import History, compact_record, expand_record, record_version
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, the data directory is then not locked
+    fcntl = None
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "memory")
+STORAGE_DIR = os.getenv("STORAGE_DIR", "./data")
+# fsync every group commit; turning it off only protects against process crashes
+WAL_FSYNC = os.getenv("WAL_FSYNC", "true").lower() == "true"
+# How long a commit waits for other writers to join its batch, in milliseconds
+WAL_GROUP_COMMIT_MS = float(os.getenv("WAL_GROUP_COMMIT_MS", "2"))
+# Compact the WAL into a snapshot after this many seconds or WAL records
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "300"))
+SNAPSHOT_WAL_RECORDS = int(os.getenv("SNAPSHOT_WAL_RECORDS", "100000"))
+# Users copied per step of a snapshot before the event loop gets control back
+SNAPSHOT_CHUNK_SIZE = int(os.getenv("SNAPSHOT_CHUNK_SIZE", "1000"))
+
+def dumps(value):
+    return json.dumps(value, separators=(",", ":"))
+
+class ScanSnapshot:
+    """
+    A point-in-time view of the users at key positions [position, end).
+    While it is open, the storage hands it the old state of every user it
+    changes (copy on write), so the view costs memory only for users that
+    are modified during the scan.
+    """
+
+    def __init__(self, storage, position: int, end: int):
+        self.storage = storage
+        self.position = position
+        self.end = end
+        self.preimages = {}
+
+    def done(self):
+        return self.position >= self.end
+
+    def next_rows(self, count: int, keep=None):
+        """
+        (user_id, record, history, dropped) rows for the next count positions,
+        skipping deleted users and, when given, users keep(user_id) rejects
+        """
+        storage = self.storage
+        rows = []
+        stop = min(self.end, self.position + count)
+        for user_id in storage.keys[self.position:stop]:
+            if keep is not None and not keep(user_id):
+                continue
+            if user_id in self.preimages:
+                value, history, dropped = self.preimages[user_id]
+            else:
+                value, history, dropped = (storage.records.get(user_id), storage.histories.get(user_id),
+                                           storage.history_dropped.get(user_id, 0))
+            if value is not None or history is not None:
+                rows.append((user_id, expand_record(value), list(history) if history is not None else None,
+                             dropped))
+        self.position = stop
+        return rows
+
+    def close(self):
+        self.storage.snapshots.discard(self)
+
+class MemoryStorage:
+    """
+    Keeps records and process histories in process memory, in the compact
+    form of records.py; dicts are only built again when they are read.
+    Everything is lost on restart.
+    """
+    backend = "memory"
+
+    def __init__(self, history_max_entries: int = 0):
+        self.history_max_entries = history_max_entries
+        self.records: Dict[str, Any] = {}
+        self.histories: Dict[str, History] = {}
+        # Number of entries dropped from the front of a capped history
+        self.history_dropped: Dict[str, int] = {}
+        self.indexes = RecordIndexes()
+        # Every user_id in first-seen order, so positions are stable scan cursors. Deleted users
+        # keep their position (until a restart rebuilds the list) and get it back if they return.
+        self.keys = []
+        self.deleted = set()
+        self.snapshots = set()
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def sync(self):
+        """Wait until every mutation made so far is durable"""
+        pass
+
+    def count(self):
+        return len(self.records)
+
+    def get(self, user_id: str):
+        return expand_record(self.records.get(user_id))
+
+    def version(self, user_id: str):
+        return record_version(self.records.get(user_id))
+
+    def touch(self, user_id: str):
+        """Called before a user changes: records new users and preserves the old state for open scans"""
+        if user_id not in self.records and user_id not in self.histories:
+            if user_id not in self.deleted:
+                self.keys.append(user_id)
+                return
+            # A returning user is at an old position, where open scans must still see no user
+            self.deleted.discard(user_id)
+        for snapshot in self.snapshots:
+            if user_id not in snapshot.preimages:
+                history = self.histories.get(user_id)
+                if history is not None:
+                    history = history.copy()
+                snapshot.preimages[user_id] = (self.records.get(user_id), history,
+                                               self.history_dropped.get(user_id, 0))
+
+    def open_scan(self, position: int = 0, end: int = None):
+        snapshot = ScanSnapshot(self, position, len(self.keys) if end is None else min(end, len(self.keys)))
+        self.snapshots.add(snapshot)
+        return snapshot
+
+    def put(self, user_id: str, record: Dict[str, Any]):
+        self.touch(user_id)
+        value = compact_record(record)
+        self.indexes.update(user_id, self.records.get(user_id), value)
+        self.records[user_id] = value
+
+    def delete(self, user_id: str):
+        """Remove a user's record and history; returns False if there was neither"""
+        if user_id not in self.records and user_id not in self.histories:
+            return False
+        self.touch(user_id)
+        self.indexes.update(user_id, self.records.pop(user_id, None), None)
+        self.histories.pop(user_id, None)
+        self.history_dropped.pop(user_id, None)
+        self.deleted.add(user_id)
+        return True
+
+    def query(self, field: str, low=None, high=None, after=None, limit: int = 50, where=None, max_scan: int = 100000):
+        """
+        Records whose indexed field ("sentiment", "updated" or "version") lies in
+        [low, high], in (value, user_id) order, optionally filtered by
+        where(index_fields). Returns the matches and the last (value, user_id)
+        examined, to resume from, or None when the range is exhausted.
+        """
+        index = getattr(self.indexes, field)
+        matches = []
+        scanned = 0
+        for item in index.range(low, high, after):
+            scanned += 1
+            value = self.records.get(item[1])
+            if value is not None and (where is None or where(index_fields(value))):
+                matches.append((item[1], expand_record(value)))
+            if len(matches) == limit or scanned == max_scan:
+                return matches, item
+        return matches, None
+
+    def history(self, user_id: str):
+        return self.histories.get(user_id, ())
+
+    def dropped(self, user_id: str):
+        return self.history_dropped.get(user_id, 0)
+
+    def append_history(self, user_id: str, entry: Dict[str, Any]):
+        self.touch(user_id)
+        history = self.histories.get(user_id)
+        if history is None:
+            history = History(maxlen=self.history_max_entries or None)
+            self.histories[user_id] = history
+        if history.append(entry):
+            self.history_dropped[user_id] = self.history_dropped.get(user_id, 0) + 1
+        return len(history)
+
+    def replace_history(self, user_id: str, entries, dropped: int = 0):
+        self.touch(user_id)
+        history = History(entries, maxlen=self.history_max_entries or None)
+        self.histories[user_id] = history
+        self.history_dropped[user_id] = dropped + len(entries) - len(history)
+
+    def history_entries(self):
+        return sum(len(history) for history in self.histories.values())
+
+    def disk_bytes(self):
+        return 0
+
+    def stats(self):
+        return {"backend": self.backend, "records": self.count()}
+
+class DurableStorage(MemoryStorage):
+    """
+    In-memory state backed by an append-only write-ahead log on local disk.
+
+    Mutations are applied in memory and queued for the WAL. A background task
+    writes queued records in batches (group commit) with one fsync per batch;
+    sync() waits for the batch holding the caller's mutations. The WAL is
+    periodically compacted into a snapshot, and startup loads the snapshot and
+    replays only the WAL segments written after it.
+
+    The data directory is single-writer: a second process opening it fails.
+    """
+    backend = "durable"
+
+    def __init__(self, directory: str, history_max_entries: int = 0, fsync: bool = True,
+                 group_commit_ms: float = 2, snapshot_interval: float = 300,
+                 snapshot_wal_records: int = 100000, snapshot_chunk_size: int = 1000):
+        super().__init__(history_max_entries)
+        self.directory = directory
+        self.fsync = fsync
+        self.group_commit_delay = group_commit_ms / 1000
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_wal_records = snapshot_wal_records
+        self.snapshot_chunk_size = snapshot_chunk_size
+        self.segment = 0
+        self.wal_file = None
+        self.lock_file = None
+        self.pending = []
+        self.pending_future = None
+        self.inflight_future = None
+        self.write_lock = None
+        self.wakeup = None
+        self.tasks = []
+        self.snapshot_task = None
+        self.wal_records_since_snapshot = 0
+        self.last_snapshot = time.monotonic()
+        self.recovery_stats = {}
+        self.replaying = False
+
+    def path(self, name: str):
+        return os.path.join(self.directory, name)
+
+    def segment_path(self, segment: int):
+        return self.path(f"wal-{segment:08d}.log")
+
+    def segments(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith("wal-") and name.endswith(".log"):
+                found.append(int(name[4:-4]))
+        return sorted(found)
+
+    async def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock_file = open(self.path("LOCK"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError(f"Storage directory {self.directory} is already in use by another process")
+        self.recover()
+        # Always start a fresh segment so a torn tail from a crash is never appended to
+        self.segment = max(self.segments(), default=self.segment) + 1
+        self.wal_file = open(self.segment_path(self.segment), "ab")
+        self.write_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.flush_loop()),
+                      asyncio.create_task(self.snapshot_loop())]
+
+    async def close(self, snapshot: bool = True):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.snapshot_task is not None:
+            # A snapshot keeps writing after the loop that started it is cancelled
+            await asyncio.gather(self.snapshot_task, return_exceptions=True)
+        await self.flush()
+        if snapshot and self.wal_records_since_snapshot:
+            await self.snapshot()
+        self.wal_file.close()
+        self.lock_file.close()
+
+    def recover(self):
+        """Load the latest snapshot, then replay the WAL segments written after it"""
+        start = time.perf_counter()
+        first_segment = 0
+        snapshot_records = 0
+        snapshot_path = self.path("snapshot.jsonl")
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, "rb") as snapshot:
+                header = json.loads(snapshot.readline())
+                first_segment = header["wal_segment"]
+                for line in snapshot:
+                    item = json.loads(line)
+                    user_id = item["k"]
+                    if item.get("v") is not None:
+                        MemoryStorage.put(self, user_id, item["v"])
+                    if "h" in item:
+                        MemoryStorage.replace_history(self, user_id, item["h"], item.get("d", 0))
+                    snapshot_records += 1
+        self.segment = first_segment
+        replayed = 0
+        self.replaying = True
+        try:
+            for segment in self.segments():
+                if segment < first_segment:
+                    os.remove(self.segment_path(segment))
+                    continue
+                replayed += self.replay(self.segment_path(segment))
+        finally:
+            self.replaying = False
+        self.wal_records_since_snapshot = replayed
+        self.recovery_stats = {
+            "snapshot_records": snapshot_records,
+            "wal_records_replayed": replayed,
+            "seconds": round(time.perf_counter() - start, 3)
+        }
+
+    def replay(self, path: str):
+        replayed = 0
+        with open(path, "rb") as wal:
+            for line in wal:
+                try:
+                    op, user_id, value = json.loads(line)
+                except ValueError:
+                    # Torn write at the tail of a segment from a crash
+                    break
+                if op == "put":
+                    self.put(user_id, value)
+                elif op == "append":
+                    self.append_history(user_id, value)
+                elif op == "delete":
+                    self.delete(user_id)
+                elif op == "history":
+                    if isinstance(value, dict):
+                        self.replace_history(user_id, value["entries"], value["dropped"])
+                    else:
+                        self.replace_history(user_id, value)
+                replayed += 1
+        return replayed
+
+    def log(self, op: str, user_id: str, value):
+        if self.replaying:
+            return
+        self.pending.append(dumps([op, user_id, value]).encode() + b"\n")
+        if self.pending_future is None:
+            self.pending_future = asyncio.get_running_loop().create_future()
+        self.wal_records_since_snapshot += 1
+        self.wakeup.set()
+
+    def put(self, user_id, record):
+        super().put(user_id, record)
+        self.log("put", user_id, record)
+
+    def delete(self, user_id):
+        deleted = super().delete(user_id)
+        if deleted:
+            self.log("delete", user_id, None)
+        return deleted
+
+    def append_history(self, user_id, entry):
+        history_length = super().append_history(user_id, entry)
+        self.log("append", user_id, entry)
+        return history_length
+
+    def replace_history(self, user_id, entries, dropped=0):
+        super().replace_history(user_id, entries, dropped)
+        self.log("history", user_id, {"entries": list(entries), "dropped": dropped} if dropped else list(entries))
+
+    async def sync(self):
+        future = self.pending_future or self.inflight_future
+        if future is not None:
+            await asyncio.shield(future)
+
+    def write_batch(self, batch, wal_file):
+        wal_file.write(b"".join(batch))
+        wal_file.flush()
+        if self.fsync:
+            os.fsync(wal_file.fileno())
+
+    def take_pending(self):
+        batch, future = self.pending, self.pending_future
+        self.pending, self.pending_future = [], None
+        return batch, future
+
+    async def write_pending(self, batch, future, wal_file):
+        self.inflight_future = future
+        try:
+            await asyncio.to_thread(self.write_batch, batch, wal_file)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(None)
+        finally:
+            if self.inflight_future is future:
+                self.inflight_future = None
+
+    async def flush(self):
+        async with self.write_lock:
+            batch, future = self.take_pending()
+            if batch:
+                await self.write_pending(batch, future, self.wal_file)
+
+    async def flush_loop(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if self.group_commit_delay:
+                # Give concurrent writers a moment to join this batch
+                await asyncio.sleep(self.group_commit_delay)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"WAL write failed: {e}")
+
+    async def snapshot_loop(self):
+        while True:
+            await asyncio.sleep(1)
+            due = time.monotonic() - self.last_snapshot >= self.snapshot_interval
+            if self.wal_records_since_snapshot >= self.snapshot_wal_records or (due and self.wal_records_since_snapshot):
+                try:
+                    await self.snapshot()
+                except Exception as e:
+                    print(f"Snapshot failed: {e}")
+
+    async def snapshot(self):
+        """
+        Write a compacted snapshot and drop the WAL segments it covers. A
+        snapshot runs in a task of its own, shared by concurrent callers, so
+        cancelling a caller never leaves it half written.
+        """
+        if self.snapshot_task is None or self.snapshot_task.done():
+            self.snapshot_task = asyncio.create_task(self.take_snapshot())
+            # A caller may be cancelled before it sees the failure; don't log it as unretrieved
+            self.snapshot_task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        await asyncio.shield(self.snapshot_task)
+
+    async def take_snapshot(self):
+        """
+        The batch swap, the segment rotation and opening a scan of the state
+        happen without yielding to the event loop, so every mutation is either
+        in the snapshot or in a segment replayed after it, never both. The scan
+        keeps the old state of users changed afterwards (copy on write), so the
+        users are copied and written a chunk at a time while requests go on.
+        """
+        async with self.write_lock:
+            batch, future = self.take_pending()
+            scan = self.open_scan()
+            old_file = self.wal_file
+            self.segment += 1
+            self.wal_file = open(self.segment_path(self.segment), "ab")
+            self.wal_records_since_snapshot = 0
+            self.last_snapshot = time.monotonic()
+            if batch:
+                await self.write_pending(batch, future, old_file)
+            old_file.close()
+        segment = self.segment
+        tmp_path = self.path("snapshot.jsonl.tmp")
+        try:
+            snapshot_file = await asyncio.to_thread(open, tmp_path, "wb")
+            try:
+                header = dumps({"wal_segment": segment, "created": time.time()}).encode() + b"\n"
+                await asyncio.to_thread(snapshot_file.write, header)
+                while not scan.done():
+                    rows = scan.next_rows(self.snapshot_chunk_size)
+                    await asyncio.to_thread(self.write_rows, snapshot_file, rows)
+                await asyncio.to_thread(self.finish_snapshot, snapshot_file, tmp_path, segment)
+            finally:
+                snapshot_file.close()
+        finally:
+            scan.close()
+
+    def write_rows(self, snapshot_file, rows):
+        for user_id, record, history, dropped in rows:
+            item = {"k": user_id, "v": record}
+            if history is not None:
+                item["h"], item["d"] = history, dropped
+            snapshot_file.write(dumps(item).encode() + b"\n")
+
+    def finish_snapshot(self, snapshot_file, tmp_path, segment):
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+        snapshot_file.close()
+        os.replace(tmp_path, self.path("snapshot.jsonl"))
+        if hasattr(os, "O_DIRECTORY"):
+            directory = os.open(self.directory, os.O_DIRECTORY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        for old_segment in self.segments():
+            if old_segment < segment:
+                os.remove(self.segment_path(old_segment))
+
+    def disk_bytes(self):
+        total = 0
+        for name in os.listdir(self.directory):
+            try:
+                total += os.path.getsize(self.path(name))
+            except OSError:
+                pass
+        return total
+
+    def stats(self):
+        return {
+            **super().stats(),
+            "directory": self.directory,
+            "wal_segment": self.segment,
+            "wal_records_since_snapshot": self.wal_records_since_snapshot,
+            "recovery": self.recovery_stats
+        }
+
+def create_storage(history_max_entries: int = 0):
+    if STORAGE_BACKEND == "durable":
+        return DurableStorage(
+            STORAGE_DIR,
+            history_max_entries=history_max_entries,
+            fsync=WAL_FSYNC,
+            group_commit_ms=WAL_GROUP_COMMIT_MS,
+            snapshot_interval=SNAPSHOT_INTERVAL,
+            snapshot_wal_records=SNAPSHOT_WAL_RECORDS,
+            snapshot_chunk_size=SNAPSHOT_CHUNK_SIZE
+        )
+    if STORAGE_BACKEND != "memory":
+        raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return MemoryStorage(history_max_entries=history_max_entries)
@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import client_service
+from admission import ConcurrencyLimiter, RateLimiter, Rejected
+from load_test import in_process_gateway
+
+def test_token_bucket():
+    limiter = RateLimiter(rate=20, burst=2)
+    assert [limiter.acquire("a"), limiter.acquire("a")] == [0, 0]
+    wait = limiter.acquire("a")
+    assert 0 < wait <= 0.05
+    # Other keys have buckets of their own
+    assert limiter.acquire("b") == 0
+    time.sleep(wait + 0.01)
+    assert limiter.acquire("a") == 0
+
+def test_concurrency_limit_sheds_instead_of_queueing_forever():
+    async def scenario():
+        limiter = ConcurrencyLimiter(limit=1, max_queue=1, queue_target=0.2)
+        outcomes = []
+
+        async def request(hold):
+            try:
+                async with limiter.slot():
+                    await asyncio.sleep(hold)
+                outcomes.append("done")
+            except Rejected as e:
+                outcomes.append(e.reason)
+
+        await asyncio.gather(request(0.1), request(0), request(0))
+        # A request would now expect to wait 0.3s for the slot, above the target
+        limiter.service_time = 0.3
+        await asyncio.gather(request(0.25), request(0))
+        limiter.service_time = 0.1
+        await asyncio.gather(request(0.5), request(0))
+        return outcomes, limiter.stats()
+
+    outcomes, stats = asyncio.run(scenario())
+    assert outcomes == ["queue_full", "done", "done",
+                        "expected_wait", "done",
+                        "wait_timeout", "done"]
+    assert stats["active"] == 0 and stats["queued"] == 0
+
+def test_gateway_rejects_with_retry_after():
+    admin = {"Authorization": "Bearer test_admin_token"}
+
+    async def scenario(gateway):
+        settings = {"user_rate": 1, "user_burst": 2, "max_concurrency": 2, "queue_target": 10}
+        # The API token may not change the limits it is held to
+        denied = [(await gateway.put("/admission", json=settings)).status_code,
+                  (await gateway.get("/admission")).status_code,
+                  # nor send the internal token and user data to a shard URL of its choice
+                  (await gateway.post("/shards", json={"url": "http://example.com"})).status_code]
+        update = await gateway.put("/admission", json=settings, headers=admin)
+        body = {"content": "fine", "user_id": "limited_user"}
+        statuses = [(await gateway.post("/process", json=body)) for _ in range(3)]
+        other = await gateway.post("/process", json={**body, "user_id": "other_user"})
+        stats = await gateway.get("/admission", headers=admin)
+        return denied, update, statuses, other, stats.json()
+
+    async def run():
+        async with in_process_gateway() as gateway:
+            return await scenario(gateway)
+
+    admin_token, client_service.ADMIN_TOKEN = client_service.ADMIN_TOKEN, "test_admin_token"
+    try:
+        denied, update, responses, other, stats = asyncio.run(run())
+    finally:
+        client_service.ADMIN_TOKEN = admin_token
+        client_service.admission.configure({"user_rate": client_service.ADMISSION_USER_RATE,
+                                            "user_burst": client_service.ADMISSION_USER_BURST,
+                                            "max_concurrency": client_service.ADMISSION_MAX_CONCURRENCY,
+                                            "queue_target": client_service.ADMISSION_QUEUE_TARGET})
+    assert denied == [401, 401, 401]
+    assert update.json()["concurrency"]["limit"] == 2
+    assert [response.status_code for response in responses] == [200, 200, 429]
+    assert responses[2].headers["retry-after"] == "1"
+    assert other.status_code == 200
+    assert stats["per_user"]["limited"] >= 1
+
+def test_replays_are_not_limited_and_health_shows_a_summary():
+    async def scenario(gateway):
+        body = {"content": "replayed", "user_id": "replay_user"}
+        first = await gateway.post("/process", json=body, headers={"Idempotency-Key": "replay-1"})
+        retry = await gateway.post("/process", json=body, headers={"Idempotency-Key": "replay-1"})
+        new = await gateway.post("/process", json=body, headers={"Idempotency-Key": "replay-2"})
+        return first, retry, new, (await gateway.get("/health", headers={"Authorization": ""})).json()
+
+    async def run():
+        async with in_process_gateway() as gateway:
+            return await scenario(gateway)
+
+    client_service.admission.configure({"user_rate": 0.01, "user_burst": 1})
+    try:
+        first, retry, new, health = asyncio.run(run())
+    finally:
+        client_service.admission.configure({"user_rate": client_service.ADMISSION_USER_RATE,
+                                            "user_burst": client_service.ADMISSION_USER_BURST})
+    assert first.status_code == retry.status_code == 200
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert new.status_code == 429
+    summary = health["admission"]
+    assert summary["user_rate"] == 0.01 and summary["rejected"]["user_rate"] >= 1
+    assert summary["active"] == 0 and summary["queued"] == 0
+    assert "replay_user" not in str(health) and "per_user" not in summary
+
+if __name__ == "__main__":
+    test_token_bucket()
+    test_concurrency_limit_sheds_instead_of_queueing_forever()
+    test_gateway_rejects_with_retry_after()
+    test_replays_are_not_limited_and_health_shows_a_summary()
+    print("Admission control tests passed")
@@ -0,0 +1,55 @@
+import asyncio
+
+import httpx
+
+import business_service
+from analysis_cache import cache_key
+from sentiment import ANALYZER_VERSION, Lexicon, lexicon
+
+def process(contents, version=None):
+    """Cache counters before and after sending contents to business /process, under version if given"""
+    async def scenario():
+        app = business_service.app
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://business-service",
+                                         headers={"Authorization": f"Bearer {business_service.INTERNAL_SERVICE_TOKEN}"}
+                                         ) as client:
+                before = (await client.get("/cache_stats")).json()
+                for content in contents:
+                    response = await client.post("/process", json={"content": content})
+                    assert response.status_code == 200
+                return before, (await client.get("/cache_stats")).json()
+
+    saved = business_service.PROCESSING_DELAY, business_service.ANALYSIS_CACHE_VERSION
+    business_service.PROCESSING_DELAY = 0
+    if version is not None:
+        business_service.ANALYSIS_CACHE_VERSION = version
+    try:
+        return asyncio.run(scenario())
+    finally:
+        business_service.PROCESSING_DELAY, business_service.ANALYSIS_CACHE_VERSION = saved
+
+def test_repeated_content_is_a_cache_hit():
+    before, after = process(["the cache test is a great day", "the cache test is a great day"])
+    assert after["misses"] - before["misses"] == 1
+    assert after["hits"] - before["hits"] == 1
+    assert after["analyzer_version"] == f"{ANALYZER_VERSION}:{lexicon.fingerprint}"
+
+def test_lexicon_or_analyzer_change_misses():
+    content = "the cache version test is a great day"
+    process([content])
+    other_lexicon = Lexicon({**lexicon.weights, "day": -1.0})
+    versions = [f"{ANALYZER_VERSION}:{other_lexicon.fingerprint}", f"{ANALYZER_VERSION}.1:{lexicon.fingerprint}"]
+    assert len({cache_key(content, version) for version in versions + [business_service.ANALYSIS_CACHE_VERSION]}) == 3
+    for version in versions:
+        before, after = process([content], version)
+        assert after["misses"] - before["misses"] == 1
+        assert after["hits"] == before["hits"]
+    # The results cached under the current version are still served
+    before, after = process([content])
+    assert after["hits"] - before["hits"] == 1
+
+if __name__ == "__main__":
+    test_repeated_content_is_a_cache_hit()
+    test_lexicon_or_analyzer_change_misses()
+    print("Analysis cache tests passed")
@@ -0,0 +1,58 @@
+import asyncio
+
+import httpx
+
+import database_service
+from load_test import in_process_gateway
+from local_transport import DirectTransport
+
+def test_direct_transport_matches_the_network_responses():
+    """Token checks, validation, 404/405 and streaming behave as they do through the full app"""
+    async def scenario():
+        async with database_service.app.router.lifespan_context(database_service.app):
+            responses = {}
+            for name, transport in (("asgi", httpx.ASGITransport(app=database_service.app)),
+                                    ("direct", DirectTransport(database_service.app))):
+                async with httpx.AsyncClient(transport=transport, base_url="http://database-service") as db:
+                    token = {"Authorization": f"Bearer {database_service.INTERNAL_SERVICE_TOKEN}"}
+                    write = await db.post("/write", json={"user_id": f"direct_{name}", "data": {"n": 1}},
+                                          headers=token)
+                    responses[name] = [
+                        (write.status_code, write.json()["status"]),
+                        (await db.get("/read", params={"user_id": "nobody"})).status_code,
+                        (await db.get("/read", params={"user_id": "nobody"},
+                                      headers={"Authorization": "Bearer wrong"})).status_code,
+                        (await db.post("/write", json={"data": {}}, headers=token)).status_code,
+                        (await db.get("/no_such_endpoint", headers=token)).status_code,
+                        (await db.get("/write", headers=token)).status_code,
+                        len((await db.get("/scan", params={"user_ids": f"direct_{name},nobody"},
+                                          headers=token)).content.splitlines())
+                    ]
+            return responses
+
+    responses = asyncio.run(scenario())
+    assert responses["direct"] == responses["asgi"]
+    assert responses["direct"][:6] == [(200, "success"), 401, 401, 422, 404, 405]
+    assert responses["direct"][6] == 1
+
+def test_gateway_with_direct_transport():
+    async def scenario(gateway):
+        processed = await gateway.post("/process", json={"content": "what a great day", "user_id": "direct_user"})
+        history = await gateway.get("/history", params={"user_id": "direct_user"})
+        return processed.json(), history.json()
+
+    async def run():
+        async with in_process_gateway(transport="direct") as gateway:
+            return await scenario(gateway)
+
+    database_service.storage.records.pop("direct_user", None)
+    database_service.storage.histories.pop("direct_user", None)
+    processed, history = asyncio.run(run())
+    assert processed["storage_status"]["metadata"]["version"] == 1
+    assert processed["processed_result"]["analysis"]["sentiment"] == "positive"
+    assert history["total"] == 1
+
+if __name__ == "__main__":
+    test_direct_transport_matches_the_network_responses()
+    test_gateway_with_direct_transport()
+    print("Co-located transport tests passed")
@@ -0,0 +1,111 @@
+import asyncio
+import contextvars
+
+import client_service
+import database_service
+from job_queue import JobQueue
+from load_test import in_process_gateway
+
+USER_ID = "stress_user"
+TASKS = 100
+
+async def run_in_process(scenario):
+    """Run the three services in-process, wiring the gateway to the others through ASGI transports"""
+    saved_retries = client_service.WRITE_CONFLICT_RETRIES
+    client_service.WRITE_CONFLICT_RETRIES = 200
+    try:
+        async with in_process_gateway() as gateway:
+            return await scenario(gateway)
+    finally:
+        client_service.WRITE_CONFLICT_RETRIES = saved_retries
+
+async def hammer_single_user(gateway):
+    async def send(i):
+        response = await gateway.post("/process", json={"content": f"good request {i}", "user_id": USER_ID})
+        return response.json()
+    return await asyncio.gather(*[send(i) for i in range(TASKS)])
+
+def test_no_lost_updates_for_single_user():
+    """100 concurrent /process calls for one user_id must all land: one version and one history entry each"""
+    database_service.storage.records.pop(USER_ID, None)
+    database_service.storage.histories.pop(USER_ID, None)
+    results = asyncio.run(run_in_process(hammer_single_user))
+
+    errors = [result["error"] for result in results if "error" in result]
+    assert not errors, errors[:3]
+    versions = sorted(result["storage_status"]["metadata"]["version"] for result in results)
+    assert versions == list(range(1, TASKS + 1))
+    record = database_service.storage.get(USER_ID)
+    assert record["metadata"]["version"] == TASKS
+    assert len(database_service.storage.history(USER_ID)) == TASKS
+
+def test_stale_expected_version_is_rejected():
+    async def scenario(gateway):
+        database = client_service.http_clients["database"]
+        first = await database.post("/write", json={"user_id": "cas_user", "data": {}, "expected_version": 0})
+        stale = await database.post("/write", json={"user_id": "cas_user", "data": {}, "expected_version": 0,
+                                                    "history_entry": {"word_count": 1}})
+        return first, stale
+
+    database_service.storage.records.pop("cas_user", None)
+    database_service.storage.histories.pop("cas_user", None)
+    first, stale = asyncio.run(run_in_process(scenario))
+    assert first.status_code == 200
+    assert stale.status_code == 409
+    assert stale.json()["detail"]["current_version"] == 1
+    # A rejected write must not append to the history either
+    assert len(database_service.storage.history("cas_user")) == 0
+
+def test_async_job_mode():
+    async def scenario(gateway):
+        accepted = await gateway.post("/process?mode=async", json={"content": "good day", "user_id": "job_user"})
+        job = await gateway.get(accepted.headers["location"], params={"wait": 10})
+        return accepted, job
+
+    accepted, job = asyncio.run(run_in_process(scenario))
+    assert accepted.status_code == 202
+    assert job.json()["status"] == "succeeded"
+    assert job.json()["result"]["processed_result"]["analysis"]["sentiment"] == "positive"
+
+def test_finished_jobs_are_evicted_behind_a_running_one():
+    request_id = contextvars.ContextVar("request_id", default=None)
+
+    async def scenario():
+        queue = JobQueue(maxsize=10, workers=2, max_results=2)
+        await queue.start()
+        release = asyncio.Event()
+
+        async def slow():
+            await release.wait()
+            return {"request_id": request_id.get()}
+
+        async def quick(n):
+            return {"request_id": request_id.get(), "n": n}
+
+        request_id.set("slow")
+        first = queue.submit(slow)
+        quick_jobs = []
+        for n in range(4):
+            request_id.set(f"quick_{n}")
+            quick_jobs.append(queue.submit(quick, n))
+        await asyncio.gather(*[job.done.wait() for job in quick_jobs])
+        # Only the newest finished jobs are kept while the first one still runs
+        kept = [job.id for job in quick_jobs if queue.get(job.id) is not None]
+        release.set()
+        await first.done.wait()
+        await queue.stop()
+        return first, quick_jobs, kept, queue
+
+    first, quick_jobs, kept, queue = asyncio.run(scenario())
+    assert kept == [job.id for job in quick_jobs[-2:]]
+    assert [job.result for job in quick_jobs[-2:]] == [{"request_id": "quick_2", "n": 2},
+                                                       {"request_id": "quick_3", "n": 3}]
+    assert first.result == {"request_id": "slow"}
+    assert queue.get(first.id) is first and len(queue.jobs) == 2
+
+if __name__ == "__main__":
+    test_no_lost_updates_for_single_user()
+    test_stale_expected_version_is_rejected()
+    test_async_job_mode()
+    test_finished_jobs_are_evicted_behind_a_running_one()
+    print("Concurrency tests passed")
@@ -0,0 +1,93 @@
+import asyncio
+
+import database_service
+from idempotency import IdempotencyStore, KeyReused
+from load_test import in_process_gateway
+
+def test_duplicates_run_once():
+    calls = 0
+
+    async def handler():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return {"call": calls}
+
+    async def scenario():
+        store = IdempotencyStore(max_entries=2, ttl=60)
+        concurrent = await asyncio.gather(*[store.run(("token", "key"), "a", handler) for _ in range(5)])
+        later = await store.run(("token", "key"), "a", handler)
+        try:
+            await store.run(("token", "key"), "b", handler)
+            reused = False
+        except KeyReused:
+            reused = True
+        for key in ("second", "third"):
+            await store.run(("token", key), "a", handler)
+        evicted = await store.run(("token", "key"), "a", handler)
+        return store, concurrent, later, reused, evicted
+
+    store, concurrent, later, reused, evicted = asyncio.run(scenario())
+    assert [result for result, _ in concurrent] == [{"call": 1}] * 5
+    assert [replayed for _, replayed in concurrent] == [False] + [True] * 4
+    assert later == ({"call": 1}, True)
+    assert reused
+    # Only two results fit, so the first key was evicted and runs again
+    assert evicted == ({"call": 4}, False)
+    assert store.stats()["coalesced"] == 4 and store.stats()["evictions"] == 2
+
+def test_failures_are_not_kept():
+    outcomes = [RuntimeError("down"), {"error": "busy"}, {"ok": True}]
+
+    async def handler():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def scenario():
+        store = IdempotencyStore()
+        results = []
+        for _ in range(4):
+            try:
+                results.append(await store.run(("token", "key"), "a", handler,
+                                               keep=lambda result: "error" not in result))
+            except RuntimeError as e:
+                results.append(str(e))
+        return results
+
+    assert asyncio.run(scenario()) == ["down", ({"error": "busy"}, False), ({"ok": True}, False),
+                                       ({"ok": True}, True)]
+
+def test_process_retry_with_idempotency_key():
+    async def scenario(gateway):
+        body = {"content": "a good retry", "user_id": "idempotent_user"}
+        headers = {"Idempotency-Key": "retry-1"}
+        first, duplicate = await asyncio.gather(gateway.post("/process", json=body, headers=headers),
+                                                gateway.post("/process", json=body, headers=headers))
+        retry = await gateway.post("/process", json=body, headers=headers)
+        changed = await gateway.post("/process", json={**body, "content": "other"}, headers=headers)
+        history = await gateway.get("/history", params={"user_id": "idempotent_user"})
+        stats = [(await gateway.get("/idempotency_stats", headers=auth)).status_code
+                 for auth in ({}, {"Authorization": "Bearer wrong"})]
+        return first, duplicate, retry, changed, history.json(), stats
+
+    async def run():
+        async with in_process_gateway() as gateway:
+            return await scenario(gateway)
+
+    database_service.storage.records.pop("idempotent_user", None)
+    database_service.storage.histories.pop("idempotent_user", None)
+    first, duplicate, retry, changed, history, stats = asyncio.run(run())
+    assert first.json() == duplicate.json() == retry.json()
+    assert "idempotent-replayed" not in first.headers
+    assert duplicate.headers["idempotent-replayed"] == retry.headers["idempotent-replayed"] == "true"
+    assert changed.status_code == 422
+    assert history["total"] == 1
+    assert stats == [200, 401]
+
+if __name__ == "__main__":
+    test_duplicates_run_once()
+    test_failures_are_not_kept()
+    test_process_retry_with_idempotency_key()
+    print("Idempotency tests passed")
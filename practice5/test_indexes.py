@@ -0,0 +1,55 @@
+import random
+
+import indexes
+from indexes import SortedIndex
+from storage import MemoryStorage
+
+def test_sorted_index_matches_a_sorted_list():
+    block_size, indexes.BLOCK_SIZE = indexes.BLOCK_SIZE, 4  # force many block splits
+    try:
+        check_sorted_index()
+    finally:
+        indexes.BLOCK_SIZE = block_size
+
+def check_sorted_index():
+    rng = random.Random(7)
+    index, reference = SortedIndex(), set()
+    for _ in range(2000):
+        item = (rng.randrange(50), f"user_{rng.randrange(40)}")
+        if item in reference and rng.random() < 0.5:
+            index.remove(item)
+            reference.discard(item)
+        elif item not in reference:
+            index.add(item)
+            reference.add(item)
+    expected = sorted(reference)
+    assert list(index.range()) == expected and len(index) == len(expected)
+    assert list(index.range(10, 20)) == [item for item in expected if 10 <= item[0] <= 20]
+    after = expected[len(expected) // 2]
+    assert list(index.range(after=after)) == [item for item in expected if item > after]
+
+def test_query_pages_and_aggregates_follow_writes():
+    storage = MemoryStorage()
+    def put(user_id, sentiment, words, version):
+        storage.put(user_id, {
+            "analysis": {"word_count": words, "character_count": words * 5, "sentiment": sentiment,
+                         "processing_id": "proc_1000"},
+            "metadata": {"last_updated": "2025-04-23 12:00:00", "version": version, "history_length": 0}
+        })
+    for i in range(10):
+        put(f"user_{i}", "negative" if i % 2 else "positive", i, 1)
+    put("user_1", "positive", 100, 2)
+
+    first, cursor = storage.query("sentiment", "negative", "negative", limit=2)
+    rest, end = storage.query("sentiment", "negative", "negative", after=cursor, limit=10)
+    assert [user_id for user_id, _ in first + rest] == ["user_3", "user_5", "user_7", "user_9"]
+    assert end is None
+    assert [user_id for user_id, _ in storage.query("version", 2, None)[0]] == ["user_1"]
+    aggregates = storage.indexes.aggregates()
+    assert aggregates["sentiment_distribution"] == {"negative": 4, "positive": 6}
+    assert aggregates["total_word_count"] == sum(range(10)) - 1 + 100
+
+if __name__ == "__main__":
+    test_sorted_index_matches_a_sorted_list()
+    test_query_pages_and_aggregates_follow_writes()
+    print("Index tests passed")
@@ -0,0 +1,48 @@
+import asyncio
+
+import httpx
+
+from load_balancer import BalancingTransport
+
+async def replicas(request):
+    """Fake business replicas told apart by host: 'bad' always fails, 'down' fails its health check"""
+    if request.url.host == "bad" or (request.url.host == "down" and request.url.path == "/health"):
+        return httpx.Response(503)
+    await asyncio.sleep(0.001)
+    return httpx.Response(200, json={"host": request.url.host})
+
+def send(balancer, count):
+    async def scenario():
+        async with httpx.AsyncClient(transport=balancer, base_url="http://replica") as client:
+            responses = [await client.get("/process") for _ in range(count)]
+        await balancer.aclose()
+        return responses
+    return asyncio.run(scenario())
+
+def test_failing_replica_is_ejected():
+    balancer = BalancingTransport(httpx.MockTransport(replicas), ["http://a", "http://b", "http://bad"],
+                                  eject_failures=3)
+    responses = send(balancer, 100)
+    stats = {endpoint["url"]: endpoint for endpoint in balancer.stats()["endpoints"]}
+    assert stats["http://bad"]["ejected"]
+    assert stats["http://bad"]["requests"] == 3
+    assert sum(response.status_code != 200 for response in responses) == 3
+    assert stats["http://a"]["requests"] > 0 and stats["http://b"]["requests"] > 0
+
+def test_unhealthy_replica_gets_no_traffic():
+    async def scenario():
+        balancer = BalancingTransport(httpx.MockTransport(replicas), ["http://a", "http://down"],
+                                      strategy="least_outstanding", health_interval=0.01)
+        balancer.start()
+        await asyncio.sleep(0.05)
+        async with httpx.AsyncClient(transport=balancer, base_url="http://replica") as client:
+            hosts = {(await client.get("/process")).json()["host"] for _ in range(20)}
+        await balancer.aclose()
+        return hosts
+
+    assert asyncio.run(scenario()) == {"a"}
+
+if __name__ == "__main__":
+    test_failing_replica_is_ejected()
+    test_unhealthy_replica_gets_no_traffic()
+    print("Load balancer tests passed")
@@ -119,7 +119,8 @@ def test_process_endpoint():
             print(f"- Character Count: {processed.get('character_count')}")
             print(f"- Sentiment: {processed.get('sentiment')}")
         
-        history = result.get('processed_result', {}).get('process_history', [])
+        history_response = make_request(f"/history?user_id={user_id}")
+        history = history_response.json().get('entries', []) if history_response else []
         if len(history) > 1:
             print("\nProcess History:")
             for i, entry in enumerate(history):
@@ -0,0 +1,91 @@
+import asyncio
+import marshal
+import time
+
+import httpx
+from fastapi import FastAPI
+
+import profiling
+
+def busy(seconds):
+    deadline = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < deadline:
+        total += sum(range(1000))
+    return total
+
+def debug_app(enabled=True):
+    app = FastAPI()
+
+    @app.get("/block")
+    async def block(seconds: float):
+        busy(seconds)
+        return {"ok": True}
+
+    profiling.PROFILING_ENABLED, profiling.PROFILING_TOKEN = enabled, "debug-token"
+    try:
+        profiling.enable_profiling(app, "test")
+    finally:
+        profiling.PROFILING_ENABLED = False
+    return app
+
+async def block(client, seconds):
+    """Block the event loop once the profiler (started just before) is running"""
+    await asyncio.sleep(0.1)
+    return await client.get("/block", params={"seconds": seconds})
+
+def run(app, scenario):
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://service",
+                                     headers={"Authorization": "Bearer debug-token"}, timeout=30) as client:
+            return await scenario(client)
+    return asyncio.run(main())
+
+def test_disabled_by_default():
+    async def scenario(client):
+        return (await client.get("/debug/profile", params={"seconds": 0.1})).status_code
+
+    assert run(debug_app(enabled=False), scenario) == 404
+
+def test_cpu_profile_and_loop_watch_find_the_blocking_handler():
+    async def scenario(client):
+        unauthorized = await client.get("/debug/profile", headers={"Authorization": "Bearer wrong"})
+        profile, _ = await asyncio.gather(client.get("/debug/profile", params={"seconds": 0.5}),
+                                          block(client, 0.3))
+        stats, _ = await asyncio.gather(client.get("/debug/profile", params={"seconds": 0.5, "format": "pstats"}),
+                                        block(client, 0.3))
+        loop, _ = await asyncio.gather(client.get("/debug/loop", params={"seconds": 0.6, "threshold": 0.1}),
+                                       block(client, 0.3))
+        return unauthorized, profile, stats, loop.json()
+
+    unauthorized, profile, stats, loop = run(debug_app(), scenario)
+    assert unauthorized.status_code == 401
+    busy_lines = [line for line in profile.text.splitlines() if "busy (test_profiling.py" in line]
+    assert busy_lines and all(line.startswith("MainThread;") for line in busy_lines)
+    functions = marshal.loads(stats.content)
+    busy_function = next(function for function in functions if function[2] == "busy")
+    assert functions[busy_function][3] > 0.1
+    assert loop["lag_ms"]["max"] > 200
+    [stall] = loop["slow_callbacks"]
+    assert any(frame.startswith("busy (test_profiling.py") for frame in stall["stack"])
+    assert stall["seconds"] > 0.2
+
+def test_tracemalloc_diff():
+    async def scenario(client):
+        await client.post("/debug/tracemalloc/start")
+        await client.get("/debug/tracemalloc")
+        kept = [bytearray(1000) for _ in range(1000)]
+        snapshot = (await client.get("/debug/tracemalloc", params={"top": 5})).json()
+        await client.post("/debug/tracemalloc/stop")
+        return kept, snapshot
+
+    _, snapshot = run(debug_app(), scenario)
+    assert snapshot["traced_bytes"] >= 1000 * 1000
+    assert "test_profiling.py" in snapshot["diff_since_last"][0]["where"]
+    assert snapshot["diff_since_last"][0]["size_diff_bytes"] >= 1000 * 1000
+
+if __name__ == "__main__":
+    test_disabled_by_default()
+    test_cpu_profile_and_loop_watch_find_the_blocking_handler()
+    test_tracemalloc_diff()
+    print("Profiling tests passed")
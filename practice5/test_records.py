@@ -0,0 +1,43 @@
+from collections import deque
+
+from records import History, Record, compact_record, expand_record
+
+RECORD = {
+    "analysis": {"word_count": 2, "character_count": 9, "sentiment": "positive", "processing_id": "proc_1234"},
+    "metadata": {"last_updated": "2025-04-23 12:00:00", "version": 3, "history_length": 3}
+}
+
+def test_record_round_trip():
+    record = compact_record(RECORD)
+    assert type(record) is Record
+    assert expand_record(record) == RECORD
+    # Anything else is kept as it was sent
+    assert compact_record({"custom": [1, 2]}) == {"custom": [1, 2]}
+
+def test_history_keeps_entries_and_order():
+    entries = [{"timestamp": f"2025-04-23 12:00:0{i}", "word_count": i, "sentiment": "neutral"} for i in range(5)]
+    entries.insert(2, {"note": "not the usual shape"})
+    history = History(entries, maxlen=4)
+    assert list(history) == entries[-4:]
+    assert history[1:3] == entries[-3:-1]
+    assert list(history.copy()) == entries[-4:]
+
+def test_capped_history_matches_a_bounded_deque():
+    history = History(maxlen=3)
+    expected = deque(maxlen=3)
+    for i in range(20):
+        entry = ({"note": i} if i % 4 == 0 else
+                 {"timestamp": f"2025-04-23 12:00:{i:02d}", "word_count": i, "sentiment": "positive"})
+        assert history.append(entry) == (len(expected) == 3)
+        expected.append(entry)
+        assert list(history) == list(expected)
+        assert history[1:] == list(expected)[1:]
+        assert list(history.copy()) == list(expected)
+    # Dropped slots are cut off once there are maxlen of them
+    assert len(history.sentiments) < 2 * 3
+
+if __name__ == "__main__":
+    test_record_round_trip()
+    test_history_keeps_entries_and_order()
+    test_capped_history_matches_a_bounded_deque()
+    print("Record tests passed")
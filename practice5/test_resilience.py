@@ -0,0 +1,140 @@
+import asyncio
+import time
+
+import httpx
+
+import client_service
+from load_balancer import BalancingTransport
+from load_test import in_process_gateway
+from resilience import CircuitBreaker, CircuitOpen, ResilientTransport, RetryBudget
+
+def guarded(handler, **options):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=0.05)
+    return ResilientTransport(httpx.MockTransport(handler), breaker, RetryBudget(), retry_backoff=0, **options)
+
+def run(transport, scenario):
+    async def main():
+        async with httpx.AsyncClient(transport=transport, base_url="http://replica") as client:
+            return await scenario(client)
+    return asyncio.run(main())
+
+def test_circuit_opens_and_recovers():
+    healthy = False
+    calls = 0
+
+    def handler(request):
+        nonlocal calls
+        calls += 1
+        return httpx.Response(200 if healthy else 503)
+
+    async def scenario(client):
+        nonlocal healthy
+        statuses = [(await client.post("/process")).status_code for _ in range(3)]
+        try:
+            await client.post("/process")
+            shed = False
+        except CircuitOpen:
+            shed = True
+        healthy = True
+        await asyncio.sleep(0.06)
+        recovered = (await client.post("/process")).status_code
+        return statuses, shed, recovered
+
+    transport = guarded(handler)
+    statuses, shed, recovered = run(transport, scenario)
+    assert statuses == [503, 503, 503]
+    assert shed and calls == 4
+    assert recovered == 200
+    assert transport.breaker.state == "closed"
+
+def test_only_reads_are_retried():
+    attempts = {"GET": 0, "POST": 0}
+
+    def handler(request):
+        attempts[request.method] += 1
+        return httpx.Response(503 if attempts[request.method] == 1 else 200)
+
+    async def scenario(client):
+        return (await client.get("/read")).status_code, (await client.post("/write")).status_code
+
+    assert run(guarded(handler), scenario) == (200, 503)
+    assert attempts == {"GET": 2, "POST": 1}
+
+def test_slow_request_is_hedged_to_another_replica():
+    async def handler(request):
+        await asyncio.sleep(1 if request.url.host == "slow" else 0.005)
+        return httpx.Response(200, json={"host": request.url.host})
+
+    balancer = BalancingTransport(httpx.MockTransport(handler), ["http://fast", "http://slow"],
+                                  strategy="least_outstanding")
+    transport = ResilientTransport(balancer, CircuitBreaker("test"), RetryBudget(), hedge_paths=("/process",),
+                                   hedge_min_samples=5)
+    # Seed the latency history so a hedge delay is known
+    transport.latencies["/process"].extend([0.005] * 10)
+
+    async def scenario(client):
+        balancer.endpoints.reverse()  # least_outstanding picks the slow replica first on ties
+        start = time.perf_counter()
+        response = await client.post("/process")
+        return response.json()["host"], time.perf_counter() - start
+
+    host, elapsed = run(transport, scenario)
+    assert host == "fast" and elapsed < 0.5
+    assert transport.counters == {"hedged": 1, "hedge_wins": 1}
+
+def test_gateway_reports_downstream_failures_with_their_status():
+    def database(request):
+        if request.url.path == "/read":
+            return httpx.Response(200, json={"data": {}})
+        return httpx.Response(409, json={"detail": {"current_version": 7}})
+
+    def unreachable(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    def too_slow(request):
+        raise httpx.ReadTimeout("read timed out", request=request)
+
+    async def scenario(gateway):
+        body = {"content": "fine", "user_id": "failing_user"}
+        responses = []
+        for business in (too_slow, unreachable):
+            client_service.http_clients["business"] = client_service.create_http_client(
+                "business", "http://business-service", 30, transport=httpx.MockTransport(business))
+            responses.append(await gateway.post("/process", json=body))
+        breaker = client_service.guards["business"].breaker
+        breaker.state, breaker.opened_at = "open", time.monotonic()
+        responses.append(await gateway.post("/process", json=body))
+        breaker.state = "closed"
+        client_service.http_clients["database"] = client_service.create_http_client(
+            "database", "http://database-service", 30, transport=httpx.MockTransport(database))
+        responses.append(await gateway.get("/history", params={"user_id": "failing_user"}))
+        return responses
+
+    async def run_gateway():
+        async with in_process_gateway() as gateway:
+            # The real business service answers the conflict case
+            business = client_service.http_clients["business"]
+            responses = await scenario(gateway)
+            client_service.http_clients["business"] = business
+            responses.append(await gateway.post("/process", json={"content": "fine", "user_id": "failing_user"}))
+            return responses
+
+    retries = client_service.WRITE_CONFLICT_RETRIES
+    client_service.WRITE_CONFLICT_RETRIES = 1
+    try:
+        timeout, refused, circuit_open, history, conflict = asyncio.run(run_gateway())
+    finally:
+        client_service.WRITE_CONFLICT_RETRIES = retries
+    assert timeout.status_code == 504 and "retry-after" not in timeout.headers
+    assert refused.status_code == 503 and refused.headers["retry-after"] == "1"
+    assert circuit_open.status_code == 503
+    assert int(circuit_open.headers["retry-after"]) == client_service.CIRCUIT_RESET_TIMEOUT
+    assert history.status_code == 502
+    assert conflict.status_code == 409 and "conflict after 1 retries" in conflict.json()["error"]
+
+if __name__ == "__main__":
+    test_circuit_opens_and_recovers()
+    test_only_reads_are_retried()
+    test_slow_request_is_hedged_to_another_replica()
+    test_gateway_reports_downstream_failures_with_their_status()
+    print("Resilience tests passed")
@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import httpx
+
+import database_service
+from storage import MemoryStorage
+
+def entry(word_count):
+    return {"timestamp": "2025-04-23 12:00:00", "word_count": word_count, "sentiment": "neutral"}
+
+def test_scan_sees_the_store_as_it_was_when_opened():
+    storage = MemoryStorage()
+    for i in range(30):
+        storage.put(f"user_{i}", {"value": i})
+        storage.append_history(f"user_{i}", entry(i))
+    snapshot = storage.open_scan()
+    rows = snapshot.next_rows(10)
+    for i in range(30):
+        storage.put(f"user_{i}", {"value": -1})
+        storage.append_history(f"user_{i}", entry(-1))
+    storage.put("late_user", {"value": 100})
+    while not snapshot.done():
+        rows += snapshot.next_rows(10)
+    snapshot.close()
+
+    assert [row[0] for row in rows] == [f"user_{i}" for i in range(30)]
+    assert all(data == {"value": i} and history == [entry(i)] for i, (_, data, history, _) in enumerate(rows))
+    assert not storage.snapshots
+
+def test_scan_output_imports_back():
+    async def scenario():
+        async with database_service.app.router.lifespan_context(database_service.app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=database_service.app), base_url="http://db",
+                                         headers={"Authorization": f"Bearer {database_service.INTERNAL_SERVICE_TOKEN}"}) as db:
+                for i in range(5):
+                    await db.post("/write", json={"user_id": f"scan_user_{i}", "data": {"n": i},
+                                                  "history_entry": entry(i)})
+                exported = (await db.get("/scan")).content
+                kept = (await db.post("/import", params={"overwrite": "false"}, content=exported)).json()
+                restored = (await db.post("/import", content=exported + b'{"no_user_id": 1}\n')).json()
+
+                async def trickle():
+                    # Lines arrive split over many small chunks, the last one without a newline
+                    body = exported.rstrip(b"\n")
+                    for start in range(0, len(body), 7):
+                        yield body[start:start + 7]
+
+                trickled = (await db.post("/import", content=trickle())).json()
+                record = (await db.get("/read", params={"user_id": "scan_user_3", "include_history": True})).json()
+                return exported, kept, restored, trickled, record
+
+    exported, kept, restored, trickled, record = asyncio.run(scenario())
+    lines = [json.loads(line) for line in exported.splitlines()]
+    assert {"scan_user_0", "scan_user_4"} <= {line["user_id"] for line in lines}
+    assert kept["imported"] == 0 and kept["skipped"] == len(lines)
+    assert restored["imported"] == len(lines) and restored["failed"] == 1
+    assert trickled["imported"] == trickled["lines"] == len(lines) and trickled["failed"] == 0
+    assert record["data"]["n"] == 3 and record["data"]["process_history"] == [entry(3)]
+
+if __name__ == "__main__":
+    test_scan_sees_the_store_as_it_was_when_opened()
+    test_scan_output_imports_back()
+    print("Scan tests passed")
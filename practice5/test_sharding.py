@@ -0,0 +1,96 @@
+import asyncio
+import importlib.util
+
+import httpx
+
+import database_service
+from sharding import HashRanges, HashRing, ShardingTransport
+
+SHARD_A = "http://shard-a:8002"
+SHARD_B = "http://shard-b:8002"
+USERS = [f"shard_user_{i}" for i in range(300)]
+
+def test_ring_spreads_keys_and_moves_only_to_the_new_node():
+    ring = HashRing(["http://db-1", "http://db-2", "http://db-3"])
+    assert all(0.28 < share < 0.39 for share in ring.shares().values())
+    target = ring.with_node("http://db-4")
+    moved_ranges = {source: HashRanges(ranges) for source, ranges in ring.moved_ranges(target).items()}
+    keys = [f"user_{i}" for i in range(20000)]
+    moved = [key for key in keys if ring.node_for(key) != target.node_for(key)]
+    assert 0.2 < len(moved) / len(keys) < 0.3
+    assert all(target.node_for(key) == "http://db-4" for key in moved)
+    assert all((key in moved_ranges.get(ring.node_for(key), HashRanges([]))) == (key in set(moved)) for key in keys)
+
+def second_database():
+    """Another Database Service with its own storage, loaded from the same source"""
+    spec = importlib.util.spec_from_file_location("database_shard_b", database_service.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_add_shard_moves_users_while_they_are_written():
+    shard_b = second_database()
+    apps = {SHARD_A: database_service.app, SHARD_B: shard_b.app}
+    sharding = ShardingTransport([SHARD_A], lambda url: httpx.ASGITransport(app=apps[url]), vnodes=32, pause_keys=10)
+
+    async def scenario():
+        async with database_service.app.router.lifespan_context(database_service.app), \
+                shard_b.app.router.lifespan_context(shard_b.app), \
+                httpx.AsyncClient(transport=sharding, base_url=SHARD_A, headers={
+                    "Authorization": f"Bearer {database_service.INTERNAL_SERVICE_TOKEN}"}) as client:
+            async def write(user_id, round_number):
+                response = await client.post("/write", json={
+                    "user_id": user_id, "data": {"round": round_number},
+                    "history_entry": {"timestamp": "2025-04-23 12:00:00", "word_count": round_number,
+                                      "sentiment": "neutral"}
+                }, extensions={"shard_keys": [user_id]})
+                assert response.status_code == 200, response.text
+
+            await asyncio.gather(*[write(user_id, 0) for user_id in USERS])
+            rebalance = asyncio.create_task(sharding.add_shard(client, SHARD_B))
+            for round_number in range(1, 4):
+                await asyncio.gather(*[write(user_id, round_number) for user_id in USERS])
+            await rebalance
+            reads = await asyncio.gather(*[client.get("/read", params={"user_id": user_id, "include_history": True},
+                                                      extensions={"shard_keys": [user_id]}) for user_id in USERS])
+            return [read.json()["data"] for read in reads]
+
+    records = asyncio.run(scenario())
+    assert all(record["round"] == 3 and record["metadata"]["version"] == 4 and
+               [entry["word_count"] for entry in record["process_history"]] == [0, 1, 2, 3] for record in records)
+    owned_by_b = {user_id for user_id in USERS if sharding.ring.node_for(user_id) == SHARD_B}
+    assert owned_by_b and len(owned_by_b) < len(USERS)
+    assert set(shard_b.storage.records) == {user_id for user_id in shard_b.storage.records
+                                            if sharding.ring.node_for(user_id) == SHARD_B}
+    assert not any(sharding.ring.node_for(user_id) == SHARD_B for user_id in database_service.storage.records)
+    assert sharding.status["state"] == "done"
+
+def test_failed_shard_is_forgotten():
+    import client_service
+    from load_test import in_process_gateway
+
+    url = "http://shard-c:8002"
+
+    async def unreachable(*args, **kwargs):
+        raise httpx.ConnectError("shard-c is down")
+
+    async def scenario():
+        async with in_process_gateway():
+            sharding = client_service.database_sharding
+            sharding.copy = unreachable
+            try:
+                await client_service.rebalance(url)
+            finally:
+                del sharding.copy
+            return set(sharding.shards), set(client_service.guards), dict(sharding.status)
+
+    shards, guards, status = asyncio.run(scenario())
+    assert url not in shards and status["state"] == "failed"
+    # No circuit breaker is left for /health to report
+    assert client_service.shard_name(url) not in guards
+
+if __name__ == "__main__":
+    test_ring_spreads_keys_and_moves_only_to_the_new_node()
+    test_add_shard_moves_users_while_they_are_written()
+    test_failed_shard_is_forgotten()
+    print("Sharding tests passed")
@@ -0,0 +1,143 @@
+import asyncio
+import os
+import tempfile
+
+from storage import DurableStorage
+
+def record(version):
+    return {"analysis": {"word_count": version, "character_count": 5, "sentiment": "positive",
+                         "processing_id": f"proc_{version}"},
+            "metadata": {"last_updated": "2025-04-23 12:00:00", "version": version, "history_length": version}}
+
+def entry(second):
+    return {"timestamp": f"2025-04-23 12:00:{second:02d}", "word_count": second, "sentiment": "neutral"}
+
+async def crash(storage):
+    """Stop a storage the way a killed process would: no final flush or snapshot"""
+    for task in storage.tasks:
+        task.cancel()
+    await asyncio.gather(*storage.tasks, return_exceptions=True)
+    storage.wal_file.close()
+    storage.lock_file.close()
+
+async def reopen(directory):
+    storage = DurableStorage(directory, fsync=False, group_commit_ms=0)
+    await storage.open()
+    return storage
+
+def state(storage):
+    return ({user_id: storage.get(user_id) for user_id in storage.records},
+            {user_id: list(history) for user_id, history in storage.histories.items()})
+
+def run(scenario):
+    with tempfile.TemporaryDirectory() as directory:
+        return asyncio.run(scenario(directory))
+
+def test_wal_replay_without_snapshot():
+    async def scenario(directory):
+        storage = await reopen(directory)
+        for version in range(1, 4):
+            storage.put("alice", record(version))
+            storage.append_history("alice", entry(version))
+        storage.put("bob", record(1))
+        storage.delete("bob")
+        await storage.sync()
+        expected = state(storage)
+        await crash(storage)
+        recovered = await reopen(directory)
+        result = state(recovered), recovered.recovery_stats, "bob" in recovered.records
+        await recovered.close()
+        return expected, result
+
+    expected, (recovered, stats, bob) = run(scenario)
+    assert recovered == expected
+    assert stats["snapshot_records"] == 0 and stats["wal_records_replayed"] == 8
+    assert not bob
+
+def test_snapshot_then_wal_tail():
+    async def scenario(directory):
+        storage = await reopen(directory)
+        for user in range(10):
+            storage.put(f"user_{user}", record(1))
+            storage.append_history(f"user_{user}", entry(user))
+        await storage.snapshot()
+        storage.put("user_0", record(2))
+        storage.append_history("user_0", entry(30))
+        storage.delete("user_1")
+        await storage.sync()
+        expected = state(storage)
+        await crash(storage)
+        recovered = await reopen(directory)
+        result = state(recovered), recovered.recovery_stats
+        await recovered.close()
+        return expected, result
+
+    expected, (recovered, stats) = run(scenario)
+    assert recovered == expected
+    assert stats["snapshot_records"] == 10 and stats["wal_records_replayed"] == 3
+    assert "user_1" not in recovered[0] and len(recovered[1]["user_0"]) == 2
+
+def test_torn_last_wal_line_is_ignored():
+    async def scenario(directory):
+        storage = await reopen(directory)
+        storage.put("alice", record(1))
+        storage.append_history("alice", entry(1))
+        await storage.sync()
+        expected = state(storage)
+        segment = storage.segment_path(storage.segment)
+        await crash(storage)
+        with open(segment, "ab") as wal:
+            wal.write(b'["append","alice",{"timestamp":"2025-04')
+        recovered = await reopen(directory)
+        # Writes after the crash go to a new segment and survive the next restart
+        recovered.put("carol", record(1))
+        await recovered.close(snapshot=False)
+        restarted = await reopen(directory)
+        result = state(recovered), recovered.recovery_stats, restarted.get("carol")
+        await restarted.close()
+        return expected, result
+
+    expected, (recovered, stats, carol) = run(scenario)
+    assert recovered[1] == expected[1]
+    assert stats["wal_records_replayed"] == 2
+    assert carol == record(1)
+
+def test_snapshot_sees_one_point_in_time_while_writes_go_on():
+    async def scenario(directory):
+        storage = DurableStorage(directory, fsync=False, group_commit_ms=0, snapshot_chunk_size=1)
+        await storage.open()
+        for user in range(20):
+            storage.append_history(f"user_{user}", entry(user))
+        snapshot = asyncio.create_task(storage.snapshot())
+
+        async def write():
+            # Users are changed both before and after the snapshot has copied them
+            for second in range(20):
+                storage.append_history(f"user_{19 - second}", entry(second))
+                storage.delete("user_10")
+                await asyncio.sleep(0)
+
+        await asyncio.gather(snapshot, write())
+        # A snapshot cancelled half way is finished before close() writes the last one
+        cancelled = asyncio.create_task(storage.snapshot())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await storage.close()
+        leftovers = sorted(name for name in os.listdir(directory) if name.endswith(".tmp"))
+        expected = state(storage)
+        recovered = await reopen(directory)
+        result = state(recovered)
+        await recovered.close()
+        return expected, result, leftovers
+
+    expected, recovered, leftovers = run(scenario)
+    assert recovered == expected
+    assert all(len(history) == 2 for history in recovered[1].values())
+    assert leftovers == []
+
+if __name__ == "__main__":
+    test_wal_replay_without_snapshot()
+    test_snapshot_then_wal_tail()
+    test_torn_last_wal_line_is_ignored()
+    test_snapshot_sees_one_point_in_time_while_writes_go_on()
+    print("Storage tests passed")
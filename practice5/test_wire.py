@@ -0,0 +1,40 @@
+import asyncio
+
+import httpx
+
+import database_service
+import wire
+
+def test_negotiate_prefers_highest_quality():
+    assert wire.negotiate("*/*") == wire.JSON
+    assert wire.negotiate(f"{wire.JSON};q=0.5, {wire.MSGPACK}") == (wire.MSGPACK if wire.msgpack else wire.JSON)
+    assert wire.negotiate(None) == wire.JSON
+
+def test_codec_switches_after_the_service_advertises_formats():
+    codec = wire.Codec()
+    history = [{"timestamp": "2025-04-23 12:00:00", "word_count": i % 50, "sentiment": "neutral"} for i in range(5000)]
+
+    async def scenario():
+        async with database_service.app.router.lifespan_context(database_service.app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=database_service.app), base_url="http://db",
+                                         headers={"Authorization": f"Bearer {database_service.INTERNAL_SERVICE_TOKEN}",
+                                                  "Accept": wire.ACCEPT}) as db:
+                first = codec.encode({"user_id": "wire_user", "data": {"n": 1}})
+                codec.decode(await db.post("/write", **first))
+                second = codec.encode({"user_id": "wire_user", "data": {"n": 2, "process_history": history}})
+                stored = codec.decode(await db.post("/write", **second))
+                read = await db.get("/read", params={"user_id": "wire_user", "include_history": True})
+                return first, second, stored, read, codec.decode(read)
+
+    first, second, stored, read, record = asyncio.run(scenario())
+    assert first["headers"] == {"Content-Type": wire.JSON}
+    assert second["headers"]["Content-Type"] == wire.supported[0]
+    assert second["headers"]["Content-Encoding"] == "gzip"
+    assert stored["metadata"]["history_length"] == 5000
+    assert read.headers["content-type"] == wire.supported[0]
+    assert record["data"]["n"] == 2 and record["data"]["process_history"] == history
+
+if __name__ == "__main__":
+    test_negotiate_prefers_highest_quality()
+    test_codec_switches_after_the_service_advertises_formats()
+    print("Wire format tests passed")
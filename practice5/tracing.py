@@ -0,0 +1,134 @@
+import json
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import httpx
+from fastapi import FastAPI
+
+TRACE_HEADER = "X-Request-ID"
+# Optional JSONL file receiving every finished span, for offline analysis
+TRACE_SINK_FILE = os.getenv("TRACE_SINK_FILE", "")
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
+
+VALID_TRACE_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+current_trace = ContextVar("current_trace", default=None)
+sink = None
+
+class Trace:
+    """Spans recorded while one request is handled by one service"""
+
+    def __init__(self, trace_id: str, service: str):
+        self.trace_id = trace_id
+        self.service = service
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def add(self, name: str, start: float, end: float, **attributes):
+        self.spans.append({"name": name, "start": start, "duration": end - start, **attributes})
+
+    def server_timing(self, end: float):
+        parts = [f"{span['name']};dur={span['duration'] * 1000:.1f}" for span in self.spans]
+        parts.append(f"total;dur={(end - self.start) * 1000:.1f}")
+        return ", ".join(parts)
+
+def write_to_sink(trace: Trace):
+    global sink
+    if not TRACE_SINK_FILE:
+        return
+    if sink is None:
+        sink = open(TRACE_SINK_FILE, "a", buffering=1, encoding="utf-8")
+    wall_start = time.time() - (time.perf_counter() - trace.start)
+    for span in trace.spans:
+        record = {"trace_id": trace.trace_id, "service": trace.service, **span}
+        record["start"] = round(wall_start + span["start"] - trace.start, 6)
+        record["duration_ms"] = round(record.pop("duration") * 1000, 3)
+        sink.write(json.dumps(record) + "\n")
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a block of work as a span of the current request, if there is one"""
+    trace = current_trace.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.add(name, start, time.perf_counter(), **attributes)
+
+class TracingMiddleware:
+    """
+    Accepts the caller's X-Request-ID (or generates one), makes it available to
+    outgoing calls through current_trace, echoes it on the response and
+    optionally adds a Server-Timing header with the spans recorded so far.
+    """
+
+    def __init__(self, app, service: str, server_timing: bool):
+        self.app = app
+        self.service = service
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                trace_id = value.decode("latin-1")
+                break
+        if trace_id is None or not VALID_TRACE_ID.match(trace_id):
+            trace_id = uuid.uuid4().hex
+        trace = Trace(trace_id, self.service)
+        token = current_trace.set(trace)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                now = time.perf_counter()
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", trace_id.encode()))
+                if self.server_timing:
+                    headers.append((b"server-timing", trace.server_timing(now).encode()))
+                message = {**message, "headers": headers}
+                trace.add("request", trace.start, now, method=scope["method"], path=scope["path"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_trace.reset(token)
+            write_to_sink(trace)
+
+class TracingTransport(httpx.AsyncBaseTransport):
+    """Propagates the request ID to a downstream service and records the hop as a span"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, downstream: str):
+        self.transport = transport
+        self.downstream = downstream
+
+    async def handle_async_request(self, request):
+        trace = current_trace.get()
+        if trace is None:
+            return await self.transport.handle_async_request(request)
+        request.headers[TRACE_HEADER] = trace.trace_id
+        name = self.downstream + request.url.path.replace("/", "_")
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await self.transport.handle_async_request(request)
+            status = response.status_code
+            return response
+        finally:
+            trace.add(name, start, time.perf_counter(), status=status)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+def enable_tracing(app: FastAPI, service: str, server_timing: bool = False):
+    """Add request ID propagation and span recording; server_timing is meant for the public gateway"""
+    app.add_middleware(TracingMiddleware, service=service,
+                       server_timing=server_timing and SERVER_TIMING_ENABLED)
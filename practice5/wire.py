@@ -0,0 +1,195 @@
+import json
+import os
+import zlib
+from contextvars import ContextVar
+
+from fastapi import HTTPException, Request, Response
+from fastapi.routing import APIRoute
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+# Body formats for internal calls, most preferred first; msgpack is skipped when the package is missing.
+# orjson encodes and decodes faster than msgpack, so JSON comes first when it is installed.
+WIRE_FORMATS = [name.strip() for name in os.getenv("WIRE_FORMATS", "json,msgpack" if orjson else "msgpack,json")
+                .split(",") if name.strip()]
+# Bodies at least this large are gzip-compressed when the other side accepts it; 0 disables compression
+WIRE_COMPRESS_MIN_BYTES = int(os.getenv("WIRE_COMPRESS_MIN_BYTES", "65536"))
+WIRE_COMPRESS_LEVEL = int(os.getenv("WIRE_COMPRESS_LEVEL", "1"))
+# Largest request body accepted after decompression
+WIRE_MAX_BODY_BYTES = int(os.getenv("WIRE_MAX_BODY_BYTES", str(64 * 1024 * 1024)))
+
+MEDIA_TYPES = {"json": JSON, "msgpack": MSGPACK}
+supported = [MEDIA_TYPES[name] for name in WIRE_FORMATS
+             if name in MEDIA_TYPES and (name != "msgpack" or msgpack is not None)]
+if JSON not in supported:
+    supported.append(JSON)
+ACCEPT = ", ".join(media_type if index == 0 else f"{media_type};q={1 - index / 10:.1f}"
+                   for index, media_type in enumerate(supported))
+
+def json_dumps(value) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass  # e.g. integers beyond 64 bits, which the standard encoder handles
+    return json.dumps(value, separators=(",", ":")).encode()
+
+def json_loads(body: bytes):
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+def encode(value, media_type: str):
+    """(body, media_type) for value; falls back to JSON for values msgpack cannot hold"""
+    if media_type == MSGPACK and msgpack is not None:
+        try:
+            return msgpack.packb(value), MSGPACK
+        except (TypeError, OverflowError, ValueError):
+            pass
+    return json_dumps(value), JSON
+
+def decode(body: bytes, media_type: str):
+    if media_type.split(";")[0].strip().lower() == MSGPACK:
+        return msgpack.unpackb(body)
+    return json_loads(body)
+
+def negotiate(accept: str):
+    """The supported media type with the highest q in an Accept-style header; JSON when none is listed"""
+    best, best_q = JSON, 0.0
+    for part in (accept or "").split(","):
+        media_type, _, params = part.partition(";")
+        media_type = media_type.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type in supported and q > best_q:
+            best, best_q = media_type, q
+    return best
+
+def accepts_gzip(accept_encoding: str):
+    return WIRE_COMPRESS_MIN_BYTES > 0 and "gzip" in (accept_encoding or "").lower()
+
+def compress(body: bytes):
+    compressor = zlib.compressobj(WIRE_COMPRESS_LEVEL, wbits=31)
+    return compressor.compress(body) + compressor.flush()
+
+def decompress(body: bytes):
+    decompressor = zlib.decompressobj(wbits=31)
+    data = decompressor.decompress(body, WIRE_MAX_BODY_BYTES)
+    if decompressor.unconsumed_tail:
+        raise HTTPException(status_code=413, detail=f"Body is larger than {WIRE_MAX_BODY_BYTES} bytes")
+    return data
+
+# (media type, gzip allowed) negotiated for the response to the request being handled
+response_format = ContextVar("response_format", default=(JSON, False))
+
+class WireRequest(Request):
+    """A request whose body may be gzip-compressed and msgpack- or JSON-encoded"""
+
+    def __init__(self, scope, receive, media_type: str = JSON):
+        super().__init__(scope, receive)
+        self.media_type = media_type
+
+    async def body(self):
+        if not hasattr(self, "_body"):
+            body = await super().body()
+            if self.headers.get("content-encoding", "").lower() == "gzip":
+                body = decompress(body)
+            self._body = body
+        return self._body
+
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = decode(await self.body(), self.media_type)
+        return self._json
+
+class WireRoute(APIRoute):
+    """
+    Route that reads msgpack and gzip request bodies and negotiates the format
+    WireResponse uses for the reply. Body models are validated as usual; FastAPI
+    only looks for a JSON content type, so msgpack requests are presented as one.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def wire_handler(request: Request):
+            scope = request.scope
+            media_type = request.headers.get("content-type", JSON).split(";")[0].strip().lower()
+            if media_type == MSGPACK:
+                scope = {**scope, "headers": [(name, value) for name, value in scope["headers"]
+                                              if name != b"content-type"] + [(b"content-type", JSON.encode())]}
+            request = WireRequest(scope, request.receive, media_type)
+            token = response_format.set((negotiate(request.headers.get("accept")),
+                                         accepts_gzip(request.headers.get("accept-encoding"))))
+            try:
+                return await handler(request)
+            finally:
+                response_format.reset(token)
+
+        return wire_handler
+
+class WireResponse(Response):
+    """
+    Body in the format negotiated for the current request, gzip-compressed when
+    large. Returning it skips FastAPI's jsonable_encoder, which walks every
+    nested value of the content in Python. The Accept-Post and Accept-Encoding
+    headers tell a Codec what it may send in requests to this service.
+    """
+
+    def __init__(self, content, status_code: int = 200, headers: dict = None):
+        media_type, gzip_allowed = response_format.get()
+        body, media_type = encode(content, media_type)
+        headers = {**(headers or {}), "Accept-Post": ", ".join(supported), "Vary": "Accept, Accept-Encoding"}
+        if WIRE_COMPRESS_MIN_BYTES > 0:
+            headers["Accept-Encoding"] = "gzip"
+        if gzip_allowed and len(body) >= WIRE_COMPRESS_MIN_BYTES:
+            body = compress(body)
+            headers["Content-Encoding"] = "gzip"
+        super().__init__(body, status_code, headers, media_type)
+
+class Codec:
+    """
+    Body encoding for calls to one downstream service. Requests go out as JSON
+    until a response shows, through Accept-Post and Accept-Encoding, that the
+    service reads msgpack or gzip, so a service that has not been upgraded is
+    never sent a body it cannot parse. compression=False never compresses,
+    for services in the same process where it would only cost CPU.
+    """
+
+    def __init__(self, compression: bool = True):
+        self.request_format = JSON
+        self.compression = compression
+        self.compress = False
+
+    def encode(self, value):
+        """Keyword arguments for an httpx request carrying value as its body"""
+        body, media_type = encode(value, self.request_format)
+        headers = {"Content-Type": media_type}
+        if self.compress and len(body) >= WIRE_COMPRESS_MIN_BYTES:
+            body = compress(body)
+            headers["Content-Encoding"] = "gzip"
+        return {"content": body, "headers": headers}
+
+    def decode(self, response):
+        """The decoded body of an httpx response (httpx has already undone gzip)"""
+        accepted = response.headers.get("accept-post")
+        if accepted is not None:
+            self.request_format = negotiate(accepted)
+            self.compress = self.compression and accepts_gzip(response.headers.get("accept-encoding"))
+        return decode(response.content, response.headers.get("content-type", JSON))
+
+    def stats(self):
+        return {"request_format": self.request_format, "compress": self.compress, "accept": ACCEPT}
@@ -1,51 +1,333 @@
 import httpx
 import asyncio
+import json
 import os
+import random
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
 from fastapi import FastAPI, HTTPException
 from dotenv import load_dotenv
+from pydantic import BaseModel
 
-load_dotenv()
+from metrics import instrument, registry
+from profiling import enable_profiling
 
-app = FastAPI(title="Scheduler Service")
+load_dotenv()
 
 APP_TOKEN = os.getenv("APP_TOKEN", "YourSuperSecretToken")
 CLIENT_SERVICE_URL = os.getenv("CLIENT_SERVICE_URL", "http://client-service:8000")
+# Job definitions as a JSON list, inline or in a file; see DEFAULT_JOBS for the fields
+SCHEDULER_JOBS = os.getenv("SCHEDULER_JOBS", "")
+SCHEDULER_JOBS_FILE = os.getenv("SCHEDULER_JOBS_FILE", "")
+
+DEFAULT_JOBS = [{
+    "name": "scheduled-task",
+    "interval": 10,
+    "payload": {"content": "Scheduled task running", "user_id": "scheduler"}
+}]
+
+JOB_DURATION = registry.histogram("scheduler_job_duration_seconds", "Duration of scheduled job runs",
+                                  ("job", "status"))
+
+class JobConfig(BaseModel):
+    name: str
+    # Exactly one of interval (seconds) or cron ("minute hour day month weekday")
+    interval: Optional[float] = None
+    cron: Optional[str] = None
+    # fixed_rate keeps a steady period; fixed_delay waits the interval after each run finishes
+    mode: str = "fixed_rate"
+    # Random delay of up to this many seconds added to every run; fixed_rate runs keep their grid
+    jitter: float = 0
+    # What to do with runs missed while the scheduler was busy: skip, run_once or catch_up.
+    # Runs that fall inside a backoff are always skipped.
+    missed_runs: str = "skip"
+    max_in_flight: int = 1
+    method: str = "POST"
+    path: str = "/process"
+    payload: Dict[str, Any] = {}
+    timeout: float = 10
+    # Calls repeated after an error within one run; they share the run's Idempotency-Key,
+    # so the gateway processes the run at most once
+    retries: int = 0
+    # Wait before retry n: retry_backoff * 2^n plus as much again at random, or the Retry-After
+    # the gateway asked for when that is longer; capped at max_backoff
+    retry_backoff: float = 1
+    # Runs slower than this count as failures for backoff purposes
+    slow_threshold: float = 5
+    max_backoff: float = 300
+
+def parse_cron_field(field: str, low: int, high: int):
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/")
+            step = int(step_text)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(value) for value in part.split("-"))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise ValueError(f"Cron field '{field}' is outside {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+class CronSchedule:
+    """Standard five-field cron expression evaluated in local time"""
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression '{expression}' must have 5 fields")
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12)
+        weekdays = parse_cron_field(fields[4], 0, 7)
+        # Cron counts Sunday as 0 or 7, Python as 6
+        self.weekdays = {(day - 1) % 7 for day in weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def day_matches(self, moment: datetime):
+        day_ok = moment.day in self.days
+        weekday_ok = moment.weekday() in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        # Like cron, a restricted day and weekday match when either one does
+        return day_ok or weekday_ok
+
+    def next_after(self, moment: datetime):
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate + timedelta(days=366 * 5)
+        while candidate < limit:
+            if candidate.month not in self.months:
+                candidate = (candidate.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError("Cron expression never matches")
+
+class Job:
+    def __init__(self, config: JobConfig):
+        if (config.interval is None) == (config.cron is None):
+            raise ValueError(f"Job {config.name} needs exactly one of interval or cron")
+        if config.mode not in ("fixed_rate", "fixed_delay"):
+            raise ValueError(f"Job {config.name} has unknown mode {config.mode}")
+        if config.missed_runs not in ("skip", "run_once", "catch_up"):
+            raise ValueError(f"Job {config.name} has unknown missed_runs policy {config.missed_runs}")
+        self.config = config
+        self.cron = CronSchedule(config.cron) if config.cron else None
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.latencies = deque(maxlen=100)
+        self.next_run = None
+        self.last_run = None
+        self.last_status = None
+        self.counters = {"runs": 0, "succeeded": 0, "failed": 0, "skipped_busy": 0, "missed": 0}
+        self.task = None
+
+    def backoff(self):
+        """Extra delay after consecutive failures or slow runs, doubling up to max_backoff"""
+        if not self.consecutive_failures:
+            return 0
+        base = self.config.interval or 60
+        return min(self.config.max_backoff, base * (2 ** (self.consecutive_failures - 1)))
+
+    def next_cron_delay(self, now: datetime = None):
+        now = now or datetime.now()
+        return (self.cron.next_after(now) - now).total_seconds()
+
+    def next_fixed_rate(self, due: float, now: float):
+        """(next slot, missed slots) of a fixed_rate job whose run was due at due: slots already past at now are missed"""
+        period = self.config.interval
+        next_time = due + period
+        missed = 0
+        if next_time < now:
+            missed = int((now - next_time) // period) + 1
+            next_time += missed * period
+        return next_time, missed
+
+    def run_delay(self):
+        """Backoff and jitter for the next run, added to its wait but never to the schedule itself"""
+        return self.backoff() + (random.uniform(0, self.config.jitter) if self.config.jitter else 0)
+
+    def retry_delay(self, attempt: int, response: httpx.Response = None):
+        delay = self.config.retry_backoff * 2 ** attempt
+        delay += random.uniform(0, delay)
+        retry_after = response.headers.get("retry-after", "") if response is not None else ""
+        if retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        return min(self.config.max_backoff, delay)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 1)
+        return {
+            **self.config.model_dump(exclude={"payload"}),
+            **self.counters,
+            "in_flight": self.in_flight,
+            "consecutive_failures": self.consecutive_failures,
+            "backoff_seconds": self.backoff(),
+            "last_run": self.last_run,
+            "last_status": self.last_status,
+            "next_run": self.next_run,
+            "latency_ms": {"last": round(self.latencies[-1] * 1000, 1) if self.latencies else None,
+                           "p50": percentile(0.5), "p95": percentile(0.95)}
+        }
+
+jobs: Dict[str, Job] = {}
+http_client: Optional[httpx.AsyncClient] = None
+
+def load_jobs():
+    if SCHEDULER_JOBS_FILE:
+        with open(SCHEDULER_JOBS_FILE) as jobs_file:
+            definitions = json.load(jobs_file)
+    elif SCHEDULER_JOBS:
+        definitions = json.loads(SCHEDULER_JOBS)
+    else:
+        definitions = DEFAULT_JOBS
+    return {definition["name"]: Job(JobConfig(**definition)) for definition in definitions}
+
+def retryable(response: httpx.Response):
+    """Errors a later call may not hit: the gateway or a service behind it failing, a conflict or a rate limit"""
+    return response.status_code >= 500 or response.status_code in (409, 429)
+
+async def execute(job: Job, sleep=asyncio.sleep):
+    """Call the client service for a job, retrying with backoff, and record the outcome"""
+    config = job.config
+    job.in_flight += 1
+    job.counters["runs"] += 1
+    job.last_run = time.strftime("%Y-%m-%d %H:%M:%S")
+    start = time.perf_counter()
+    status = "error"
+    headers = {"Idempotency-Key": f"{config.name}-{uuid.uuid4().hex}"}
+    try:
+        for attempt in range(config.retries + 1):
+            response = None
+            try:
+                response = await http_client.request(config.method, config.path, json=config.payload or None,
+                                                      headers=headers, timeout=config.timeout)
+                status = str(response.status_code)
+                failed = response.status_code != 200 or "error" in response.json()
+                if failed:
+                    print(f"Job {config.name} failed with status {response.status_code}: {response.text[:200]}")
+            except Exception as e:
+                failed = True
+                print(f"Job {config.name} error calling client service: {str(e)}")
+            if not failed or attempt == config.retries or (response is not None and not retryable(response)):
+                break
+            # Spread the retries out so they do not hit a service that just failed all at once
+            await sleep(job.retry_delay(attempt, response))
+    finally:
+        job.in_flight -= 1
+    elapsed = time.perf_counter() - start
+    job.latencies.append(elapsed)
+    job.last_status = status
+    JOB_DURATION.observe(elapsed, config.name, status)
+    if failed or elapsed > config.slow_threshold:
+        # Back off while the gateway is failing or slow instead of piling more load onto it
+        job.consecutive_failures += 1
+        job.counters["failed" if failed else "succeeded"] += 1
+    else:
+        job.consecutive_failures = 0
+        job.counters["succeeded"] += 1
+
+def launch(job: Job, running: set, sleep=asyncio.sleep):
+    if job.in_flight >= job.config.max_in_flight:
+        job.counters["skipped_busy"] += 1
+        return None
+    task = asyncio.create_task(execute(job, sleep))
+    running.add(task)
+    task.add_done_callback(running.discard)
+    return task
+
+async def run_job(job: Job, clock=None, sleep=asyncio.sleep):
+    """
+    Launch a job's runs forever. fixed_rate runs stay on a grid of interval
+    slots from the start; backoff and jitter only delay the run at hand, so
+    the schedule never drifts. clock (loop time by default) and sleep can be
+    replaced to drive the schedule in tests.
+    """
+    config = job.config
+    running = set()
+    clock = clock or asyncio.get_running_loop().time
+    period = config.interval
+    next_time = clock() + (job.next_cron_delay() if job.cron else 0)
+    while True:
+        backing_off = job.consecutive_failures > 0
+        delay = next_time + job.run_delay() - clock()
+        job.next_run = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() + max(0, delay)))
+        if delay > 0:
+            await sleep(delay)
+        task = launch(job, running, sleep)
+
+        if config.mode == "fixed_delay" and not job.cron:
+            if task is not None:
+                await task
+            next_time = clock() + period
+        elif job.cron:
+            next_time = clock() + job.next_cron_delay()
+        else:
+            next_time, missed = job.next_fixed_rate(next_time, clock())
+            if missed:
+                job.counters["missed"] += missed
+                # Slots skipped by a backoff stay skipped, or catching up would undo it
+                if config.missed_runs == "catch_up" and not backing_off:
+                    for _ in range(missed):
+                        launch(job, running, sleep)
+                elif config.missed_runs == "run_once" and not backing_off:
+                    launch(job, running, sleep)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    http_client = httpx.AsyncClient(base_url=CLIENT_SERVICE_URL,
+                                    headers={"Authorization": f"Bearer {APP_TOKEN}"})
+    jobs.update(load_jobs())
+    for job in jobs.values():
+        job.task = asyncio.create_task(run_job(job))
+    yield
+    for job in jobs.values():
+        job.task.cancel()
+    await asyncio.gather(*[job.task for job in jobs.values()], return_exceptions=True)
+    jobs.clear()
+    await http_client.aclose()
+
+app = FastAPI(title="Scheduler Service", lifespan=lifespan)
+instrument(app, "scheduler")
+enable_profiling(app, "scheduler")
 
 @app.get("/")
 async def root():
-    return {"service": "Scheduler Service", "version": "1.0.0"}
+    return {"service": "Scheduler Service", "version": "1.1.0", "endpoints": ["/jobs", "/jobs/{name}", "/health", "/metrics"]}
 
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
-async def call_client_service():
-    """Function to periodically call the client service"""
-    while True:
-        try:
-            async with httpx.AsyncClient() as client:
-                headers = {"Authorization": f"Bearer {APP_TOKEN}"}
-                payload = {"content": "Scheduled task running", "user_id": "scheduler"}
-                
-                print(f"Attempting to call {CLIENT_SERVICE_URL}/process")
-                
-                response = await client.post(
-                    f"{CLIENT_SERVICE_URL}/process",
-                    headers=headers,
-                    json=payload,
-                    timeout=10.0
-                )
-                
-                print(f"Called client service. Status code: {response.status_code}")
-                if response.status_code == 200:
-                    print(f"Response: {response.json()}")
-                else:
-                    print(f"Error: {response.text}")
-        except Exception as e:
-            print(f"Error calling client service: {str(e)}")
-
-        await asyncio.sleep(10)
-
-@app.on_event("startup")
-async def startup_event():
-    asyncio.create_task(call_client_service())
+@app.get("/jobs")
+async def list_jobs():
+    return {"jobs": [job.stats() for job in jobs.values()]}
+
+@app.get("/jobs/{name}")
+async def get_job(name: str):
+    job = jobs.get(name)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {name}")
+    return job.stats()
@@ -0,0 +1,146 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import sys
+from datetime import datetime
+
+import httpx
+
+# The scheduler image copies metrics.py and profiling.py from practice5
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "practice5"))
+
+import scheduler_service
+from scheduler_service import CronSchedule, Job, JobConfig, parse_cron_field, run_job
+
+class Finished(Exception):
+    pass
+
+class FakeClock:
+    """Loop time that jumps to the next sleeper once every task is waiting, up to until"""
+
+    def __init__(self, until: float):
+        self.now = 0.0
+        self.until = until
+        self.sleeps = []
+        self.sleepers = []
+        self.order = itertools.count()
+
+    def __call__(self):
+        return self.now
+
+    async def wait(self, seconds):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.sleepers, (self.now + seconds, next(self.order), future))
+        await future
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        await self.wait(seconds)
+
+    async def run(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        while True:
+            for _ in range(20):
+                await asyncio.sleep(0)
+            if task.done() or not self.sleepers or self.sleepers[0][0] > self.until:
+                break
+            self.now, _, future = heapq.heappop(self.sleepers)
+            future.set_result(None)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+def schedule(config: dict, until: float, answers=lambda call: httpx.Response(200, json={}), duration: float = 0):
+    """Start times of a job's calls to the gateway while run_job runs on a FakeClock up to until"""
+    clock = FakeClock(until)
+    calls = []
+
+    async def handler(request):
+        calls.append(clock.now)
+        await clock.wait(duration)
+        return answers(len(calls))
+
+    async def scenario():
+        scheduler_service.http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler),
+                                                          base_url="http://client-service")
+        job = Job(JobConfig(name="test", **config))
+        try:
+            await clock.run(run_job(job, clock, clock.sleep))
+        finally:
+            await scheduler_service.http_client.aclose()
+        return job
+
+    job = asyncio.run(scenario())
+    return calls, job, clock
+
+def test_cron_fields_and_next_run():
+    assert parse_cron_field("*/15", 0, 59) == {0, 15, 30, 45}
+    assert parse_cron_field("5/20", 0, 59) == {5, 25, 45}
+    assert parse_cron_field("1-3,7", 0, 7) == {1, 2, 3, 7}
+    for field in ("60", "5-2", "0-8"):
+        try:
+            parse_cron_field(field, 0, 7 if field == "0-8" else 59)
+            raise AssertionError(f"{field} was accepted")
+        except ValueError:
+            pass
+    working_hours = CronSchedule("*/15 9-17 * * 1-5")
+    # Friday evening to Monday morning
+    assert working_hours.next_after(datetime(2026, 10, 16, 17, 50)) == datetime(2026, 10, 19, 9, 0)
+    assert working_hours.next_after(datetime(2026, 10, 19, 9, 0)) == datetime(2026, 10, 19, 9, 15)
+    # A restricted day of month and weekday match when either one does: the 13th, or any Friday
+    thirteenth_or_friday = CronSchedule("0 0 13 * 5")
+    assert thirteenth_or_friday.next_after(datetime(2026, 10, 10)) == datetime(2026, 10, 13)
+    assert thirteenth_or_friday.next_after(datetime(2026, 10, 13)) == datetime(2026, 10, 16)
+    job = Job(JobConfig(name="cron", cron="30 * * * *"))
+    assert job.next_cron_delay(datetime(2026, 10, 19, 9, 0)) == 30 * 60
+
+def test_fixed_rate_keeps_its_grid_and_fixed_delay_waits_after_runs():
+    rate, _, _ = schedule({"interval": 10}, until=35, duration=3)
+    delay, _, _ = schedule({"interval": 10, "mode": "fixed_delay"}, until=35, duration=3)
+    assert rate == [0, 10, 20, 30]
+    assert delay == [0, 13, 26]
+    random.seed(3)
+    jittered, _, _ = schedule({"interval": 10, "jitter": 4}, until=1000)
+    # Jitter delays each run within its slot but never moves the slots
+    assert len(jittered) == 100
+    assert all(10 * slot <= start <= 10 * slot + 4 for slot, start in enumerate(jittered))
+
+def test_missed_slots_are_counted_and_skipped():
+    job = Job(JobConfig(name="missed", interval=10))
+    assert job.next_fixed_rate(0, 5) == (10, 0)
+    assert job.next_fixed_rate(0, 35) == (40, 3)
+    assert job.next_fixed_rate(0, 40) == (50, 4)
+
+def test_backoff_delays_runs_without_moving_the_grid():
+    failing = lambda call: httpx.Response(503 if call <= 4 else 200, json={})
+    calls, job, _ = schedule({"interval": 10, "max_backoff": 100, "missed_runs": "catch_up"}, until=200,
+                             answers=failing)
+    # A run's result is known from the next slot on: the slots at 20, 30, 60 and 110 wait 10, 20, 40 and
+    # 80 seconds. The slots that passed during a backoff are skipped even with catch_up, and the grid is
+    # the same afterwards
+    assert calls == [0, 10, 30, 50, 100, 190, 200]
+    assert job.counters["failed"] == 4 and job.counters["missed"] == 14
+    assert job.consecutive_failures == 0
+
+def test_retries_back_off_exponentially():
+    answers = {1: httpx.Response(503), 2: httpx.Response(503), 3: httpx.Response(429, headers={"Retry-After": "9"})}
+    calls, job, clock = schedule({"interval": 100, "mode": "fixed_delay", "retries": 3, "retry_backoff": 1}, until=50,
+                                 answers=lambda call: answers.get(call, httpx.Response(200, json={})))
+    retry_waits = clock.sleeps[:3]
+    assert 1 <= retry_waits[0] <= 2 and 2 <= retry_waits[1] <= 4
+    assert retry_waits[2] == 9
+    assert len(calls) == 4 and job.counters["succeeded"] == 1
+
+    # A request the gateway rejected as invalid is not repeated
+    calls, job, _ = schedule({"interval": 100, "retries": 3}, until=50,
+                             answers=lambda call: httpx.Response(422, json={"detail": "invalid"}))
+    assert len(calls) == 1 and job.counters["failed"] == 1
+
+if __name__ == "__main__":
+    test_cron_fields_and_next_run()
+    test_fixed_rate_keeps_its_grid_and_fixed_delay_waits_after_runs()
+    test_missed_slots_are_counted_and_skipped()
+    test_backoff_delays_runs_without_moving_the_grid()
+    test_retries_back_off_exponentially()
+    print("Scheduler tests passed")